@@ -0,0 +1,529 @@
+"""Benchmark API của server trên catalogue tổng hợp.
+
+Tạo database riêng với N user và N scenario (visual workflow có kích thước
+giống thực tế), rồi chạy song song các request đọc / ghi trong một khoảng thời
+gian cố định, báo throughput và p50 / p99 cho từng loại request:
+
+    python bench.py --users 200 --scenarios 20000 --concurrency 8 --duration 20
+    python bench.py --mode http              # qua WSGI server thật trên cổng local
+    python bench.py --save bench-baseline.json
+    python bench.py --compare bench-baseline.json --threshold 0.2
+
+Cùng --seed thì catalogue và chuỗi request giống hệt nhau giữa các lần chạy.
+--compare trả về exit code 1 nếu có request chậm hơn / ít hơn baseline quá threshold.
+"""
+import argparse
+import http.client
+import json
+import logging
+import math
+import os
+import platform
+import random
+import sqlite3
+import sys
+import threading
+import time
+import urllib.parse
+import zlib
+
+from werkzeug.security import generate_password_hash
+
+import server
+from workflow import STEP_PARAMETERS, REQUIRED
+
+BENCH_PASSWORD = 'bench123'
+
+# Key trong app_meta đánh dấu database do bench.py tạo (chỉ database này mới được xóa để seed lại)
+BENCH_META_KEY = 'bench_seed'
+
+# Tỷ lệ loại bước trong workflow thực tế: phần lớn là click / nhập liệu / chờ
+STEP_TYPE_WEIGHTS = {
+    'click': 30, 'type_text': 15, 'wait': 12, 'wait_element': 10, 'open_url': 5, 'get_text': 5,
+    'element_exists': 4, 'scroll': 4, 'press_key': 3, 'condition': 3, 'screenshot': 2, 'javascript': 2,
+    'new_tab': 1, 'activate_tab': 1, 'close_tab': 1, 'go_back': 1, 'reload_page': 1, 'upload': 1,
+    'download': 1, 'loop': 1,
+}
+
+# Loại request -> trọng số trong workload
+DEFAULT_MIX = {
+    'list': 30,
+    'detail': 30,
+    'automation': 10,
+    'admin': 5,
+    'update': 15,
+    'create': 5,
+    'plan': 5,
+}
+
+def workflow_size(rng):
+    """Số node của một workflow: log-normal, trung vị ~15, tối đa 300"""
+    return max(1, min(300, int(rng.lognormvariate(2.7, 0.8))))
+
+def step_parameters(rng, step_type, index):
+    data = {}
+    for name, (kind, default) in STEP_PARAMETERS[step_type].items():
+        if name in ('xpath', 'element_xpath', 'target_element'):
+            data[name] = f"//div[@id='section-{index % 7}']//button[contains(@class, 'action-{rng.randrange(40)}')]"
+        elif name in ('url',):
+            data[name] = f'https://example.com/app/{rng.randrange(1000)}/page?step={index}'
+        elif name in ('text', 'script', 'expected_value'):
+            data[name] = ' '.join(f'value{rng.randrange(10000)}' for _ in range(rng.randint(1, 8)))
+        elif default is not REQUIRED and default is not None:
+            # Editor lưu mọi giá trị dưới dạng chuỗi
+            data[name] = str(default).lower() if kind is bool else str(default)
+    return data
+
+def generate_visual_workflow(rng, node_count):
+    """Workflow dạng editor (static/app.js): chuỗi success từ start node,
+    condition rẽ nhánh failure tới một node phía sau"""
+    types = list(STEP_TYPE_WEIGHTS)
+    weights = list(STEP_TYPE_WEIGHTS.values())
+    nodes = [{'id': 'node_1', 'type': 'start', 'position': {'x': 100, 'y': 100}, 'data': {}, 'isStart': True}]
+    connections = []
+    for index in range(2, node_count + 2):
+        step_type = rng.choices(types, weights)[0]
+        nodes.append({
+            'id': f'node_{index}',
+            'type': step_type,
+            'position': {'x': 100 + (index % 6) * 220, 'y': 100 + (index // 6) * 140},
+            'data': step_parameters(rng, step_type, index),
+            'isStart': False,
+        })
+        connections.append({'source': f'node_{index - 1}', 'target': f'node_{index}', 'type': 'success'})
+        if step_type == 'condition' and index + 2 <= node_count + 1:
+            target = rng.randint(index + 2, min(node_count + 1, index + 6))
+            connections.append({'source': f'node_{index}', 'target': f'node_{target}', 'type': 'failure'})
+    return {
+        'workflow_type': 'visual',
+        'nodes': nodes,
+        'connections': connections,
+        'startNode': 'node_1',
+        'metadata': {'nodeCount': len(nodes), 'connectionCount': len(connections), 'version': '2.0', 'mode': 'create'},
+    }
+
+def generate_scenario_steps(rng):
+    """80% visual workflow như editor mới, còn lại là danh sách bước kiểu cũ"""
+    size = workflow_size(rng)
+    if rng.random() < 0.8:
+        return generate_visual_workflow(rng, size)
+    types = list(STEP_TYPE_WEIGHTS)
+    weights = list(STEP_TYPE_WEIGHTS.values())
+    steps = []
+    for index in range(size):
+        step_type = rng.choices(types, weights)[0]
+        steps.append({'type': step_type, **step_parameters(rng, step_type, index)})
+    return steps
+
+def remove_database(path):
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+def read_bench_seed(path):
+    """Tham số seed đã ghi trong database, None nếu database không do bench.py tạo"""
+    if not os.path.exists(path):
+        return None
+    conn = sqlite3.connect(path)
+    try:
+        row = conn.execute('SELECT value FROM app_meta WHERE key = ?', (BENCH_META_KEY,)).fetchone()
+    except sqlite3.Error:
+        row = None
+    finally:
+        conn.close()
+    return row[0] if row else None
+
+def seed_key(users, scenarios, seed):
+    return zlib.crc32(f'{users}:{scenarios}:{seed}'.encode())
+
+def seed_database(path, users, scenarios, seed, public_ratio=0.6):
+    """Tạo database mẫu với user bench_<i> (mật khẩu BENCH_PASSWORD) và scenario ngẫu nhiên theo seed"""
+    started = time.time()
+    server.app.config['DATABASE'] = path
+    server.init_database()
+    rng = random.Random(seed)
+    # Băm mật khẩu rất chậm, mọi user benchmark dùng chung một hash
+    password_hash = generate_password_hash(BENCH_PASSWORD)
+    
+    conn = server.open_db_connection(path)
+    cursor = conn.cursor()
+    cursor.execute('BEGIN IMMEDIATE')
+    cursor.executemany('INSERT INTO users (username, password_hash, role) VALUES (?, ?, ?)', [
+        (f'bench_{index}', password_hash, 'user') for index in range(users)
+    ])
+    user_ids = [row[0] for row in cursor.execute("SELECT id FROM users WHERE username LIKE 'bench\\_%' ESCAPE '\\'")]
+    conn.commit()
+    
+    batch = server.app.config['IMPORT_BATCH_SIZE']
+    for start in range(0, scenarios, batch):
+        cursor.execute('BEGIN IMMEDIATE')
+        for index in range(start, min(scenarios, start + batch)):
+            server.insert_scenario(
+                cursor,
+                f'Scenario {index} {rng.choice(["login", "checkout", "report", "sync", "export", "search"])}',
+                f'Synthetic workflow #{index}',
+                generate_scenario_steps(rng),
+                rng.random() < public_ratio,
+                rng.choice(user_ids)
+            )
+        conn.commit()
+        print(f"\rSeeding scenarios: {min(scenarios, start + batch)}/{scenarios}", end='', flush=True)
+    
+    conn.execute('INSERT OR REPLACE INTO app_meta (key, value) VALUES (?, ?)', (BENCH_META_KEY, seed_key(users, scenarios, seed)))
+    conn.commit()
+    conn.execute('ANALYZE')
+    conn.close()
+    print(f"\nSeeded {users} users and {scenarios} scenarios in {time.time() - started:.1f}s")
+
+def prepare_database(path, users, scenarios, seed):
+    """Chép database mẫu (<path>.seed, chỉ seed lại khi tham số đổi) ra path để mỗi lần chạy
+    bắt đầu từ cùng một trạng thái, kể cả khi lần trước đã ghi thêm dữ liệu"""
+    template = path + '.seed'
+    for target in (template, path):
+        if os.path.exists(target) and read_bench_seed(target) is None:
+            sys.exit(f"{target} was not created by bench.py, refusing to overwrite it (pass another --database)")
+    
+    if read_bench_seed(template) != seed_key(users, scenarios, seed):
+        remove_database(template)
+        seed_database(template, users, scenarios, seed)
+    
+    remove_database(path)
+    source = sqlite3.connect(template)
+    target = sqlite3.connect(path)
+    try:
+        source.backup(target)
+    finally:
+        source.close()
+        target.close()
+
+class TestClientSession:
+    """Gọi app qua Flask test client (không tốn chi phí mạng / HTTP parsing)"""
+    
+    def __init__(self, base_url=None):
+        self.client = server.app.test_client()
+    
+    def request(self, method, path, json_body=None, form=None):
+        response = self.client.open(path, method=method, json=json_body, data=form)
+        response.get_data()
+        return response.status_code
+
+class HttpSession:
+    """Gọi WSGI server thật qua HTTP, giữ cookie session"""
+    
+    def __init__(self, base_url):
+        parsed = urllib.parse.urlsplit(base_url)
+        self.host, self.port = parsed.hostname, parsed.port
+        self.cookie = None
+    
+    def request(self, method, path, json_body=None, form=None):
+        headers = {'Accept-Encoding': 'gzip'}
+        body = None
+        if json_body is not None:
+            body = json.dumps(json_body)
+            headers['Content-Type'] = 'application/json'
+        elif form is not None:
+            body = urllib.parse.urlencode(form)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        if self.cookie:
+            headers['Cookie'] = self.cookie
+        
+        conn = http.client.HTTPConnection(self.host, self.port, timeout=30)
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            response = conn.getresponse()
+            response.read()
+            cookie = response.getheader('Set-Cookie')
+            if cookie:
+                self.cookie = cookie.split(';', 1)[0]
+            return response.status
+        finally:
+            conn.close()
+
+def start_http_server():
+    """Chạy app trên werkzeug threaded server ở một cổng rảnh, trả về (server, base_url)"""
+    from werkzeug.serving import make_server
+    # Log từng request của werkzeug làm sai lệch kết quả
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    http_server = make_server('127.0.0.1', 0, server.app, threaded=True)
+    threading.Thread(target=http_server.serve_forever, name='bench-http', daemon=True).start()
+    return http_server, f'http://127.0.0.1:{http_server.server_port}'
+
+class Workload:
+    """Danh sách id để chọn request, đọc một lần từ database đã seed"""
+    
+    def __init__(self, path, mix):
+        conn = sqlite3.connect(path)
+        self.public_ids = [row[0] for row in conn.execute(
+            'SELECT id FROM automation_scenarios WHERE is_public = 1 ORDER BY id')]
+        self.owned = {}
+        for scenario_id, username in conn.execute('''
+            SELECT s.id, u.username FROM automation_scenarios s JOIN users u ON u.id = s.created_by
+            WHERE u.username LIKE 'bench\\_%' ESCAPE '\\' ORDER BY s.id
+        '''):
+            self.owned.setdefault(username, []).append(scenario_id)
+        self.usernames = [row[0] for row in conn.execute(
+            "SELECT username FROM users WHERE username LIKE 'bench\\_%' ESCAPE '\\' ORDER BY id")]
+        conn.close()
+        if not self.public_ids or not self.usernames:
+            sys.exit('Benchmark database has no public scenarios or users, seed it with more scenarios')
+        
+        self.operations = [name for name in mix if mix[name] > 0]
+        self.weights = [mix[name] for name in self.operations]
+        self.total_pages = max(1, len(self.public_ids) // server.app.config['PAGE_SIZE'])
+
+def run_operation(operation, session, admin, username, workload, rng):
+    """Thực hiện một request, trả về status code"""
+    if operation == 'list':
+        params = {'limit': 50, 'fields': 'id,name,description,is_public,updated_at,workflow_type'}
+        return session.request('GET', f'/api/scenarios?{urllib.parse.urlencode(params)}')
+    if operation == 'detail':
+        return session.request('GET', f'/api/scenarios/{rng.choice(workload.public_ids)}')
+    if operation == 'plan':
+        return session.request('GET', f'/api/scenarios/{rng.choice(workload.public_ids)}/plan')
+    if operation == 'automation':
+        # Trang đầu được mở nhiều nhất, các trang sau giảm dần
+        page = min(workload.total_pages, int(rng.expovariate(0.5)) + 1)
+        return session.request('GET', f'/automation?page={page}')
+    if operation == 'admin':
+        return admin.request('GET', f'/admin?page={min(workload.total_pages, int(rng.expovariate(0.5)) + 1)}')
+    if operation == 'update':
+        owned = workload.owned.get(username)
+        if not owned:
+            return session.request('POST', '/api/scenarios', json_body={
+                'name': f'Bench {username}', 'steps': generate_scenario_steps(rng), 'is_public': False})
+        return session.request('PUT', f'/api/scenarios/{rng.choice(owned)}', json_body={
+            'description': f'Updated at {time.time():.3f}', 'steps': generate_scenario_steps(rng)})
+    if operation == 'create':
+        return session.request('POST', '/api/scenarios', json_body={
+            'name': f'Bench {username} {rng.randrange(10 ** 6)}',
+            'description': 'Created by bench.py',
+            'steps': generate_scenario_steps(rng),
+            'is_public': rng.random() < 0.5,
+        })
+    raise ValueError(f'Unknown operation {operation}')
+
+def percentile(values, fraction):
+    """Percentile theo nearest-rank của danh sách đã sắp xếp"""
+    if not values:
+        return None
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+def run_benchmark(workload, session_class, base_url, concurrency, duration, warmup, seed):
+    """Chạy concurrency luồng trong warmup + duration giây, trả về latency (giây) và số lỗi theo loại request"""
+    latencies = {name: [] for name in workload.operations}
+    errors = {name: 0 for name in workload.operations}
+    lock = threading.Lock()
+    start_barrier = threading.Barrier(concurrency + 1)
+    timing = {}
+    
+    def worker(index):
+        rng = random.Random(seed * 1000 + index)
+        username = workload.usernames[index % len(workload.usernames)]
+        session = session_class(base_url)
+        admin = session_class(base_url)
+        session.request('POST', '/login', form={'username': username, 'password': BENCH_PASSWORD})
+        admin.request('POST', '/login', form={'username': 'admin', 'password': 'admin123'})
+        local_latencies = {name: [] for name in workload.operations}
+        local_errors = {name: 0 for name in workload.operations}
+        start_barrier.wait()
+        
+        while True:
+            now = time.perf_counter()
+            if now >= timing['end']:
+                break
+            operation = rng.choices(workload.operations, workload.weights)[0]
+            started = time.perf_counter()
+            try:
+                status = run_operation(operation, session, admin, username, workload, rng)
+            except Exception:
+                status = None
+            elapsed = time.perf_counter() - started
+            if started < timing['measure_from']:
+                continue
+            if status is None or status >= 400:
+                local_errors[operation] += 1
+            else:
+                local_latencies[operation].append(elapsed)
+        
+        with lock:
+            for name in workload.operations:
+                latencies[name].extend(local_latencies[name])
+                errors[name] += local_errors[name]
+    
+    threads = [threading.Thread(target=worker, args=(index,), daemon=True) for index in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    # Các luồng đã đăng nhập xong, tính giờ từ lúc cùng bắt đầu
+    began = time.perf_counter()
+    timing['measure_from'] = began + warmup
+    timing['end'] = began + warmup + duration
+    start_barrier.wait()
+    for thread in threads:
+        thread.join()
+    return latencies, errors
+
+def summarize(latencies, errors, duration):
+    results = {}
+    total = []
+    for name, values in latencies.items():
+        values.sort()
+        total.extend(values)
+        results[name] = {
+            'requests': len(values),
+            'errors': errors[name],
+            'throughput': round(len(values) / duration, 1),
+            'p50_ms': round(percentile(values, 0.5) * 1000, 2) if values else None,
+            'p99_ms': round(percentile(values, 0.99) * 1000, 2) if values else None,
+        }
+    total.sort()
+    results['total'] = {
+        'requests': len(total),
+        'errors': sum(errors.values()),
+        'throughput': round(len(total) / duration, 1),
+        'p50_ms': round(percentile(total, 0.5) * 1000, 2) if total else None,
+        'p99_ms': round(percentile(total, 0.99) * 1000, 2) if total else None,
+    }
+    return results
+
+def print_results(results, baseline=None):
+    header = f"{'request':<12}{'count':>9}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}"
+    print(header + ('   vs baseline (req/s, p50, p99)' if baseline else ''))
+    print('-' * len(header))
+    for name, result in results.items():
+        p50 = '-' if result['p50_ms'] is None else f"{result['p50_ms']:.2f}"
+        p99 = '-' if result['p99_ms'] is None else f"{result['p99_ms']:.2f}"
+        line = f"{name:<12}{result['requests']:>9}{result['errors']:>8}{result['throughput']:>10.1f}{p50:>10}{p99:>10}"
+        previous = (baseline or {}).get(name)
+        if previous:
+            line += '   ' + ', '.join(
+                format_change(result[key], previous.get(key)) for key in ('throughput', 'p50_ms', 'p99_ms')
+            )
+        print(line)
+
+def relative_change(current, previous):
+    if current is None or not previous:
+        return None
+    return (current - previous) / previous
+
+def format_change(current, previous):
+    change = relative_change(current, previous)
+    return 'n/a' if change is None else f'{change:+.0%}'
+
+def find_regressions(results, baseline, threshold):
+    """Các request có throughput giảm hoặc p50/p99 tăng quá threshold so với baseline"""
+    regressions = []
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if not previous:
+            continue
+        throughput = relative_change(result['throughput'], previous.get('throughput'))
+        if throughput is not None and throughput < -threshold:
+            regressions.append(f"{name}: throughput {format_change(result['throughput'], previous['throughput'])}")
+        for key in ('p50_ms', 'p99_ms'):
+            change = relative_change(result[key], previous.get(key))
+            if change is not None and change > threshold:
+                regressions.append(f"{name}: {key} {format_change(result[key], previous[key])}")
+        if result['errors'] > previous.get('errors', 0):
+            regressions.append(f"{name}: errors {previous.get('errors', 0)} -> {result['errors']}")
+    return regressions
+
+def parse_mix(value):
+    """--mix list=40,detail=40,update=20 (các loại không nêu có trọng số 0)"""
+    mix = dict.fromkeys(DEFAULT_MIX, 0)
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError(f"unknown request type {name!r}, expected one of {', '.join(DEFAULT_MIX)}")
+        try:
+            mix[name] = float(weight)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f'invalid weight for {name}: {weight!r}')
+    if not any(mix.values()):
+        raise argparse.ArgumentTypeError('at least one request type needs a positive weight')
+    return mix
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the automation server against a synthetic catalogue")
+    parser.add_argument('--database', default='bench.db', help="benchmark database (created by this script)")
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--scenarios', type=int, default=5000)
+    parser.add_argument('--seed', type=int, default=1, help="seed for the catalogue and the request sequence")
+    parser.add_argument('--mode', choices=('client', 'http'), default='client',
+                        help="Flask test client in-process, or a local threaded WSGI server")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=10, help="measured seconds")
+    parser.add_argument('--warmup', type=float, default=2, help="seconds run before measuring")
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+                        help="request weights, e.g. list=40,detail=40,update=20")
+    parser.add_argument('--save', metavar='FILE', help="write the results as a baseline")
+    parser.add_argument('--compare', metavar='FILE', help="compare with a saved baseline, exit 1 on regression")
+    parser.add_argument('--threshold', type=float, default=0.2, help="allowed relative regression (0.2 = 20%%)")
+    args = parser.parse_args()
+    
+    config = {
+        'users': args.users,
+        'scenarios': args.scenarios,
+        'seed': args.seed,
+        'mode': args.mode,
+        'concurrency': args.concurrency,
+        'duration': args.duration,
+        'mix': args.mix,
+    }
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        differing = {key: (baseline['config'].get(key), value) for key, value in config.items()
+                     if baseline['config'].get(key) != value}
+        if differing:
+            print(f"Warning: configuration differs from the baseline: {differing}")
+    
+    prepare_database(args.database, args.users, args.scenarios, args.seed)
+    server.app.config['DATABASE'] = args.database
+    server.init_database()
+    server.scenario_cache.invalidate()
+    # Giống cấu hình production: không có debug / testing
+    server.app.testing = False
+    
+    workload = Workload(args.database, args.mix)
+    http_server = None
+    base_url = None
+    session_class = TestClientSession
+    if args.mode == 'http':
+        http_server, base_url = start_http_server()
+        session_class = HttpSession
+    
+    print(f"Running {args.concurrency} client(s) for {args.duration:g}s (+{args.warmup:g}s warmup), mode {args.mode}")
+    try:
+        latencies, errors = run_benchmark(workload, session_class, base_url, args.concurrency,
+                                          args.duration, args.warmup, args.seed)
+    finally:
+        if http_server is not None:
+            http_server.shutdown()
+    
+    results = summarize(latencies, errors, args.duration)
+    print_results(results, baseline and baseline['results'])
+    
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump({
+                'config': config,
+                'environment': {'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version,
+                                'machine': platform.machine(), 'created': time.strftime('%Y-%m-%dT%H:%M:%S')},
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f"Baseline written to {args.save}")
+    
+    if baseline:
+        regressions = find_regressions(results, baseline['results'], args.threshold)
+        if regressions:
+            print(f"Regressions beyond {args.threshold:.0%}:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print("No regressions beyond threshold")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+"""Cấu hình gunicorn: gunicorn -c gunicorn.conf.py wsgi:app
+
+Các giá trị đọc từ biến môi trường để chỉnh khi deploy mà không sửa file:
+BIND, WEB_CONCURRENCY (số worker), WORKER_CONNECTIONS (kết nối mỗi worker).
+"""
+import multiprocessing
+import os
+import subprocess
+import sys
+
+bind = os.environ.get('BIND', '0.0.0.0:5000')
+
+# SQLite chỉ có một writer tại một thời điểm, thêm worker chủ yếu giúp phần đọc / render
+workers = int(os.environ.get('WEB_CONCURRENCY', min(multiprocessing.cpu_count() * 2 + 1, 8)))
+
+# gevent: mỗi kết nối là một greenlet, stream SSE và keep-alive không chiếm OS thread.
+# Truy vấn SQLite của request vẫn chặn worker trong lúc chạy (vài ms), nên giữ truy vấn ngắn;
+# thread nền (ghi step event, đọc run_event_log) có thể chờ khóa ghi tới DB_BUSY_TIMEOUT
+# nên chạy SQLite trên threadpool của hub (run_blocking_sqlite)
+worker_class = 'gevent'
+worker_connections = int(os.environ.get('WORKER_CONNECTIONS', 1000))
+keepalive = 5
+
+# Stream SSE kéo dài nhiều phút; timeout chỉ áp dụng cho heartbeat của worker
+timeout = 30
+graceful_timeout = 30
+
+# Không preload: kết nối SQLite và các thread nền (ghi step event, đọc run_event_log)
+# được mở trong từng worker sau khi fork
+preload_app = False
+
+def on_starting(arbiter):
+    """Migrate database một lần trước khi các worker khởi động. Chạy trong process con:
+    master không được import server, nếu không worker fork ra sẽ mang lock / kết nối
+    tạo trước khi gevent monkey-patch"""
+    subprocess.run([sys.executable, '-c', 'import wsgi'], check=True)
+    os.environ['SCENARIO_SERVER_INITIALIZED'] = '1'
@@ -23,8 +23,80 @@ import os
 import subprocess
 import platform
 from pathlib import Path
+from workflow import compile_workflow, PLAN_VERSION
+
+class RunReporter:
+    """Gửi event của một run lên server từ thread riêng để không làm chậm các bước.
+    Event phát sinh trong lúc request trước đang gửi được gom vào request kế tiếp.
+    endpoint 'steps' lưu lịch sử và phát trực tiếp, 'events' chỉ phát trực tiếp."""
+    
+    # Số event tối đa mỗi request (server giới hạn RUN_EVENT_MAX_BATCH)
+    MAX_BATCH = 500
+    
+    def __init__(self, api_url, run_id, token, endpoint='steps', on_error=None):
+        self.url = f"{api_url}/runs/{run_id}/{endpoint}"
+        self.token = token
+        self.on_error = on_error
+        self.pending = []
+        self.finish = None
+        self.closed = False
+        self.failed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._send_loop, name=f'run-report-{run_id}', daemon=True)
+        self.thread.start()
+    
+    def send(self, kind, **data):
+        """Xếp một event (step-started, step-finished, log) vào hàng gửi"""
+        with self.condition:
+            if self.closed or self.failed:
+                return
+            self.pending.append({'kind': kind, **data})
+            self.condition.notify()
+    
+    def close(self, status=None, error=None, steps_total=None, timeout=10):
+        """Gửi các event còn lại kèm trạng thái cuối (nếu có), chờ tối đa timeout giây"""
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            if status:
+                self.finish = {'status': status, 'error': error, 'steps_total': steps_total}
+            self.condition.notify()
+        self.thread.join(timeout)
+    
+    def _send_loop(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+                events = self.pending[:self.MAX_BATCH]
+                del self.pending[:self.MAX_BATCH]
+                last = self.closed and not self.pending
+                if last and not events and not self.finish:
+                    return
+                body = {'events': events}
+                if last and self.finish:
+                    body.update(self.finish)
+            
+            try:
+                response = requests.post(self.url, json=body, headers={'X-Run-Token': self.token}, timeout=10)
+                if response.status_code != 202:
+                    raise Exception(f"Server returned status code: {response.status_code}")
+            except Exception as e:
+                with self.condition:
+                    self.failed = True
+                    self.pending = []
+                if self.on_error:
+                    self.on_error(e)
+                return
+            if last:
+                return
 
 class AutomationApp:
+    # Trường lấy khi tải danh sách và số kịch bản mỗi trang
+    SCENARIO_LIST_FIELDS = "id,name,description,is_public,updated_at,workflow_type,needs_upload,needs_download"
+    SCENARIO_PAGE_SIZE = 200
+    
     def __init__(self, root):
         self.root = root
         self.root.title("Enhanced Browser Automation Tool v2.0")
@@ -35,7 +107,14 @@ class AutomationApp:
         
         # Variables
         self.scenarios = []
+        self.scenarios_etag = None  # (api_url, ETag) của lần tải danh sách gần nhất
+        self.replica = {}  # Bản sao catalogue công khai: id -> scenario
+        self.replica_api_url = None
+        self.replica_revision = 0  # Revision đã đồng bộ tới, gửi lại làm ?since=
+        self.showing_search_results = False
         self.selected_scenario = None
+        self.execution_plan = None  # Plan của lần chạy hiện tại
+        self.run_report = None  # RunReporter của run đang được ghi lịch sử trên server
         self.upload_folder = tk.StringVar()
         self.download_path = tk.StringVar()
         self.show_browser = tk.BooleanVar(value=True)
@@ -90,6 +169,18 @@ class AutomationApp:
         scenarios_frame.columnconfigure(0, weight=1)
         scenarios_frame.rowconfigure(1, weight=1)
         
+        # Search box (tìm kiếm toàn văn trên server)
+        search_frame = ttk.Frame(scenarios_frame)
+        search_frame.grid(row=0, column=0, sticky=(tk.W, tk.E), pady=(0, 5))
+        search_frame.columnconfigure(0, weight=1)
+        
+        self.search_entry = ttk.Entry(search_frame)
+        self.search_entry.grid(row=0, column=0, sticky=(tk.W, tk.E))
+        self.search_entry.bind('<Return>', lambda event: self.search_scenarios())
+        
+        ttk.Button(search_frame, text="Search", command=self.search_scenarios).grid(row=0, column=1, padx=(5, 0))
+        ttk.Button(search_frame, text="Clear", command=self.clear_search).grid(row=0, column=2, padx=(5, 0))
+        
         # Scenarios listbox with scrollbar
         listbox_frame = ttk.Frame(scenarios_frame)
         listbox_frame.grid(row=1, column=0, sticky=(tk.W, tk.E, tk.N, tk.S))
@@ -181,6 +272,10 @@ class AutomationApp:
             "DEBUG": "🐛"
         }.get(level, "ℹ️")
         
+        report = self.run_report
+        if report:
+            report.send('log', level=level, message=str(message), at=time.time())
+        
         self.log_text.config(state="normal")
         self.log_text.insert(tk.END, f"[{timestamp}] {level_prefix} {message}\n")
         self.log_text.see(tk.END)
@@ -192,19 +287,64 @@ class AutomationApp:
         self.status_var.set(status)
         self.root.update_idletasks()
     
+    def get_api_url(self):
+        """Lấy địa chỉ Flask API đang cấu hình"""
+        api_url = self.api_url_entry.get().strip()
+        if not api_url:
+            api_url = "http://localhost:5000/api"
+        return api_url
+    
     def load_scenarios(self):
         """Tải danh sách kịch bản từ Flask API"""
         try:
             self.update_status("Loading scenarios...")
-            api_url = self.api_url_entry.get().strip()
-            if not api_url:
-                api_url = "http://localhost:5000/api"
+            api_url = self.get_api_url()
             
-            response = requests.get(f"{api_url}/scenarios", timeout=10)
+            # Server mới: chỉ tải những gì đã thay đổi kể từ lần đồng bộ trước
+            changed = self.sync_scenarios(api_url)
+            if changed is not None:
+                if changed or self.showing_search_results or not self.scenarios:
+                    self.showing_search_results = False
+                    self.scenarios = sorted(self.replica.values(),
+                                            key=lambda scenario: (scenario['updated_at'], scenario['id']),
+                                            reverse=True)
+                    self.populate_scenarios_list()
+                    self.log_message(f"Synced {changed} changes, {len(self.scenarios)} scenarios available", "SUCCESS")
+                else:
+                    self.log_message("Scenarios are up to date", "INFO")
+                self.update_status("Ready")
+                return
+            
+            # Gửi ETag đã có để server trả 304 nếu danh sách chưa đổi
+            headers = {}
+            if self.scenarios_etag and self.scenarios_etag[0] == api_url:
+                headers['If-None-Match'] = self.scenarios_etag[1]
+            
+            # Danh sách chỉ gồm metadata, steps được tải khi chọn kịch bản
+            params = {'fields': self.SCENARIO_LIST_FIELDS, 'limit': self.SCENARIO_PAGE_SIZE}
+            response = requests.get(f"{api_url}/scenarios", params=params, headers=headers, timeout=10)
             
-            if response.status_code == 200:
+            if response.status_code == 304:
+                self.log_message("Scenarios are up to date", "INFO")
+                self.update_status("Ready")
+            elif response.status_code == 200:
                 self.scenarios = response.json()
+                etag = response.headers.get('ETag')
+                self.scenarios_etag = (api_url, etag) if etag else None
                 self.populate_scenarios_list()
+                
+                # Tải các trang tiếp theo, hiển thị ngay từng trang
+                next_cursor = response.headers.get('X-Next-Cursor')
+                while next_cursor:
+                    page = requests.get(f"{api_url}/scenarios", params={**params, 'cursor': next_cursor}, timeout=10)
+                    if page.status_code != 200:
+                        raise Exception(f"Server returned status code: {page.status_code}")
+                    
+                    start = len(self.scenarios)
+                    self.scenarios.extend(page.json())
+                    self.populate_scenarios_list(start)
+                    next_cursor = page.headers.get('X-Next-Cursor')
+                
                 self.log_message(f"Loaded {len(self.scenarios)} scenarios successfully", "SUCCESS")
                 self.update_status("Ready")
             else:
@@ -221,13 +361,123 @@ class AutomationApp:
             self.update_status("Error")
             messagebox.showerror("Error", error_msg)
     
-    def populate_scenarios_list(self):
-        """Điền danh sách kịch bản vào listbox"""
-        self.scenarios_listbox.delete(0, tk.END)
-        for scenario in self.scenarios:
+    def sync_scenarios(self, api_url):
+        """Cập nhật bản sao cục bộ qua change feed; trả về số thay đổi,
+        hoặc None nếu server chưa hỗ trợ /scenarios/changes"""
+        if self.replica_api_url != api_url:
+            self.replica = {}
+            self.replica_api_url = api_url
+            self.replica_revision = 0
+        
+        changed = 0
+        while True:
+            params = {
+                'since': self.replica_revision,
+                'fields': self.SCENARIO_LIST_FIELDS,
+                'limit': self.SCENARIO_PAGE_SIZE
+            }
+            response = requests.get(f"{api_url}/scenarios/changes", params=params, timeout=10)
+            if response.status_code == 404:
+                self.replica_api_url = None
+                return None
+            if response.status_code != 200:
+                raise Exception(f"Server returned status code: {response.status_code}")
+            
+            feed = response.json()
+            for change in feed['changes']:
+                if change['deleted']:
+                    self.replica.pop(change['id'], None)
+                else:
+                    self.replica[change['id']] = change
+            changed += len(feed['changes'])
+            self.replica_revision = feed['revision']
+            
+            if not feed['has_more']:
+                return changed
+    
+    def search_scenarios(self):
+        """Tìm kịch bản theo tên, mô tả và nội dung các bước"""
+        query = self.search_entry.get().strip()
+        if not query:
+            self.clear_search()
+            return
+        
+        try:
+            self.update_status("Searching...")
+            params = {'q': query, 'limit': self.SCENARIO_PAGE_SIZE}
+            response = requests.get(f"{self.get_api_url()}/scenarios/search", params=params, timeout=10)
+            if response.status_code != 200:
+                raise Exception(f"Server returned status code: {response.status_code}")
+            
+            self.scenarios = response.json()
+            # Danh sách đang là kết quả tìm kiếm, lần Refresh sau phải tải lại đầy đủ
+            self.scenarios_etag = None
+            self.showing_search_results = True
+            self.selected_scenario = None
+            self.populate_scenarios_list()
+            
+            self.log_message(f"Found {len(self.scenarios)} scenarios matching '{query}'", "INFO")
+            self.update_status("Ready")
+        except requests.exceptions.RequestException as e:
+            error_msg = f"Failed to connect to Flask API: {str(e)}"
+            self.log_message(error_msg, "ERROR")
+            self.update_status("Connection failed")
+            messagebox.showerror("Connection Error", error_msg)
+        except Exception as e:
+            error_msg = f"Error searching scenarios: {str(e)}"
+            self.log_message(error_msg, "ERROR")
+            self.update_status("Error")
+            messagebox.showerror("Error", error_msg)
+    
+    def clear_search(self):
+        """Xóa từ khóa và hiển thị lại toàn bộ danh sách"""
+        self.search_entry.delete(0, tk.END)
+        self.scenarios_etag = None
+        self.load_scenarios()
+    
+    def populate_scenarios_list(self, start=0):
+        """Điền danh sách kịch bản vào listbox (từ vị trí start trở đi)"""
+        if start == 0:
+            self.scenarios_listbox.delete(0, tk.END)
+        for scenario in self.scenarios[start:]:
             status = "🟢" if scenario.get('is_public', False) else "🔴"
-            workflow_type = self.get_workflow_type_indicator(scenario.get('steps', ''))
-            self.scenarios_listbox.insert(tk.END, f"{status} {workflow_type} {scenario['name']}")
+            if 'workflow_type' in scenario:
+                workflow_type = "🎨" if scenario['workflow_type'] == 'visual' else "📋"
+                self.scenarios_listbox.insert(tk.END, f"{status} {workflow_type} {scenario['name']}")
+            elif 'steps' in scenario:
+                workflow_type = self.get_workflow_type_indicator(scenario['steps'])
+                self.scenarios_listbox.insert(tk.END, f"{status} {workflow_type} {scenario['name']}")
+            else:
+                self.scenarios_listbox.insert(tk.END, f"{status} {scenario['name']}")
+    
+    def fetch_scenario_details(self, scenario):
+        """Tải đầy đủ steps của kịch bản nếu danh sách chỉ có metadata"""
+        if 'steps' in scenario:
+            return scenario
+        
+        response = requests.get(f"{self.get_api_url()}/scenarios/{scenario['id']}", timeout=10)
+        if response.status_code != 200:
+            raise Exception(f"Server returned status code: {response.status_code}")
+        
+        scenario.update(response.json())
+        return scenario
+    
+    def fetch_execution_plan(self, scenario):
+        """Tải execution plan server đã biên dịch sẵn; với server cũ thì tự biên dịch từ steps"""
+        response = requests.get(f"{self.get_api_url()}/scenarios/{scenario['id']}/plan", timeout=10)
+        if response.status_code == 200:
+            plan = response.json()
+            if plan.get('version') == PLAN_VERSION:
+                return plan
+        elif response.status_code != 404:
+            raise Exception(f"Server returned status code: {response.status_code}")
+        
+        # Server chưa có /plan hoặc plan khác phiên bản với runner này
+        self.fetch_scenario_details(scenario)
+        steps_data = scenario.get('steps', [])
+        if isinstance(steps_data, str):
+            steps_data = json.loads(steps_data)
+        return compile_workflow(steps_data)
     
     def get_workflow_type_indicator(self, steps_data):
         """Xác định loại workflow và trả về indicator"""
@@ -255,24 +505,23 @@ class AutomationApp:
         
         self.log_message(f"Selected scenario: {self.selected_scenario['name']}", "INFO")
         
-        # Parse workflow data
-        steps_data = self.selected_scenario.get('steps', [])
-        if isinstance(steps_data, str):
+        # Server đã tính sẵn metadata khi lưu, không cần tải và parse steps
+        if 'needs_upload' in self.selected_scenario and 'needs_download' in self.selected_scenario:
+            needs_upload = bool(self.selected_scenario['needs_upload'])
+            needs_download = bool(self.selected_scenario['needs_download'])
+        else:
+            # Server cũ: lấy yêu cầu cấu hình từ execution plan
             try:
-                steps_data = json.loads(steps_data)
+                plan = self.fetch_execution_plan(self.selected_scenario)
             except json.JSONDecodeError:
                 self.log_message("Invalid JSON in scenario steps", "ERROR")
                 return
-        
-        # Extract steps based on workflow type
-        if isinstance(steps_data, dict) and steps_data.get('workflow_type') == 'visual':
-            steps = self.convert_visual_to_linear(steps_data)
-        else:
-            steps = steps_data if isinstance(steps_data, list) else []
-        
-        # Check requirements
-        needs_upload = any(step.get('type') in ['upload'] for step in steps)
-        needs_download = any(step.get('type') in ['download'] for step in steps)
+            except Exception as e:
+                self.log_message(f"Failed to load scenario details: {str(e)}", "ERROR")
+                return
+            
+            needs_upload = plan['needs_upload']
+            needs_download = plan['needs_download']
         
         # Show/hide upload configuration
         if needs_upload:
@@ -306,80 +555,51 @@ class AutomationApp:
         # Enable buttons
         self.run_btn.config(state="normal")
     
-    def convert_visual_to_linear(self, visual_data):
-        """Chuyển đổi visual workflow thành linear steps để thực thi"""
-        if not visual_data.get('nodes') or not visual_data.get('connections'):
-            return []
-        
-        # Build execution order from visual workflow
-        nodes_dict = {node['id']: node for node in visual_data['nodes']}
-        connections = visual_data['connections']
-        
-        # Find start node
-        start_node_id = visual_data.get('startNode')
-        if not start_node_id:
-            # Fallback: find node marked as start
-            for node in visual_data['nodes']:
-                if node.get('isStart') or node.get('type') == 'start':
-                    start_node_id = node['id']
-                    break
-        
-        if not start_node_id:
-            self.log_message("No start node found in visual workflow", "ERROR")
-            return []
-        
-        # Traverse workflow to build execution sequence
-        execution_order = []
-        visited = set()
-        
-        def traverse(node_id, path=[]):
-            if node_id in visited or node_id in path:  # Prevent infinite loops
-                return
-            
-            visited.add(node_id)
-            current_path = path + [node_id]
-            
-            node = nodes_dict.get(node_id)
-            if not node or node.get('type') == 'start':
-                # Continue to next nodes
-                pass
-            else:
-                # Convert node to step
-                step = self.convert_node_to_step(node)
-                if step:
-                    execution_order.append(step)
-            
-            # Find next nodes (success connections have priority)
-            next_nodes = []
-            for conn in connections:
-                if conn['source'] == node_id:
-                    if conn['type'] == 'success':
-                        next_nodes.insert(0, conn['target'])  # Prioritize success paths
-                    else:
-                        next_nodes.append(conn['target'])
-            
-            # Continue traversal
-            for next_node_id in next_nodes:
-                traverse(next_node_id, current_path)
+    def start_run_report(self, steps_total):
+        """Báo server bắt đầu một run để lưu lịch sử và phát tiến độ trực tiếp; server cũ không hỗ trợ thì bỏ qua"""
+        self.run_report = None
+        api_url = self.get_api_url()
+        try:
+            response = requests.post(f"{api_url}/runs", json={
+                'scenario_id': self.selected_scenario['id'],
+                'steps_total': steps_total
+            }, timeout=10)
+        except requests.RequestException as e:
+            self.log_message(f"Run history disabled: {str(e)}", "WARNING")
+            return
         
-        traverse(start_node_id)
-        return execution_order
+        if response.status_code == 201:
+            run = response.json()
+            self.run_report = RunReporter(api_url, run['id'], run['ingest_token'], on_error=self.on_run_report_error)
     
-    def convert_node_to_step(self, node):
-        """Chuyển đổi node thành step format"""
-        node_type = node.get('type')
-        node_data = node.get('data', {})
-        
-        if not node_type or node_type == 'start':
-            return None
-        
-        # Convert based on node type
-        step = {
-            'type': node_type,
-            **node_data
-        }
-        
-        return step
+    def on_run_report_error(self, error):
+        """Không để việc ghi lịch sử làm hỏng lần chạy"""
+        self.run_report = None
+        self.log_message(f"Run history disabled: {str(error)}", "WARNING")
+    
+    def record_step_started(self, step_index, step):
+        """Báo bước bắt đầu chạy (chỉ để hiển thị trực tiếp, không lưu)"""
+        if self.run_report:
+            self.run_report.send('step-started', step_index=step_index, type=step.get('type') or 'unknown')
+    
+    def record_step_event(self, step_index, step, outcome, started_at, error=None):
+        """Ghi nhận kết quả một bước"""
+        if self.run_report:
+            self.run_report.send(
+                'step-finished',
+                step_index=step_index,
+                type=step.get('type') or 'unknown',
+                outcome=outcome,
+                duration_ms=(time.time() - started_at) * 1000,
+                error=error,
+                started_at=started_at
+            )
+    
+    def flush_run_report(self, status, error=None, steps_total=None):
+        """Gửi các event còn lại kèm trạng thái cuối của run"""
+        report, self.run_report = self.run_report, None
+        if report:
+            report.close(status, error, steps_total)
     
     def browse_upload_folder(self):
         """Chọn thư mục upload"""
@@ -395,36 +615,39 @@ class AutomationApp:
             self.download_path.set(folder)
             self.log_message(f"Download path set to: {folder}")
     
+    def build_chrome_options(self):
+        """Tùy chọn Chrome theo cấu hình hiện tại (headless, thư mục download)"""
+        chrome_options = Options()
+        
+        if not self.show_browser.get():
+            chrome_options.add_argument("--headless")
+            self.log_message("Running in headless mode")
+        else:
+            self.log_message("Running with visible browser")
+        
+        # Download preferences
+        if self.download_path.get():
+            prefs = {
+                "download.default_directory": self.download_path.get(),
+                "download.prompt_for_download": False,
+                "download.directory_upgrade": True,
+                "safebrowsing.enabled": True
+            }
+            chrome_options.add_experimental_option("prefs", prefs)
+        
+        # Additional options for stability
+        chrome_options.add_argument("--no-sandbox")
+        chrome_options.add_argument("--disable-dev-shm-usage")
+        chrome_options.add_argument("--disable-gpu")
+        chrome_options.add_argument("--window-size=1920,1080")
+        chrome_options.add_argument("--disable-web-security")
+        chrome_options.add_argument("--allow-running-insecure-content")
+        return chrome_options
+    
     def setup_webdriver(self):
         """Thiết lập WebDriver với cải tiến"""
         try:
-            chrome_options = Options()
-            
-            if not self.show_browser.get():
-                chrome_options.add_argument("--headless")
-                self.log_message("Running in headless mode")
-            else:
-                self.log_message("Running with visible browser")
-            
-            # Download preferences
-            if self.download_path.get():
-                prefs = {
-                    "download.default_directory": self.download_path.get(),
-                    "download.prompt_for_download": False,
-                    "download.directory_upgrade": True,
-                    "safebrowsing.enabled": True
-                }
-                chrome_options.add_experimental_option("prefs", prefs)
-            
-            # Additional options for stability
-            chrome_options.add_argument("--no-sandbox")
-            chrome_options.add_argument("--disable-dev-shm-usage")
-            chrome_options.add_argument("--disable-gpu")
-            chrome_options.add_argument("--window-size=1920,1080")
-            chrome_options.add_argument("--disable-web-security")
-            chrome_options.add_argument("--allow-running-insecure-content")
-            
-            self.driver = webdriver.Chrome(options=chrome_options)
+            self.driver = webdriver.Chrome(options=self.build_chrome_options())
             self.driver.implicitly_wait(10)
             
             # Initialize tab management
@@ -1130,22 +1353,11 @@ class AutomationApp:
         try:
             self.update_status("Setting up browser...")
             if not self.setup_webdriver():
+                self.flush_run_report('failed', "Failed to initialize WebDriver")
                 return
             
-            # Parse and prepare steps
-            steps_data = self.selected_scenario.get('steps', [])
-            if isinstance(steps_data, str):
-                try:
-                    steps_data = json.loads(steps_data)
-                except json.JSONDecodeError:
-                    raise Exception("Invalid JSON in scenario steps")
-            
-            # Convert visual workflow to linear if needed
-            if isinstance(steps_data, dict) and steps_data.get('workflow_type') == 'visual':
-                steps = self.convert_visual_to_linear(steps_data)
-                self.log_message("Converted visual workflow to execution steps", "INFO")
-            else:
-                steps = steps_data if isinstance(steps_data, list) else []
+            # Plan đã được tải và kiểm tra trong run_automation, steps đã theo thứ tự thực thi
+            steps = self.execution_plan['steps']
             
             if not steps:
                 raise Exception("No executable steps found in workflow")
@@ -1159,10 +1371,14 @@ class AutomationApp:
                     self.log_message("Automation stopped by user", "WARNING")
                     break
                 
+                step_started = time.time()
+                self.record_step_started(i - 1, step)
                 try:
                     success = self.execute_step(step)
                     if success:
                         successful_steps += 1
+                    outcome = 'succeeded' if success else ('skipped' if self.execution_stopped else 'failed')
+                    self.record_step_event(i - 1, step, outcome, step_started)
                     self.update_status(f"Running automation... ({i}/{total_steps})")
                     
                     # Small delay between steps for stability
@@ -1170,15 +1386,23 @@ class AutomationApp:
                     
                 except Exception as step_error:
                     self.log_message(f"Step {i} failed: {str(step_error)}", "ERROR")
+                    self.record_step_event(i - 1, step, 'failed', step_started, str(step_error))
                     # Continue with next step instead of stopping entire workflow
                     continue
             
-            if not self.execution_stopped:
+            if self.execution_stopped:
+                self.flush_run_report('cancelled', "Stopped by user", total_steps)
+            else:
                 self.log_message(f"Automation completed! {successful_steps}/{total_steps} steps successful", "SUCCESS")
                 self.update_status(f"Automation completed ({successful_steps}/{total_steps})")
+                if successful_steps == total_steps:
+                    self.flush_run_report('succeeded', None, total_steps)
+                else:
+                    self.flush_run_report('failed', f"{total_steps - successful_steps} of {total_steps} steps failed", total_steps)
             
         except Exception as e:
             error_msg = f"Automation failed: {str(e)}"
+            self.flush_run_report('failed', error_msg)
             self.log_message(error_msg, "ERROR")
             self.update_status("Automation failed")
             messagebox.showerror("Automation Error", error_msg)
@@ -1209,28 +1433,24 @@ class AutomationApp:
             messagebox.showwarning("No Selection", "Please select a scenario first")
             return
         
-        # Enhanced validation
-        steps_data = self.selected_scenario.get('steps', [])
-        if isinstance(steps_data, str):
-            try:
-                steps_data = json.loads(steps_data)
-            except json.JSONDecodeError:
-                messagebox.showerror("Invalid Data", "Selected scenario contains invalid JSON data")
-                return
-        
-        # Convert and validate steps
-        if isinstance(steps_data, dict) and steps_data.get('workflow_type') == 'visual':
-            steps = self.convert_visual_to_linear(steps_data)
-        else:
-            steps = steps_data if isinstance(steps_data, list) else []
+        # Plan chỉ được tải khi thực sự chạy
+        try:
+            plan = self.fetch_execution_plan(self.selected_scenario)
+        except json.JSONDecodeError:
+            messagebox.showerror("Invalid Data", "Selected scenario contains invalid JSON data")
+            return
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to load scenario details: {str(e)}")
+            return
         
+        steps = plan['steps']
         if not steps:
             messagebox.showwarning("Empty Workflow", "No executable steps found in the selected workflow")
             return
         
         # Check configuration requirements
-        needs_upload = any(step.get('type') == 'upload' for step in steps)
-        needs_download = any(step.get('type') == 'download' for step in steps)
+        needs_upload = plan['needs_upload']
+        needs_download = plan['needs_download']
         
         if needs_upload and not self.upload_folder.get():
             messagebox.showwarning("Configuration Error", "Please select an upload folder")
@@ -1256,6 +1476,10 @@ class AutomationApp:
         # Start automation in separate thread
         self.log_message(f"Starting automation: {self.selected_scenario['name']}", "INFO")
         self.log_message(f"Total steps to execute: {len(steps)}", "INFO")
+        for warning in plan['warnings']:
+            self.log_message(f"Workflow warning: {warning}", "WARNING")
+        self.execution_plan = plan
+        self.start_run_report(len(steps))
         
         automation_thread = threading.Thread(target=self.run_automation_thread)
         automation_thread.daemon = True
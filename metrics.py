@@ -0,0 +1,211 @@
+"""Metric trong bộ nhớ của process và định dạng text exposition của Prometheus.
+
+Chỉ gồm những gì server cần: histogram có label, counter và metric đọc giá trị
+lúc scrape (callback). Mỗi lần observe chỉ tốn một bisect và vài phép cộng
+dưới lock, không phụ thuộc Flask để worker.py cũng dùng được.
+
+Nhiều process (worker gunicorn) gộp qua snapshot(): mỗi process lưu giá trị của
+mình ở nơi dùng chung, process nhận scrape render() giá trị hiện tại cộng với
+snapshot của các process khác.
+"""
+
+import bisect
+import math
+import re
+import threading
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Giây: từ 0.1ms (truy vấn SQLite theo khóa chính) tới 10s (export, import)
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def format_labels(names, values, extra=None):
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def add_values(a, b):
+    if isinstance(a, list):
+        return [x + y for x, y in zip(a, b)]
+    return a + b
+
+class Metric:
+    """Phần chung: tên, mô tả, tên label và dòng HELP/TYPE"""
+    type = 'untyped'
+    
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+    
+    def header(self):
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+    
+    def render(self):
+        return self.format(self.labelnames, self.samples())
+    
+    def merge(self, processes):
+        """Gộp samples của nhiều process [(process, samples, live)] thành (tên label, samples).
+        Counter / histogram cộng dồn kể cả process đã dừng để tổng không giảm; gauge chỉ tính
+        các process còn chạy"""
+        merged = {}
+        for _, samples, live in processes:
+            if self.type == 'gauge' and not live:
+                continue
+            for labels, value in samples:
+                labels = tuple(labels)
+                merged[labels] = add_values(merged[labels], value) if labels in merged else value
+        return self.labelnames, sorted(merged.items())
+
+class Counter(Metric):
+    type = 'counter'
+    
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+    
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+    
+    def samples(self):
+        with self._lock:
+            return sorted(self._values.items())
+    
+    def format(self, labelnames, samples):
+        return self.header() + [
+            f'{self.name}{format_labels(labelnames, labels)} {format_value(value)}'
+            for labels, value in samples
+        ]
+
+class Histogram(Metric):
+    """Histogram có label; bucket lưu không cộng dồn, cộng dồn khi render"""
+    type = 'histogram'
+    
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # labels -> [count mỗi bucket..., count của +Inf, sum]
+    
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+    
+    def samples(self):
+        with self._lock:
+            return sorted((labels, list(values)) for labels, values in self._series.items())
+    
+    def format(self, labelnames, samples):
+        lines = self.header()
+        for labels, values in samples:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), values):
+                cumulative += count
+                le = f'le="{format_value(float(bound))}"'
+                lines.append(f'{self.name}_bucket{format_labels(labelnames, labels, le)} {cumulative}')
+            label_text = format_labels(labelnames, labels)
+            lines.append(f'{self.name}_sum{label_text} {format_value(values[-1])}')
+            lines.append(f'{self.name}_count{label_text} {cumulative}')
+        return lines
+
+class CallbackMetric(Metric):
+    """Gauge hoặc counter đọc từ nơi khác lúc scrape; collect() trả về [(labels, value)].
+    per_process: giá trị không cộng được giữa các process (tỉ lệ, thời điểm) được gộp
+    thành một series cho mỗi process với label process"""
+    
+    def __init__(self, name, documentation, collect, labelnames=(), type='gauge', per_process=False):
+        super().__init__(name, documentation, labelnames)
+        self.type = type
+        self.collect = collect
+        self.per_process = per_process
+    
+    def samples(self):
+        return list(self.collect())
+    
+    def merge(self, processes):
+        if not self.per_process:
+            return super().merge(processes)
+        return self.labelnames + ('process',), sorted(
+            (tuple(labels) + (process,), value)
+            for process, samples, live in processes if live for labels, value in samples
+        )
+    
+    def format(self, labelnames, samples):
+        return self.header() + [
+            f'{self.name}{format_labels(labelnames, labels)} {format_value(value)}'
+            for labels, value in samples
+        ]
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+    
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+    
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+    
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+    
+    def callback(self, name, documentation, collect, labelnames=(), type='gauge', per_process=False):
+        return self.register(CallbackMetric(name, documentation, collect, labelnames, type, per_process))
+    
+    def snapshot(self):
+        """Giá trị hiện tại của mọi metric, dạng ghi được bằng JSON để process khác gộp lúc scrape"""
+        return {metric.name: [[list(labels), value] for labels, value in metric.samples()]
+                for metric in self._metrics}
+    
+    def render(self, others=(), process=''):
+        """Text exposition; others là snapshot của các process khác [(process, snapshot, live)],
+        gộp cùng giá trị hiện tại của process này (tên là process)"""
+        lines = []
+        for metric in self._metrics:
+            if others:
+                processes = [(process, metric.samples(), True)] + [
+                    (process, snapshot.get(metric.name, ()), live) for process, snapshot, live in others
+                ]
+                lines.extend(metric.format(*metric.merge(processes)))
+            else:
+                lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+SQL_STRING = re.compile(r"'(?:[^']|'')*'")
+SQL_COMMENT = re.compile(r'--[^\n]*|/\*.*?\*/', re.DOTALL)
+SQL_VERB = re.compile(r'\s*(\w+)')
+SQL_TABLE = re.compile(r'\b(?:FROM|INTO|UPDATE)\s+["`\[]?(\w+)', re.IGNORECASE)
+# Chỉ các câu đọc / ghi dữ liệu có label; DDL, PRAGMA và lệnh transaction (migration,
+# pragma của từng kết nối, BEGIN / COMMIT) không được đo
+SQL_DATA_VERBS = frozenset(('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE', 'WITH'))
+
+def sql_fingerprint(sql):
+    """Label của câu SQL: động từ đầu câu và bảng chính (vd. 'SELECT automation_scenarios'),
+    không phụ thuộc danh sách cột hay điều kiện nên số label bị chặn theo số bảng.
+    None với câu không đọc / ghi dữ liệu"""
+    text = SQL_COMMENT.sub(' ', SQL_STRING.sub('?', sql))
+    match = SQL_VERB.match(text)
+    verb = match.group(1).upper() if match else ''
+    if verb not in SQL_DATA_VERBS:
+        return None
+    table = SQL_TABLE.search(text)
+    return f'{verb} {table.group(1)}' if table else verb
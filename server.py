@@ -1,23 +1,188 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for, session, flash
+from flask import Flask, render_template, request, jsonify, redirect, url_for, session, flash, g, stream_with_context, send_file, has_request_context
 import sqlite3
 import json
 import os
-from datetime import datetime
+import queue
+import threading
+import base64
+import zlib
+import re
+import struct
+import gzip
+import io
+import hashlib
+import hmac
+import ipaddress
+import math
+import socket
+import sys
+import time
+from datetime import datetime, timezone
+from urllib.parse import urlsplit
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
+from werkzeug.exceptions import HTTPException
 import uuid
+import copy
+from collections import OrderedDict, Counter, deque
+from flask.json.provider import DefaultJSONProvider
+from workflow import compile_workflow, PLAN_VERSION
+import metrics
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 app = Flask(__name__)
-app.secret_key = 'your-secret-key-change-this-in-production'
+app.config['SECRET_KEY_FILE'] = 'secret_key'  # Khóa ký session được tạo ngẫu nhiên ở đây nếu không đặt biến môi trường SECRET_KEY
+app.config['SCENARIO_CACHE_SYNC'] = False  # Nhiều process dùng chung database: đồng bộ cache scenario theo change feed
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+app.config['DATABASE'] = 'data.db'
+app.config['DB_POOL_SIZE'] = 8  # Số kết nối SQLite giữ sẵn trong pool
+app.config['DB_BUSY_TIMEOUT'] = 5.0  # Giây chờ khi database đang bị khóa ghi
+app.config['SCENARIO_CACHE_MAX_BYTES'] = 64 * 1024 * 1024  # Giới hạn bộ nhớ cho cache scenario
+app.config['ROLE_CACHE_TTL'] = 60  # Giây giữ role trong session trước khi kiểm tra lại
+app.config['PAGE_SIZE'] = 50  # Số scenario mỗi trang trên /automation và /admin
+app.config['STEPS_COMPRESSION_LEVEL'] = 6  # Mức nén zlib cho cột steps
+app.config['STEPS_DICTIONARY_SIZE'] = 32 * 1024  # Kích thước dictionary nén dùng chung, 0 để tắt
+# Hai giá trị sau được ghi vào app_meta khi khởi động, mọi process ghi vào database dùng chung
+app.config['SCENARIO_REVISION_LIMIT'] = 100  # Số revision tối đa giữ lại cho mỗi scenario (tối thiểu 1)
+app.config['SCENARIO_REVISION_WINDOW'] = 300  # Giây: các lần lưu liên tiếp của cùng một người trong một khung gộp thành một revision, 0 để tắt
+app.config['STEP_BLOB_GC_INTERVAL'] = 3600  # Giây giữa hai lần dọn blob steps không còn revision tham chiếu
+app.config['COMPRESS_MIN_SIZE'] = 1024  # Chỉ nén response API lớn hơn số byte này
+app.config['COMPRESS_GZIP_LEVEL'] = 6
+app.config['COMPRESS_BROTLI_QUALITY'] = 5
+app.config['EXPORT_BATCH_SIZE'] = 500  # Số dòng đọc mỗi lần khi export
+app.config['IMPORT_BATCH_SIZE'] = 1000  # Số scenario mỗi transaction khi import
+app.config['IMPORT_MAX_CONTENT_LENGTH'] = 2 * 1024 * 1024 * 1024  # Giới hạn body của /api/scenarios/import
+app.config['IMPORT_MAX_ERRORS'] = 1000  # Số lỗi tối đa liệt kê trong kết quả import
+app.config['UPLOAD_REF_TTL'] = 7 * 24 * 3600  # Giây một file upload được giữ kể từ lần upload cuối
+app.config['UPLOAD_BLOB_TTL'] = 24 * 3600  # Giây giữ blob không còn tham chiếu trước khi xóa
+app.config['UPLOAD_GC_INTERVAL'] = 3600  # Giây giữa hai lần dọn blob
+app.config['RUN_DEFAULT_DEADLINE'] = 15 * 60  # Giây tối đa cho một run nếu client không chỉ định
+app.config['RUN_MAX_DEADLINE'] = 2 * 3600
+app.config['RUN_MAX_QUEUED_PER_USER'] = 500  # Số run đang chờ tối đa của một user
+app.config['RUN_LEASE_SECONDS'] = 60  # Worker phải gia hạn trong khoảng này, quá hạn thì run được trả lại hàng đợi
+app.config['RUN_MAX_ATTEMPTS'] = 2  # Số lần nhận run tối đa (tính cả lần worker chết giữa chừng)
+app.config['RUN_WORKER_CONCURRENCY'] = 2  # Số trình duyệt headless chạy song song trong một worker.py
+app.config['RUN_POLL_INTERVAL'] = 1.0  # Giây giữa hai lần worker rảnh kiểm tra hàng đợi
+app.config['RUN_DRAIN_TIMEOUT'] = 120  # Giây chờ các run đang chạy khi worker dừng
+app.config['RUN_WORKSPACE_FOLDER'] = 'runs'  # Thư mục làm việc (upload / download / screenshot) của từng run
+app.config['RUN_ALLOW_PRIVATE_URLS'] = False  # Cho run trên server mở file:, localhost và địa chỉ nội bộ (chỉ bật khi mọi user đều tin cậy)
+app.config['RUN_REPORT_TIMEOUT'] = 15 * 60  # Run desktop không gửi event quá số giây này bị coi là thất bại
+app.config['RUN_MAX_OPEN_DESKTOP_PER_CLIENT'] = 20  # Số run desktop đang chạy tối đa của một user (hoặc một địa chỉ IP nếu chưa đăng nhập)
+app.config['RUN_EVENT_MAX_BATCH'] = 1000  # Số step event tối đa trong một request
+app.config['RUN_EVENT_GROUP_SIZE'] = 5000  # Số step event tối đa gom vào một transaction
+app.config['RUN_LATENCY_MAX_DAYS'] = 90  # Khoảng thời gian tối đa của truy vấn p50/p95
+app.config['RUN_EVENT_HISTORY'] = 1000  # Số event bị lỡ tối đa gửi lại khi client nối lại bằng Last-Event-ID
+app.config['RUN_EVENT_SUBSCRIBER_BUFFER'] = 256  # Event chờ gửi tối đa mỗi kết nối SSE, đầy thì ngắt để client nối lại
+app.config['RUN_EVENT_RETENTION'] = 3 * 3600  # Giây giữ event trong run_event_log (dài hơn RUN_MAX_DEADLINE)
+app.config['RUN_EVENT_POLL_INTERVAL'] = 0.25  # Giây giữa hai lần đọc event do process khác ghi
+app.config['RUN_EVENT_KEEPALIVE'] = 15  # Giây giữa hai comment giữ kết nối SSE
+app.config['METRICS_ENABLED'] = True  # Đo thời gian request / SQL / JSON cho /metrics
+app.config['METRICS_TOKEN'] = None  # Nếu đặt, /metrics yêu cầu header Authorization: Bearer <token>
+app.config['METRICS_MAX_STATEMENTS'] = 500  # Số label (động từ + bảng) tối đa có series riêng
+app.config['METRICS_SHARED'] = False  # Nhiều process dùng chung database: /metrics gộp metric của mọi process qua metric_snapshots
+app.config['METRICS_PUBLISH_INTERVAL'] = 10  # Giây giữa hai lần mỗi process ghi snapshot metric của mình
+
+# Metric của process, xuất ở /metrics
+app_metrics = metrics.Registry()
+REQUEST_SECONDS = app_metrics.histogram(
+    'http_request_duration_seconds', 'Time to produce the response (body of streamed responses excluded)',
+    ('method', 'route', 'status')
+)
+SQL_SECONDS = app_metrics.histogram(
+    'sqlite_statement_duration_seconds', 'Time spent in execute() (first step) per statement verb and table',
+    ('statement',)
+)
+SQL_ERRORS = app_metrics.counter('sqlite_statement_errors_total', 'Statements that raised', ('statement',))
+JSON_SECONDS = app_metrics.histogram(
+    'json_codec_duration_seconds', 'JSON encode/decode time, steps codec includes zlib', ('operation',)
+)
+
+class InstrumentedJSONProvider(DefaultJSONProvider):
+    """JSON provider của Flask có đo thời gian (jsonify, request.get_json, app.json.dumps)"""
+    
+    def dumps(self, obj, **kwargs):
+        started = time.perf_counter()
+        try:
+            return super().dumps(obj, **kwargs)
+        finally:
+            JSON_SECONDS.observe(time.perf_counter() - started, 'dumps')
+    
+    def loads(self, s, **kwargs):
+        started = time.perf_counter()
+        try:
+            return super().loads(s, **kwargs)
+        finally:
+            JSON_SECONDS.observe(time.perf_counter() - started, 'loads')
+
+app.json = InstrumentedJSONProvider(app)
+
+def observe_json(operation):
+    """Decorator đo thời gian của một hàm encode/decode vào json_codec_duration_seconds"""
+    def decorator(f):
+        def decorated_function(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                JSON_SECONDS.observe(time.perf_counter() - started, operation)
+        decorated_function.__name__ = f.__name__
+        decorated_function.__doc__ = f.__doc__
+        return decorated_function
+    return decorator
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    """Đăng ký trước compress_api_response nên chạy sau nó: thời gian nén được tính vào request"""
+    started = g.pop('request_started', None)
+    if started is not None and app.config['METRICS_ENABLED']:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        REQUEST_SECONDS.observe(time.perf_counter() - started, request.method, route, response.status_code)
+        if app.config['METRICS_SHARED']:
+            get_metrics_publisher()
+    return response
 
-# Tạo thư mục uploads nếu chưa tồn tại
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+def load_secret_key(path):
+    """Khóa ký session: biến môi trường SECRET_KEY, nếu không có thì đọc hoặc tạo file khóa.
+    Mọi worker phải dùng cùng một khóa, nên file được tạo nguyên tử (link thay vì ghi trực tiếp)"""
+    key = os.environ.get('SECRET_KEY')
+    if key:
+        return key
+    if not os.path.exists(path):
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(uuid.uuid4().hex + uuid.uuid4().hex)
+        try:
+            os.link(temp_path, path)
+        except FileExistsError:
+            pass  # Process khác vừa tạo trước
+        finally:
+            os.unlink(temp_path)
+    with open(path) as f:
+        return f.read().strip()
+
+app.secret_key = load_secret_key(app.config['SECRET_KEY_FILE'])
+
+def ensure_upload_folders():
+    """Tạo thư mục uploads nếu chưa tồn tại"""
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], 'blobs'), exist_ok=True)
+    os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], 'tmp'), exist_ok=True)
+
+ensure_upload_folders()
 
 def init_database():
     """Khởi tạo database và các bảng cần thiết"""
-    conn = sqlite3.connect('data.db')
+    conn = open_db_connection()
     cursor = conn.cursor()
     
     # Bảng users
@@ -69,14 +234,1339 @@ def init_database():
         ''', ('demo', demo_password, 'user'))
     
     conn.commit()
+    
+    # Nâng cấp schema lên phiên bản mới nhất
+    migrate_database(conn)
+    store_revision_settings(conn)
+    
+    # Train dictionary nén khi đã có đủ workflow mẫu
+    ensure_steps_dictionary(conn)
+    
+    # Biên dịch lại plan được tạo bởi phiên bản trình biên dịch cũ
+    refresh_execution_plans(conn)
+    
+    collect_upload_garbage(conn)
+    collect_step_blobs(conn)
+    
+    for name, detail in audit_query_plans(conn):
+        app.logger.warning("Query '%s' is not index-backed: %s", name, detail)
+    
     conn.close()
 
-def get_db_connection():
-    """Tạo kết nối database"""
-    conn = sqlite3.connect('data.db')
+def _column_exists(cursor, table, column):
+    """Kiểm tra cột đã tồn tại trong bảng chưa"""
+    return any(row[1] == column for row in cursor.execute(f'PRAGMA table_info({table})').fetchall())
+
+def _migration_scenario_revisions(cursor):
+    """v1: Revision cho từng scenario và version của cả catalogue"""
+    if not _column_exists(cursor, 'automation_scenarios', 'revision'):
+        cursor.execute('ALTER TABLE automation_scenarios ADD COLUMN revision INTEGER NOT NULL DEFAULT 0')
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS app_meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )
+    ''')
+    
+    # Đánh số revision cho các scenario có sẵn theo thứ tự id
+    cursor.execute('''
+        UPDATE automation_scenarios
+        SET revision = (SELECT COUNT(*) FROM automation_scenarios s2 WHERE s2.id <= automation_scenarios.id)
+    ''')
+    cursor.execute('''
+        INSERT OR REPLACE INTO app_meta (key, value)
+        SELECT 'scenarios_version', COALESCE(MAX(revision), 0) FROM automation_scenarios
+    ''')
+    cursor.execute('''
+        INSERT OR REPLACE INTO app_meta (key, value)
+        VALUES ('scenarios_modified_at', CAST(strftime('%s', 'now') AS INTEGER))
+    ''')
+    
+    # Mỗi lần ghi tăng version của catalogue và gán version mới làm revision của dòng
+    bump_version = '''
+            UPDATE app_meta SET value = value + 1 WHERE key = 'scenarios_version';
+            UPDATE app_meta SET value = CAST(strftime('%s', 'now') AS INTEGER) WHERE key = 'scenarios_modified_at';
+    '''
+    stamp_row = '''
+            UPDATE automation_scenarios
+            SET revision = (SELECT value FROM app_meta WHERE key = 'scenarios_version')
+            WHERE id = NEW.id;
+    '''
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS scenarios_revision_insert
+        AFTER INSERT ON automation_scenarios
+        BEGIN
+            {bump_version}
+            {stamp_row}
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS scenarios_revision_update
+        AFTER UPDATE ON automation_scenarios
+        WHEN NEW.revision = OLD.revision
+        BEGIN
+            {bump_version}
+            {stamp_row}
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS scenarios_revision_delete
+        AFTER DELETE ON automation_scenarios
+        BEGIN
+            {bump_version}
+        END
+    ''')
+
+def _migration_listing_indexes(cursor):
+    """v2: Index cho các truy vấn danh sách (lọc is_public / created_by, sắp theo updated_at)"""
+    # WHERE is_public = 1 ORDER BY updated_at DESC, id DESC (+ keyset cursor)
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_scenarios_public_updated
+        ON automation_scenarios (is_public, updated_at, id)
+    ''')
+    # ORDER BY updated_at DESC cho admin; chứa is_public, created_by để lọc
+    # "is_public = 1 OR created_by = ?" ngay trên index
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_scenarios_updated
+        ON automation_scenarios (updated_at, id, is_public, created_by)
+    ''')
+
+# Nhóm histogram số bước: (nhãn, số bước tối đa); nhóm cuối không giới hạn
+STEP_COUNT_BUCKETS = (
+    ('0', 0),
+    ('1-5', 5),
+    ('6-10', 10),
+    ('11-25', 25),
+    ('26-50', 50),
+    ('51-100', 100),
+    ('101+', None),
+)
+
+def _step_bucket_sql(expression):
+    """Biểu thức SQL chuyển số bước thành nhãn nhóm histogram"""
+    cases = ' '.join(
+        f"WHEN {expression} <= {upper} THEN '{label}'"
+        for label, upper in STEP_COUNT_BUCKETS if upper is not None
+    )
+    return f"CASE {cases} ELSE '{STEP_COUNT_BUCKETS[-1][0]}' END"
+
+def _migration_scenario_stats(cursor):
+    """v3: Bảng thống kê cho trang admin, cập nhật bằng trigger"""
+    if not _column_exists(cursor, 'automation_scenarios', 'node_count'):
+        cursor.execute('ALTER TABLE automation_scenarios ADD COLUMN node_count INTEGER NOT NULL DEFAULT 0')
+    
+    # Tính số bước cho các scenario có sẵn
+    for row in cursor.execute('SELECT id, steps FROM automation_scenarios').fetchall():
+        try:
+            node_count = count_workflow_steps(json.loads(row[1]) if row[1] else [])
+        except ValueError:
+            node_count = 0
+        cursor.execute('UPDATE automation_scenarios SET node_count = ? WHERE id = ?', (node_count, row[0]))
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS scenario_stats (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_scenario_stats (
+            user_id INTEGER PRIMARY KEY,
+            total INTEGER NOT NULL DEFAULT 0,
+            public INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS step_count_histogram (
+            bucket TEXT PRIMARY KEY,
+            scenarios INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    
+    # Giá trị ban đầu từ dữ liệu hiện có
+    cursor.execute('''
+        INSERT OR REPLACE INTO scenario_stats (name, value)
+        SELECT 'total_scenarios', COUNT(*) FROM automation_scenarios
+        UNION ALL SELECT 'public_scenarios', COUNT(*) FROM automation_scenarios WHERE is_public = 1
+        UNION ALL SELECT 'total_users', COUNT(*) FROM users
+    ''')
+    cursor.execute('''
+        INSERT OR REPLACE INTO user_scenario_stats (user_id, total, public)
+        SELECT created_by, COUNT(*), SUM(is_public = 1)
+        FROM automation_scenarios
+        WHERE created_by IS NOT NULL
+        GROUP BY created_by
+    ''')
+    cursor.execute('''
+        INSERT OR REPLACE INTO step_count_histogram (bucket, scenarios)
+        SELECT bucket, COUNT(*) FROM (
+            SELECT ''' + _step_bucket_sql('node_count') + ''' AS bucket FROM automation_scenarios
+        )
+        GROUP BY bucket
+    ''')
+    
+    def add_scenario(row, sign):
+        # Cộng (sign = +1) hoặc trừ (sign = -1) một scenario vào các bảng thống kê
+        return f'''
+            UPDATE scenario_stats SET value = value + {sign} WHERE name = 'total_scenarios';
+            UPDATE scenario_stats SET value = value + {sign} * ({row}.is_public = 1) WHERE name = 'public_scenarios';
+            INSERT INTO user_scenario_stats (user_id, total, public)
+            SELECT {row}.created_by, {sign}, {sign} * ({row}.is_public = 1) WHERE {row}.created_by IS NOT NULL
+            ON CONFLICT(user_id) DO UPDATE SET total = total + excluded.total, public = public + excluded.public;
+            INSERT INTO step_count_histogram (bucket, scenarios)
+            VALUES ({_step_bucket_sql(f'{row}.node_count')}, {sign})
+            ON CONFLICT(bucket) DO UPDATE SET scenarios = scenarios + excluded.scenarios;
+        '''
+    
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS scenario_stats_insert
+        AFTER INSERT ON automation_scenarios
+        BEGIN
+            {add_scenario('NEW', 1)}
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS scenario_stats_delete
+        AFTER DELETE ON automation_scenarios
+        BEGIN
+            {add_scenario('OLD', -1)}
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS scenario_stats_update
+        AFTER UPDATE OF is_public, created_by, node_count ON automation_scenarios
+        BEGIN
+            {add_scenario('OLD', -1)}
+            {add_scenario('NEW', 1)}
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS user_stats_insert
+        AFTER INSERT ON users
+        BEGIN
+            UPDATE scenario_stats SET value = value + 1 WHERE name = 'total_users';
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS user_stats_delete
+        AFTER DELETE ON users
+        BEGIN
+            UPDATE scenario_stats SET value = value - 1 WHERE name = 'total_users';
+        END
+    ''')
+
+def _migration_workflow_metadata(cursor):
+    """v4: Cột metadata suy ra từ steps để danh sách không cần parse workflow"""
+    metadata_columns = {
+        'workflow_type': "TEXT NOT NULL DEFAULT 'linear'",
+        'needs_upload': 'INTEGER NOT NULL DEFAULT 0',
+        'needs_download': 'INTEGER NOT NULL DEFAULT 0',
+        'uses_tabs': 'INTEGER NOT NULL DEFAULT 0',
+    }
+    for column, definition in metadata_columns.items():
+        if not _column_exists(cursor, 'automation_scenarios', column):
+            cursor.execute(f'ALTER TABLE automation_scenarios ADD COLUMN {column} {definition}')
+    
+    for row in cursor.execute('SELECT id, steps FROM automation_scenarios').fetchall():
+        try:
+            metadata = derive_workflow_metadata(json.loads(row[1]) if row[1] else [])
+        except ValueError:
+            metadata = derive_workflow_metadata([])
+        metadata.pop('node_count')
+        cursor.execute(f'''
+            UPDATE automation_scenarios
+            SET {', '.join(f'{column} = ?' for column in metadata)}
+            WHERE id = ?
+        ''', [*metadata.values(), row[0]])
+    
+    # Lọc danh sách công khai theo loại workflow
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_scenarios_public_type_updated
+        ON automation_scenarios (is_public, workflow_type, updated_at, id)
+    ''')
+
+def _migration_compress_steps(cursor):
+    """v5: Nén cột steps (zlib, có thể kèm dictionary dùng chung)"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS steps_dictionaries (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            dictionary BLOB NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    train_steps_dictionary(cursor)
+    
+    size_before = size_after = 0
+    for row in cursor.execute('SELECT id, steps FROM automation_scenarios').fetchall():
+        if not isinstance(row[1], str):
+            continue
+        try:
+            steps = json.loads(row[1]) if row[1] else []
+        except ValueError:
+            continue
+        encoded = encode_steps(steps, cursor.connection)
+        size_before += len(row[1].encode('utf-8'))
+        size_after += len(encoded)
+        cursor.execute('UPDATE automation_scenarios SET steps = ? WHERE id = ?', (encoded, row[0]))
+    
+    if size_before:
+        print(f"Compressed scenario steps: {size_before} -> {size_after} bytes "
+              f"({100 - size_after * 100 // size_before}% smaller, run VACUUM to reclaim space)")
+
+def _migration_scenario_search(cursor):
+    """v6: Chỉ mục FTS5 trên name, description và nội dung các bước"""
+    # Contentless: chỉ lưu chỉ mục, dữ liệu gốc vẫn nằm ở automation_scenarios.
+    # steps_text() / search_fold() là hàm SQL được đăng ký trên mọi kết nối (xem open_db_connection)
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS scenarios_fts USING fts5(
+            name, description, steps,
+            content = '',
+            tokenize = 'unicode61 remove_diacritics 2'
+        )
+    ''')
+    # Khớp ở tên quan trọng hơn mô tả, mô tả quan trọng hơn nội dung bước
+    cursor.execute("INSERT INTO scenarios_fts (scenarios_fts, rank) VALUES ('rank', 'bm25(10.0, 4.0, 1.0)')")
+    cursor.execute('''
+        INSERT INTO scenarios_fts (rowid, name, description, steps)
+        SELECT id, search_fold(name), search_fold(description), steps_text(steps) FROM automation_scenarios
+    ''')
+    
+    # Bảng contentless cần đúng giá trị cũ để xóa khỏi chỉ mục
+    index_row = '''
+            INSERT INTO scenarios_fts (rowid, name, description, steps)
+            VALUES (NEW.id, search_fold(NEW.name), search_fold(NEW.description), steps_text(NEW.steps));
+    '''
+    unindex_row = '''
+            INSERT INTO scenarios_fts (scenarios_fts, rowid, name, description, steps)
+            VALUES ('delete', OLD.id, search_fold(OLD.name), search_fold(OLD.description), steps_text(OLD.steps));
+    '''
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS scenarios_fts_insert
+        AFTER INSERT ON automation_scenarios
+        BEGIN
+            {index_row}
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS scenarios_fts_update
+        AFTER UPDATE OF name, description, steps ON automation_scenarios
+        BEGIN
+            {unindex_row}
+            {index_row}
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS scenarios_fts_delete
+        AFTER DELETE ON automation_scenarios
+        BEGIN
+            {unindex_row}
+        END
+    ''')
+
+def _migration_change_feed(cursor):
+    """v7: Tombstone cho scenario đã xóa và index theo revision cho change feed"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS scenario_tombstones (
+            scenario_id INTEGER PRIMARY KEY,
+            revision INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_tombstones_revision ON scenario_tombstones (revision)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_scenarios_revision ON automation_scenarios (revision)')
+    
+    # Xóa cũng được đánh revision: ghi tombstone ngay sau khi tăng version
+    cursor.execute('DROP TRIGGER IF EXISTS scenarios_revision_delete')
+    cursor.execute('''
+        CREATE TRIGGER scenarios_revision_delete
+        AFTER DELETE ON automation_scenarios
+        BEGIN
+            UPDATE app_meta SET value = value + 1 WHERE key = 'scenarios_version';
+            UPDATE app_meta SET value = CAST(strftime('%s', 'now') AS INTEGER) WHERE key = 'scenarios_modified_at';
+            INSERT OR REPLACE INTO scenario_tombstones (scenario_id, revision)
+            SELECT OLD.id, value FROM app_meta WHERE key = 'scenarios_version';
+        END
+    ''')
+
+def _migration_upload_store(cursor):
+    """v8: Kho upload theo nội dung (SHA-256) có đếm tham chiếu"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS upload_blobs (
+            sha256 TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            refcount INTEGER NOT NULL DEFAULT 0,
+            unreferenced_since REAL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS upload_refs (
+            id TEXT PRIMARY KEY,
+            sha256 TEXT NOT NULL REFERENCES upload_blobs (sha256),
+            user_id INTEGER NOT NULL,
+            original_filename TEXT NOT NULL,
+            expires_at REAL NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_upload_refs_owner
+        ON upload_refs (user_id, sha256, original_filename)
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_upload_refs_expires ON upload_refs (expires_at)')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_upload_blobs_unreferenced
+        ON upload_blobs (unreferenced_since) WHERE refcount = 0
+    ''')
+    
+    # refcount = số upload_refs trỏ tới blob; khi về 0 thì bắt đầu tính TTL
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS upload_refs_insert
+        AFTER INSERT ON upload_refs
+        BEGIN
+            UPDATE upload_blobs SET refcount = refcount + 1, unreferenced_since = NULL
+            WHERE sha256 = NEW.sha256;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS upload_refs_delete
+        AFTER DELETE ON upload_refs
+        BEGIN
+            UPDATE upload_blobs SET refcount = refcount - 1,
+                unreferenced_since = CASE WHEN refcount = 1 THEN CAST(strftime('%s', 'now') AS REAL) END
+            WHERE sha256 = OLD.sha256;
+        END
+    ''')
+
+def _migration_execution_plans(cursor):
+    """v9: Execution plan đã biên dịch (gzip) và phiên bản của trình biên dịch đã tạo ra nó"""
+    if not _column_exists(cursor, 'automation_scenarios', 'plan'):
+        cursor.execute('ALTER TABLE automation_scenarios ADD COLUMN plan BLOB')
+    if not _column_exists(cursor, 'automation_scenarios', 'plan_version'):
+        cursor.execute('ALTER TABLE automation_scenarios ADD COLUMN plan_version INTEGER')
+    # Plan cho các dòng có sẵn được refresh_execution_plans() tạo khi khởi động
+
+def _migration_run_queue(cursor):
+    """v10: Hàng đợi run thực thi trên server"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            scenario_id INTEGER NOT NULL,
+            scenario_revision INTEGER,
+            requested_by INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            deadline_seconds INTEGER NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            worker_id TEXT,
+            lease_expires_at REAL,
+            cancel_requested INTEGER NOT NULL DEFAULT 0,
+            steps_total INTEGER,
+            steps_succeeded INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            created_at REAL NOT NULL,
+            started_at REAL,
+            finished_at REAL
+        )
+    ''')
+    _create_run_indexes(cursor)
+
+def _create_run_indexes(cursor):
+    """Index của bảng runs (dùng chung cho v10 và lần tạo lại bảng ở v11)"""
+    # Worker lấy run cũ nhất đang chờ; index chỉ chứa các dòng đang chờ nên luôn nhỏ
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_runs_queued ON runs (id) WHERE status = 'queued'")
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_runs_running
+        ON runs (lease_expires_at) WHERE status = 'running'
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_runs_requested_by ON runs (requested_by, status)')
+
+def _migration_run_history(cursor):
+    """v11: Run từ runner desktop, lịch sử từng bước và histogram độ trễ theo ngày"""
+    # Tạo lại runs để requested_by cho phép NULL (runner desktop không đăng nhập)
+    columns = ', '.join(row[1] for row in cursor.execute('PRAGMA table_info(runs)').fetchall())
+    cursor.execute('ALTER TABLE runs RENAME TO runs_v10')
+    cursor.execute('''
+        CREATE TABLE runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            scenario_id INTEGER NOT NULL,
+            scenario_revision INTEGER,
+            requested_by INTEGER,
+            source TEXT NOT NULL DEFAULT 'server',
+            ingest_token TEXT,
+            status TEXT NOT NULL DEFAULT 'queued',
+            deadline_seconds INTEGER NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            worker_id TEXT,
+            lease_expires_at REAL,
+            cancel_requested INTEGER NOT NULL DEFAULT 0,
+            steps_total INTEGER,
+            steps_succeeded INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            created_at REAL NOT NULL,
+            started_at REAL,
+            finished_at REAL
+        )
+    ''')
+    cursor.execute(f'INSERT INTO runs ({columns}) SELECT {columns} FROM runs_v10')
+    cursor.execute('DROP TABLE runs_v10')
+    _create_run_indexes(cursor)
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_runs_scenario ON runs (scenario_id, id)')
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS run_steps (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            run_id INTEGER NOT NULL,
+            step_index INTEGER NOT NULL,
+            step_type TEXT NOT NULL,
+            node_id TEXT,
+            outcome TEXT NOT NULL,
+            duration_ms REAL NOT NULL,
+            error TEXT,
+            started_at REAL NOT NULL
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_run_steps_run ON run_steps (run_id, step_index)')
+    
+    # Số bước theo (scenario, loại bước, ngày, bucket độ trễ): p50/p95 chỉ cần đọc vài chục dòng
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS step_latency_histogram (
+            scenario_id INTEGER NOT NULL,
+            step_type TEXT NOT NULL,
+            day INTEGER NOT NULL,
+            bucket INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (scenario_id, step_type, day, bucket)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_step_latency_type_day
+        ON step_latency_histogram (step_type, day)
+    ''')
+
+def _migration_run_event_log(cursor):
+    """v12: Event trực tiếp của run dùng chung giữa các process phục vụ SSE.
+    AUTOINCREMENT để id không bị dùng lại sau khi dọn, id là Last-Event-ID của client"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS run_event_log (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            run_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            data TEXT NOT NULL,
+            created_at REAL NOT NULL
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_run_event_log_run ON run_event_log (run_id, id)')
+
+def _migration_scenario_history(cursor):
+    """v13: Lịch sử revision của scenario, steps lưu theo nội dung (SHA-256) trong step_blobs.
+    Cột steps của automation_scenarios chỉ còn tham chiếu tới blob (STEPS_CODEC_BLOB)"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS step_blobs (
+            sha256 TEXT PRIMARY KEY,
+            steps BLOB NOT NULL,
+            size INTEGER NOT NULL,
+            refcount INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS scenario_revisions (
+            id INTEGER PRIMARY KEY,
+            scenario_id INTEGER NOT NULL,
+            number INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            description TEXT,
+            sha256 TEXT NOT NULL REFERENCES step_blobs (sha256),
+            created_by INTEGER,
+            created_at REAL NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_scenario_revisions_number
+        ON scenario_revisions (scenario_id, number)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_step_blobs_unreferenced
+        ON step_blobs (sha256) WHERE refcount = 0
+    ''')
+    
+    # refcount = số revision trỏ tới blob. Blob về 0 được collect_step_blobs() xóa sau:
+    # trigger chỉ mục tìm kiếm khi xóa scenario vẫn cần đọc steps cũ từ blob.
+    # Revision mới thay revision trước đó của cùng người trong cùng khung SCENARIO_REVISION_WINDOW
+    # (autosave), rồi chỉ giữ SCENARIO_REVISION_LIMIT revision mới nhất
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS scenario_revisions_insert
+        AFTER INSERT ON scenario_revisions
+        BEGIN
+            UPDATE step_blobs SET refcount = refcount + 1 WHERE sha256 = NEW.sha256;
+            DELETE FROM scenario_revisions
+            WHERE id = (
+                SELECT id FROM scenario_revisions
+                WHERE scenario_id = NEW.scenario_id AND number < NEW.number
+                ORDER BY number DESC LIMIT 1
+            )
+            AND number > 1
+            AND created_by IS NEW.created_by
+            AND CAST(created_at / config_value('SCENARIO_REVISION_WINDOW') AS INTEGER)
+                = CAST(NEW.created_at / config_value('SCENARIO_REVISION_WINDOW') AS INTEGER);
+            DELETE FROM scenario_revisions
+            WHERE id IN (
+                SELECT id FROM scenario_revisions
+                WHERE scenario_id = NEW.scenario_id
+                ORDER BY number DESC LIMIT -1 OFFSET MAX(config_value('SCENARIO_REVISION_LIMIT'), 1)
+            );
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS scenario_revisions_delete
+        AFTER DELETE ON scenario_revisions
+        BEGIN
+            UPDATE step_blobs SET refcount = refcount - 1 WHERE sha256 = OLD.sha256;
+        END
+    ''')
+    
+    # Mỗi lần ghi làm đổi name / description / steps là một revision; người ghi lấy từ session
+    # của request (NULL khi ghi từ worker hay migration). steps_sha256() / session_user_id() /
+    # config_value() là hàm SQL được đăng ký trên mọi kết nối (xem open_db_connection)
+    record_revision = '''
+            INSERT INTO scenario_revisions (scenario_id, number, name, description, sha256, created_by, created_at)
+            VALUES (
+                NEW.id,
+                COALESCE((SELECT MAX(number) FROM scenario_revisions WHERE scenario_id = NEW.id), 0) + 1,
+                NEW.name, NEW.description, steps_sha256(NEW.steps), session_user_id(),
+                (julianday('now') - 2440587.5) * 86400.0
+            );
+    '''
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS scenarios_history_insert
+        AFTER INSERT ON automation_scenarios
+        WHEN steps_sha256(NEW.steps) IS NOT NULL
+        BEGIN
+            {record_revision}
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS scenarios_history_update
+        AFTER UPDATE OF name, description, steps ON automation_scenarios
+        WHEN steps_sha256(NEW.steps) IS NOT NULL
+            AND (NEW.name IS NOT OLD.name OR NEW.description IS NOT OLD.description OR NEW.steps IS NOT OLD.steps)
+        BEGIN
+            {record_revision}
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS scenarios_history_delete
+        AFTER DELETE ON automation_scenarios
+        BEGIN
+            DELETE FROM scenario_revisions WHERE scenario_id = OLD.id;
+        END
+    ''')
+    
+    # Chuyển steps có sẵn vào step_blobs; trigger ở trên ghi revision đầu tiên cho từng scenario
+    conn = cursor.connection
+    size_before = 0
+    for row in cursor.execute('SELECT id, steps FROM automation_scenarios').fetchall():
+        if steps_blob_sha256(row[1]) is not None:
+            continue
+        try:
+            steps = decode_steps(row[1], conn)
+        except (ValueError, zlib.error):
+            continue
+        size_before += len(row[1] if isinstance(row[1], bytes) else row[1].encode('utf-8'))
+        cursor.execute('UPDATE automation_scenarios SET steps = ? WHERE id = ?', (store_steps(steps, conn), row[0]))
+    
+    if size_before:
+        size_after = cursor.execute('SELECT COALESCE(SUM(LENGTH(steps)), 0) FROM step_blobs').fetchone()[0]
+        print(f"Moved scenario steps to step_blobs: {size_before} -> {size_after} bytes "
+              f"(run VACUUM to reclaim space)")
+
+def _migration_page_indexes(cursor):
+    """v14: is_public chỉ còn 0 / 1 để trang web đọc riêng nhánh công khai và riêng tư
+    bằng SEARCH trên index; index theo người tạo cho nhánh riêng tư"""
+    cursor.execute('''
+        UPDATE automation_scenarios SET is_public = CASE WHEN is_public = 1 THEN 1 ELSE 0 END
+        WHERE is_public IS NULL OR is_public NOT IN (0, 1)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_scenarios_owner_updated
+        ON automation_scenarios (created_by, is_public, updated_at, id)
+    ''')
+
+def _migration_change_feed_visibility(cursor):
+    """v15: published_revision = revision đầu tiên mà scenario ở trạng thái công khai (NULL nếu
+    chưa từng công khai). Change feed chỉ gửi tin gỡ cho scenario đã công khai từ trước ?since=,
+    nên id của scenario riêng tư không lộ ra ngoài"""
+    if not _column_exists(cursor, 'automation_scenarios', 'published_revision'):
+        cursor.execute('ALTER TABLE automation_scenarios ADD COLUMN published_revision INTEGER')
+    if not _column_exists(cursor, 'scenario_tombstones', 'published_revision'):
+        cursor.execute('ALTER TABLE scenario_tombstones ADD COLUMN published_revision INTEGER')
+    # Không biết lịch sử trước migration: scenario đang công khai tính từ revision hiện tại,
+    # tombstone đã có vẫn được gửi như trước
+    cursor.execute('UPDATE automation_scenarios SET published_revision = revision WHERE is_public = 1')
+    cursor.execute('UPDATE scenario_tombstones SET published_revision = 0')
+    
+    # Ghi published_revision cùng lúc với revision để không kích hoạt thêm một lần tăng version
+    stamp_row = '''
+            UPDATE automation_scenarios
+            SET revision = (SELECT value FROM app_meta WHERE key = 'scenarios_version'),
+                published_revision = CASE
+                    WHEN NEW.is_public = 1
+                    THEN COALESCE(published_revision, (SELECT value FROM app_meta WHERE key = 'scenarios_version'))
+                    ELSE published_revision
+                END
+            WHERE id = NEW.id;
+    '''
+    bump_version = '''
+            UPDATE app_meta SET value = value + 1 WHERE key = 'scenarios_version';
+            UPDATE app_meta SET value = CAST(strftime('%s', 'now') AS INTEGER) WHERE key = 'scenarios_modified_at';
+    '''
+    cursor.execute('DROP TRIGGER IF EXISTS scenarios_revision_insert')
+    cursor.execute(f'''
+        CREATE TRIGGER scenarios_revision_insert
+        AFTER INSERT ON automation_scenarios
+        BEGIN
+            {bump_version}
+            {stamp_row}
+        END
+    ''')
+    cursor.execute('DROP TRIGGER IF EXISTS scenarios_revision_update')
+    cursor.execute(f'''
+        CREATE TRIGGER scenarios_revision_update
+        AFTER UPDATE ON automation_scenarios
+        WHEN NEW.revision = OLD.revision
+        BEGIN
+            {bump_version}
+            {stamp_row}
+        END
+    ''')
+    cursor.execute('DROP TRIGGER IF EXISTS scenarios_revision_delete')
+    cursor.execute(f'''
+        CREATE TRIGGER scenarios_revision_delete
+        AFTER DELETE ON automation_scenarios
+        BEGIN
+            {bump_version}
+            INSERT OR REPLACE INTO scenario_tombstones (scenario_id, revision, published_revision)
+            SELECT OLD.id, value, OLD.published_revision FROM app_meta WHERE key = 'scenarios_version';
+        END
+    ''')
+
+def _migration_search_queue(cursor):
+    """v16: Trigger không gọi hàm Python nữa, chỉ đưa id scenario vừa ghi vào scenarios_fts_pending;
+    refresh_search_index() đánh chỉ mục các id này. Kết nối không qua open_db_connection()
+    (sqlite3 CLI, script vận hành) vẫn ghi được automation_scenarios"""
+    for trigger in ('scenarios_fts_insert', 'scenarios_fts_update', 'scenarios_fts_delete'):
+        cursor.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+    
+    # Bảng contentless cần giá trị cũ để xóa, mà giá trị cũ chỉ tính được bằng hàm Python:
+    # bảng FTS thường tự lưu nội dung nên xóa được theo rowid
+    cursor.execute('DROP TABLE IF EXISTS scenarios_fts')
+    cursor.execute('''
+        CREATE VIRTUAL TABLE scenarios_fts USING fts5(
+            name, description, steps,
+            tokenize = 'unicode61 remove_diacritics 2'
+        )
+    ''')
+    cursor.execute("INSERT INTO scenarios_fts (scenarios_fts, rank) VALUES ('rank', 'bm25(10.0, 4.0, 1.0)')")
+    cursor.execute('''
+        INSERT INTO scenarios_fts (rowid, name, description, steps)
+        SELECT id, search_fold(name), search_fold(description), steps_text(steps) FROM automation_scenarios
+    ''')
+    
+    cursor.execute('CREATE TABLE IF NOT EXISTS scenarios_fts_pending (scenario_id INTEGER PRIMARY KEY)')
+    queue_row = 'INSERT OR IGNORE INTO scenarios_fts_pending (scenario_id) VALUES ({}.id);'
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS scenarios_search_queue_insert
+        AFTER INSERT ON automation_scenarios
+        BEGIN
+            {queue_row.format('NEW')}
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS scenarios_search_queue_update
+        AFTER UPDATE OF name, description, steps ON automation_scenarios
+        BEGIN
+            {queue_row.format('NEW')}
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS scenarios_search_queue_delete
+        AFTER DELETE ON automation_scenarios
+        BEGIN
+            {queue_row.format('OLD')}
+        END
+    ''')
+
+def _migration_revisions_in_python(cursor):
+    """v17: Revision do record_scenario_revisions() ghi trong transaction của lần ghi, không còn
+    trigger gọi steps_sha256() / session_user_id() / config_value(). Trigger còn lại chỉ dùng SQL
+    (refcount của blob, xóa lịch sử khi xóa scenario) nên kết nối ngoài app vẫn ghi được"""
+    for trigger in ('scenarios_history_insert', 'scenarios_history_update', 'scenario_revisions_insert'):
+        cursor.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+    cursor.execute('''
+        CREATE TRIGGER scenario_revisions_insert
+        AFTER INSERT ON scenario_revisions
+        BEGIN
+            UPDATE step_blobs SET refcount = refcount + 1 WHERE sha256 = NEW.sha256;
+        END
+    ''')
+    
+    # refcount tính cả dòng scenario trỏ tới blob, để blob không bị dọn kể cả khi lần ghi
+    # không tạo revision (ghi từ kết nối ngoài app). Tham chiếu = byte codec 3 + 32 byte SHA-256
+    blob_sha256 = '''CASE WHEN typeof({0}.steps) = 'blob' AND length({0}.steps) = 33 AND substr({0}.steps, 1, 1) = X'03'
+                THEN lower(hex(substr({0}.steps, 2))) END'''
+    cursor.execute(f'''
+        CREATE TRIGGER scenarios_blob_ref_insert
+        AFTER INSERT ON automation_scenarios
+        BEGIN
+            UPDATE step_blobs SET refcount = refcount + 1 WHERE sha256 = {blob_sha256.format('NEW')};
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER scenarios_blob_ref_update
+        AFTER UPDATE OF steps ON automation_scenarios
+        WHEN NEW.steps IS NOT OLD.steps
+        BEGIN
+            UPDATE step_blobs SET refcount = refcount - 1 WHERE sha256 = {blob_sha256.format('OLD')};
+            UPDATE step_blobs SET refcount = refcount + 1 WHERE sha256 = {blob_sha256.format('NEW')};
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER scenarios_blob_ref_delete
+        AFTER DELETE ON automation_scenarios
+        BEGIN
+            UPDATE step_blobs SET refcount = refcount - 1 WHERE sha256 = {blob_sha256.format('OLD')};
+        END
+    ''')
+    live = Counter(
+        steps_blob_sha256(row[0])
+        for row in cursor.execute('SELECT steps FROM automation_scenarios WHERE length(steps) = 33').fetchall()
+    )
+    live.pop(None, None)
+    cursor.executemany('UPDATE step_blobs SET refcount = refcount + ? WHERE sha256 = ?',
+                       [(count, sha256) for sha256, count in live.items()])
+
+def _migration_desktop_run_clients(cursor):
+    """v18: Ghi địa chỉ client của run desktop để giới hạn số run đang mở của runner chưa đăng nhập"""
+    cursor.execute('ALTER TABLE runs ADD COLUMN client_address TEXT')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_runs_desktop_open
+        ON runs (client_address) WHERE source = 'desktop' AND status = 'running'
+    ''')
+
+def _migration_metric_snapshots(cursor):
+    """v19: Snapshot metric của từng process, worker nhận scrape /metrics gộp lại"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS metric_snapshots (
+            process TEXT PRIMARY KEY,
+            data TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    ''')
+
+# Các bước nâng cấp schema, phần tử thứ N đưa database lên PRAGMA user_version = N
+SCHEMA_MIGRATIONS = [
+    _migration_scenario_revisions,
+    _migration_listing_indexes,
+    _migration_scenario_stats,
+    _migration_workflow_metadata,
+    _migration_compress_steps,
+    _migration_scenario_search,
+    _migration_change_feed,
+    _migration_upload_store,
+    _migration_execution_plans,
+    _migration_run_queue,
+    _migration_run_history,
+    _migration_run_event_log,
+    _migration_scenario_history,
+    _migration_page_indexes,
+    _migration_change_feed_visibility,
+    _migration_search_queue,
+    _migration_revisions_in_python,
+    _migration_desktop_run_clients,
+    _migration_metric_snapshots,
+]
+
+def migrate_database(conn):
+    """Chạy các bước migration chưa áp dụng, mỗi bước trong một transaction"""
+    current_version = conn.execute('PRAGMA user_version').fetchone()[0]
+    
+    for version, migration in enumerate(SCHEMA_MIGRATIONS, 1):
+        if version <= current_version:
+            continue
+        
+        cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            migration(cursor)
+            cursor.execute(f'PRAGMA user_version = {version}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+# Pragma áp dụng cho mọi kết nối: WAL cho phép đọc song song với ghi,
+# synchronous=NORMAL là đủ an toàn khi đã bật WAL
+SQLITE_PRAGMAS = (
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA cache_size = -16000',  # ~16MB page cache mỗi kết nối
+    'PRAGMA mmap_size = 268435456',  # 256MB memory-mapped I/O
+    'PRAGMA temp_store = MEMORY',
+)
+
+_statement_labels = {}  # câu SQL -> label, phần lớn câu SQL là hằng nên chỉ chuẩn hóa một lần
+_statement_fingerprints = set()
+
+def statement_label(sql):
+    """Label của câu SQL cho metric ('' nếu không đo); quá METRICS_MAX_STATEMENTS label
+    khác nhau thì gộp vào 'other'"""
+    label = _statement_labels.get(sql)
+    if label is None:
+        label = metrics.sql_fingerprint(sql) or ''
+        if label and label not in _statement_fingerprints:
+            if len(_statement_fingerprints) >= app.config['METRICS_MAX_STATEMENTS']:
+                label = 'other'
+            else:
+                _statement_fingerprints.add(label)
+        if len(_statement_labels) >= 4 * app.config['METRICS_MAX_STATEMENTS']:
+            _statement_labels.clear()
+        _statement_labels[sql] = label
+    return label
+
+def observe_statement(sql, started, failed=False):
+    label = statement_label(sql)
+    if not label:
+        return
+    SQL_SECONDS.observe(time.perf_counter() - started, label)
+    if failed:
+        SQL_ERRORS.inc(label)
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Cursor đo thời gian execute (với SELECT chỉ gồm bước đầu tiên, các dòng sau được đọc khi fetch)"""
+    
+    def execute(self, sql, *args):
+        started = time.perf_counter()
+        try:
+            result = super().execute(sql, *args)
+        except sqlite3.Error:
+            observe_statement(sql, started, True)
+            raise
+        observe_statement(sql, started)
+        return result
+    
+    def executemany(self, sql, *args):
+        started = time.perf_counter()
+        try:
+            result = super().executemany(sql, *args)
+        except sqlite3.Error:
+            observe_statement(sql, started, True)
+            raise
+        observe_statement(sql, started)
+        return result
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Kết nối SQLite có đo thời gian mọi câu lệnh, kể cả qua conn.cursor()"""
+    
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+    
+    def execute(self, sql, *args):
+        started = time.perf_counter()
+        try:
+            result = super().execute(sql, *args)
+        except sqlite3.Error:
+            observe_statement(sql, started, True)
+            raise
+        observe_statement(sql, started)
+        return result
+    
+    def executemany(self, sql, *args):
+        started = time.perf_counter()
+        try:
+            result = super().executemany(sql, *args)
+        except sqlite3.Error:
+            observe_statement(sql, started, True)
+            raise
+        observe_statement(sql, started)
+        return result
+
+def open_db_connection(path=None):
+    """Mở một kết nối SQLite mới với các pragma đã tinh chỉnh"""
+    conn = sqlite3.connect(
+        path or app.config['DATABASE'],
+        timeout=app.config['DB_BUSY_TIMEOUT'],
+        check_same_thread=False,
+        cached_statements=256,  # Giữ prepared statements giữa các request
+        factory=InstrumentedConnection if app.config['METRICS_ENABLED'] else sqlite3.Connection,
+    )
     conn.row_factory = sqlite3.Row
+    for pragma in SQLITE_PRAGMAS:
+        conn.execute(pragma)
+    # refresh_search_index() cần đọc được cột steps đã nén
+    conn.create_function('steps_text', 1, lambda steps: search_fold(steps_search_text(steps, conn)), deterministic=True)
+    conn.create_function('search_fold', 1, search_fold, deterministic=True)
+    # Trigger lịch sử revision của migration v13 (v17 chuyển việc ghi revision sang Python)
+    conn.create_function('steps_sha256', 1, steps_blob_sha256, deterministic=True)
+    conn.create_function('session_user_id', 0, session_user_id)
+    conn.create_function('config_value', 1, lambda name: app.config[name])
     return conn
 
+def run_blocking_sqlite(function, *args):
+    """Gọi function(*args) từ thread nền. Câu ghi có thể chờ khóa của process khác tới
+    DB_BUSY_TIMEOUT trong C; dưới worker gevent thread nền là greenlet nên lúc đó mọi stream SSE
+    và request của worker bị dừng. Khi threading đã bị monkey-patch, hàm chạy trên threadpool
+    (OS thread thật) của hub và chỉ greenlet gọi phải chờ"""
+    if 'gevent.monkey' in sys.modules:
+        from gevent import get_hub, monkey
+        if monkey.is_module_patched('threading'):
+            return get_hub().threadpool.apply(function, args)
+    return function(*args)
+
+class ConnectionPool:
+    """Pool các kết nối SQLite dùng lại giữa các request"""
+    
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+    
+    def acquire(self):
+        """Lấy một kết nối rảnh, mở thêm nếu pool chưa đầy"""
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        
+        with self._lock:
+            can_create = self._created < self.size
+            if can_create:
+                self._created += 1
+        
+        if can_create:
+            try:
+                return open_db_connection(self.path)
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        
+        try:
+            return self._idle.get(timeout=app.config['DB_BUSY_TIMEOUT'])
+        except queue.Empty:
+            raise sqlite3.OperationalError('Database connection pool exhausted')
+    
+    def release(self, conn):
+        """Trả kết nối về pool, hủy transaction còn dang dở"""
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            conn.close()
+            with self._lock:
+                self._created -= 1
+            return
+        self._idle.put(conn)
+    
+    def counts(self):
+        """(số kết nối đang mở, số kết nối rảnh)"""
+        return self._created, self._idle.qsize()
+    
+    def close_all(self):
+        """Đóng toàn bộ kết nối đang rảnh"""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+_db_pool = None
+_db_pool_lock = threading.Lock()
+
+def get_db_pool():
+    """Lấy pool kết nối của app (tạo lại nếu đổi đường dẫn database)"""
+    global _db_pool
+    with _db_pool_lock:
+        if _db_pool is None or _db_pool.path != app.config['DATABASE']:
+            if _db_pool is not None:
+                _db_pool.close_all()
+            _db_pool = ConnectionPool(app.config['DATABASE'], app.config['DB_POOL_SIZE'])
+        return _db_pool
+
+def get_db_connection():
+    """Lấy kết nối database của request hiện tại (dùng chung cho decorator và route)"""
+    if 'db' not in g:
+        g.db = get_db_pool().acquire()
+    return g.db
+
+@app.teardown_appcontext
+def release_db_connection(exception):
+    """Trả kết nối về pool khi request kết thúc"""
+    conn = g.pop('db', None)
+    if conn is not None:
+        get_db_pool().release(conn)
+
+class ScenarioCache:
+    """LRU các scenario đã parse kèm JSON đã serialize sẵn, giới hạn theo dung lượng"""
+    
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (value, cost)
+        self._generations = {}  # scenario_id -> số lần bị invalidate
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    def generation(self, scenario_id):
+        """Lấy mốc invalidate hiện tại, truyền lại cho put() sau khi đọc database"""
+        with self._lock:
+            return self._generations.get(scenario_id, 0)
+    
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return item[0]
+    
+    def put(self, key, value, cost, scenario_id=None, generation=None):
+        """Lưu value; bỏ qua nếu scenario đã bị ghi đè sau khi đọc (generation đổi)"""
+        if cost > self.max_bytes:
+            return
+        with self._lock:
+            if scenario_id is not None and self._generations.get(scenario_id, 0) != generation:
+                return
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= old[1]
+            self._entries[key] = (value, cost)
+            self._size += cost
+            while self._size > self.max_bytes:
+                _, (_, evicted_cost) = self._entries.popitem(last=False)
+                self._size -= evicted_cost
+    
+    def invalidate(self, scenario_id=None):
+        """Xóa cache của một scenario (hoặc tất cả) cùng mọi danh sách đã serialize"""
+        with self._lock:
+            if scenario_id is None:
+                self._generations.clear()
+                stale = list(self._entries)
+            else:
+                self._generations[scenario_id] = self._generations.get(scenario_id, 0) + 1
+                stale = [key for key in self._entries if key[0] == 'list' or key == ('scenario', scenario_id)]
+            for key in stale:
+                self._size -= self._entries.pop(key)[1]
+    
+    def invalidate_many(self, scenario_ids):
+        """Như invalidate() cho nhiều scenario, chỉ duyệt cache một lần"""
+        with self._lock:
+            keys = set()
+            for scenario_id in scenario_ids:
+                self._generations[scenario_id] = self._generations.get(scenario_id, 0) + 1
+                keys.add(('scenario', scenario_id))
+            stale = [key for key in self._entries if key[0] == 'list' or key in keys]
+            for key in stale:
+                self._size -= self._entries.pop(key)[1]
+
+scenario_cache = ScenarioCache(app.config['SCENARIO_CACHE_MAX_BYTES'])
+
+class CachedScenario:
+    """Scenario đã parse cùng các payload JSON đã serialize"""
+    
+    def __init__(self, row, steps):
+        self.id = row['id']
+        self.revision = row['revision']
+        self.is_public = bool(row['is_public'])
+        self.created_by = row['created_by']
+        self.record = {
+            'id': row['id'],
+            'name': row['name'],
+            'description': row['description'],
+            'steps': steps,
+            'is_public': bool(row['is_public']),
+            'created_by': row['created_by'],
+            'creator_name': row['creator_name'],
+            'created_at': row['created_at'],
+            'updated_at': row['updated_at'],
+            'workflow_type': row['workflow_type'],
+            'node_count': row['node_count'],
+            'needs_upload': bool(row['needs_upload']),
+            'needs_download': bool(row['needs_download']),
+            'uses_tabs': bool(row['uses_tabs']),
+            'revision': row['revision']
+        }
+        # Payload của /api/scenarios/<id>
+        self.public_payload = EncodedPayload(app.json.dumps({
+            field: self.record[field] for field in SCENARIO_LIST_FIELDS
+        }).encode('utf-8'))
+        # Plan do phiên bản trình biên dịch khác tạo ra thì bỏ qua, biên dịch lại khi cần
+        self._stored_plan = row['plan'] if row['plan_version'] == PLAN_VERSION else None
+        self._plan_payload = None
+    
+    @property
+    def plan_payload(self):
+        """Payload của /api/scenarios/<id>/plan, bản gzip lấy thẳng từ database"""
+        if self._plan_payload is None:
+            stored = self._stored_plan or encode_execution_plan(compile_workflow(self.record['steps']))
+            self._plan_payload = EncodedPayload(gzip.decompress(stored), {'gzip': stored})
+            self._stored_plan = None
+        return self._plan_payload
+    
+    @property
+    def cost(self):
+        # Ước lượng: bản parse trong bộ nhớ chiếm vài lần kích thước JSON,
+        # đã tính cả các bản nén được thêm vào sau (plan gzip khoảng bằng một bản nén)
+        return len(self.public_payload.body) * 4 + len(self._stored_plan or b'')
+
+_scenario_cache_synced = (None, None)  # (database, version catalogue đã đồng bộ tới)
+_scenario_cache_sync_lock = threading.Lock()
+
+def sync_scenario_cache(conn):
+    """Khi nhiều process dùng chung database: bỏ khỏi cache các scenario mà process khác
+    đã ghi hoặc xóa kể từ lần đồng bộ trước (theo revision của change feed)"""
+    global _scenario_cache_synced
+    version, _ = get_catalog_version(conn)
+    with _scenario_cache_sync_lock:
+        database, synced = _scenario_cache_synced
+        if database == app.config['DATABASE'] and synced == version:
+            return
+        changed = None
+        if database == app.config['DATABASE'] and synced is not None and version > synced:
+            changed = [row[0] for row in conn.execute('''
+                SELECT id FROM automation_scenarios WHERE revision > ?
+                UNION SELECT scenario_id FROM scenario_tombstones WHERE revision > ?
+                LIMIT ?
+            ''', (synced, synced, MAX_PAGE_SIZE + 1)).fetchall()]
+        if changed is None or len(changed) > MAX_PAGE_SIZE:
+            scenario_cache.invalidate()
+        else:
+            scenario_cache.invalidate_many(changed)
+        _scenario_cache_synced = (app.config['DATABASE'], version)
+
+def load_cached_scenarios(scenario_ids):
+    """Lấy nhiều scenario từ cache; các scenario chưa có được đọc bằng một truy vấn"""
+    if app.config['SCENARIO_CACHE_SYNC']:
+        sync_scenario_cache(get_db_connection())
+    found = {}
+    missing = []
+    for scenario_id in scenario_ids:
+        cached = scenario_cache.get(('scenario', scenario_id))
+        if cached is not None:
+            found[scenario_id] = cached
+        else:
+            missing.append(scenario_id)
+    
+    if not missing:
+        return found
+    
+    generations = {scenario_id: scenario_cache.generation(scenario_id) for scenario_id in missing}
+    conn = get_db_connection()
+    for start in range(0, len(missing), MAX_PAGE_SIZE):
+        chunk = missing[start:start + MAX_PAGE_SIZE]
+        rows = conn.execute(f'''
+            SELECT s.id, s.name, s.description, s.steps, s.is_public, s.created_by,
+                   s.created_at, s.updated_at, s.revision, s.workflow_type, s.node_count,
+                   s.needs_upload, s.needs_download, s.uses_tabs, s.plan, s.plan_version,
+                   u.username as creator_name
+            FROM automation_scenarios s
+            LEFT JOIN users u ON s.created_by = u.id
+            WHERE s.id IN ({', '.join('?' * len(chunk))})
+        ''', chunk).fetchall()
+        
+        for row in rows:
+            cached = CachedScenario(row, decode_steps(row['steps'], conn))
+            scenario_cache.put(('scenario', row['id']), cached, cached.cost, row['id'], generations[row['id']])
+            found[row['id']] = cached
+    
+    return found
+
+def load_cached_scenario(scenario_id):
+    """Lấy một scenario đã parse, không chạm tới SQLite nếu đã có trong cache"""
+    return load_cached_scenarios([scenario_id]).get(scenario_id)
+
+def compress_body(body, encoding):
+    """Nén body theo content-coding đã chọn"""
+    if encoding == 'br':
+        return brotli.compress(body, quality=app.config['COMPRESS_BROTLI_QUALITY'])
+    return gzip.compress(body, compresslevel=app.config['COMPRESS_GZIP_LEVEL'], mtime=0)
+
+def negotiate_content_encoding(size):
+    """Chọn content-coding theo Accept-Encoding, None nếu không nén"""
+    if size < app.config['COMPRESS_MIN_SIZE']:
+        return None
+    supported = ['br', 'gzip'] if brotli is not None else ['gzip']
+    return request.accept_encodings.best_match(supported)
+
+class EncodedPayload:
+    """JSON đã serialize cùng các bản nén của nó, mỗi content-coding chỉ nén một lần"""
+    
+    def __init__(self, body, encoded=None):
+        self.body = body
+        self._encoded = dict(encoded or {})
+    
+    def encoded(self, encoding):
+        if encoding is None:
+            return self.body
+        data = self._encoded.get(encoding)
+        if data is None:
+            data = self._encoded[encoding] = compress_body(self.body, encoding)
+        return data
+
+def json_body_response(payload):
+    """Tạo response từ JSON đã serialize sẵn, dùng bản nén đã cache nếu client chấp nhận"""
+    encoding = negotiate_content_encoding(len(payload.body))
+    response = app.response_class(payload.encoded(encoding), mimetype='application/json')
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return response
+
+@app.after_request
+def compress_api_response(response):
+    """Nén các response JSON khác của API (những route không có payload cache sẵn)"""
+    if (not request.path.startswith('/api/') or response.status_code != 200
+            or response.is_streamed or response.mimetype != 'application/json'
+            or 'Content-Encoding' in response.headers or 'Accept-Encoding' in response.vary):
+        return response
+    
+    response.vary.add('Accept-Encoding')
+    body = response.get_data()
+    encoding = negotiate_content_encoding(len(body))
+    if encoding is not None:
+        response.set_data(compress_body(body, encoding))
+        response.headers['Content-Encoding'] = encoding
+    return response
+
+def get_session_role():
+    """Lấy role của user đang đăng nhập từ session, chỉ đọc lại database khi quá
+    ROLE_CACHE_TTL giây để việc thu hồi quyền vẫn có hiệu lực"""
+    if 'user_id' not in session:
+        return None
+    
+    checked_at = session.get('role_checked_at', 0)
+    if 'role' in session and time.time() - checked_at < app.config['ROLE_CACHE_TTL']:
+        return session['role']
+    
+    user = get_db_connection().execute('SELECT role FROM users WHERE id = ?', (session['user_id'],)).fetchone()
+    if not user:
+        session.pop('role', None)
+        return None
+    
+    session['role'] = user['role']
+    session['role_checked_at'] = time.time()
+    return user['role']
+
+def session_user_id():
+    """User của request hiện tại cho lịch sử revision, None khi không có request"""
+    return session.get('user_id') if has_request_context() else None
+
 def login_required(f):
     """Decorator yêu cầu đăng nhập"""
     def decorated_function(*args, **kwargs):
@@ -92,17 +1582,550 @@ def admin_required(f):
         if 'user_id' not in session:
             return redirect(url_for('login'))
         
-        conn = get_db_connection()
-        user = conn.execute('SELECT role FROM users WHERE id = ?', (session['user_id'],)).fetchone()
-        conn.close()
-        
-        if not user or user['role'] != 'admin':
+        if get_session_role() != 'admin':
             flash('Access denied. Admin privileges required.', 'error')
             return redirect(url_for('automation'))  # Updated redirect to automation
         return f(*args, **kwargs)
     decorated_function.__name__ = f.__name__
     return decorated_function
 
+def count_workflow_steps(steps):
+    """Số node của visual workflow hoặc số bước của linear workflow"""
+    if isinstance(steps, dict):
+        return len(steps.get('nodes') or [])
+    if isinstance(steps, list):
+        return len(steps)
+    return 0
+
+# Loại bước cần thư mục upload / download hoặc thao tác với tab
+UPLOAD_STEP_TYPES = {'upload'}
+DOWNLOAD_STEP_TYPES = {'download'}
+TAB_STEP_TYPES = {'new_tab', 'activate_tab', 'close_tab'}
+
+def derive_workflow_metadata(steps):
+    """Metadata mà runner và giao diện web cần, tính một lần khi lưu"""
+    is_visual = isinstance(steps, dict) and steps.get('workflow_type') == 'visual'
+    if isinstance(steps, dict):
+        items = steps.get('nodes') or []
+    elif isinstance(steps, list):
+        items = steps
+    else:
+        items = []
+    step_types = {item.get('type') for item in items if isinstance(item, dict)}
+    
+    return {
+        'workflow_type': 'visual' if is_visual else 'linear',
+        'node_count': count_workflow_steps(steps),
+        'needs_upload': int(bool(step_types & UPLOAD_STEP_TYPES)),
+        'needs_download': int(bool(step_types & DOWNLOAD_STEP_TYPES)),
+        'uses_tabs': int(bool(step_types & TAB_STEP_TYPES)),
+    }
+
+def scenario_steps_columns(steps, conn=None):
+    """Cột steps (tham chiếu tới step_blobs) cùng các cột suy ra từ steps, luôn được ghi cùng nhau"""
+    return {
+        'steps': store_steps(steps, conn or get_db_connection()),
+        **derive_workflow_metadata(steps),
+        **execution_plan_columns(steps)
+    }
+
+def encode_execution_plan(plan):
+    """Serialize plan và nén gzip; bản nén được trả thẳng cho client chấp nhận gzip"""
+    body = app.json.dumps(plan).encode('utf-8')
+    return compress_body(body, 'gzip')
+
+def execution_plan_columns(steps):
+    """Biên dịch workflow thành execution plan để lưu cùng steps"""
+    return {
+        'plan': encode_execution_plan(compile_workflow(steps)),
+        'plan_version': PLAN_VERSION,
+    }
+
+def refresh_execution_plans(conn, batch_size=500):
+    """Biên dịch lại các plan thiếu hoặc cũ hơn PLAN_VERSION, trả về số dòng đã cập nhật"""
+    refreshed = 0
+    last_id = 0
+    while True:
+        cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            rows = cursor.execute('''
+                SELECT id, steps FROM automation_scenarios
+                WHERE id > ? AND plan_version IS NOT ?
+                ORDER BY id LIMIT ?
+            ''', (last_id, PLAN_VERSION, batch_size)).fetchall()
+            for row in rows:
+                try:
+                    steps = decode_steps(row['steps'], conn)
+                except (ValueError, zlib.error):
+                    steps = []
+                columns = execution_plan_columns(steps)
+                # Plan mới thay đổi nội dung runner nhận được nên revision cũng tăng theo
+                cursor.execute('''
+                    UPDATE automation_scenarios SET plan = ?, plan_version = ? WHERE id = ?
+                ''', (columns['plan'], columns['plan_version'], row['id']))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        
+        if not rows:
+            break
+        refreshed += len(rows)
+        last_id = rows[-1]['id']
+    
+    if refreshed:
+        print(f"Compiled execution plans for {refreshed} scenarios (plan version {PLAN_VERSION})")
+    return refreshed
+
+# Định dạng dữ liệu steps: 1 byte codec rồi tới dữ liệu nén; với STEPS_CODEC_ZLIB_DICT
+# có thêm 4 byte id của dictionary. Dòng TEXT cũ vẫn là JSON thường.
+# Cột steps của scenario là STEPS_CODEC_BLOB và 32 byte SHA-256 của JSON,
+# dữ liệu nén nằm ở step_blobs và dùng chung cho mọi scenario / revision cùng nội dung.
+STEPS_CODEC_ZLIB = 1
+STEPS_CODEC_ZLIB_DICT = 2
+STEPS_CODEC_BLOB = 3
+STEPS_DICTIONARY_HEADER = struct.Struct('>BI')
+STEPS_DICTIONARY_MIN_SAMPLES = 20  # Số workflow tối thiểu để train dictionary
+STEPS_DICTIONARY_MAX_SAMPLES = 1000
+
+# Các cặp "key": value ngắn, phần lặp lại nhiều nhất giữa các workflow
+STEPS_FRAGMENT_PATTERN = re.compile(r'"[^"\\]{1,64}": (?:"[^"\\]{0,64}"|-?\d+(?:\.\d+)?|true|false|null|\{|\[)')
+
+# Dictionary không bao giờ bị sửa sau khi ghi nên có thể cache theo (database, id)
+_steps_dictionaries = {}
+_active_steps_dictionaries = {}
+_steps_dictionaries_lock = threading.Lock()
+
+def get_steps_dictionary(conn, dictionary_id):
+    """Đọc dictionary theo id, chỉ truy vấn database lần đầu"""
+    key = (app.config['DATABASE'], dictionary_id)
+    dictionary = _steps_dictionaries.get(key)
+    if dictionary is None:
+        row = conn.execute('SELECT dictionary FROM steps_dictionaries WHERE id = ?', (dictionary_id,)).fetchone()
+        if row is None:
+            raise ValueError(f'Unknown steps dictionary {dictionary_id}')
+        dictionary = bytes(row[0])
+        with _steps_dictionaries_lock:
+            _steps_dictionaries[key] = dictionary
+    return dictionary
+
+def get_active_steps_dictionary(conn):
+    """Dictionary mới nhất dùng cho các lần ghi, (None, None) nếu chưa train"""
+    database = app.config['DATABASE']
+    active = _active_steps_dictionaries.get(database)
+    if active is None:
+        row = conn.execute('SELECT id, dictionary FROM steps_dictionaries ORDER BY id DESC LIMIT 1').fetchone()
+        active = (row[0], bytes(row[1])) if row else (None, None)
+        with _steps_dictionaries_lock:
+            _active_steps_dictionaries[database] = active
+    return active
+
+@observe_json('encode_steps')
+def encode_steps(steps, conn):
+    """Serialize và nén steps"""
+    return compress_steps_data(json.dumps(steps).encode('utf-8'), conn)
+
+def compress_steps_data(data, conn):
+    """Nén JSON của steps, dùng dictionary mới nhất nếu đã train"""
+    level = app.config['STEPS_COMPRESSION_LEVEL']
+    dictionary_id, dictionary = get_active_steps_dictionary(conn)
+    if dictionary is None:
+        return bytes([STEPS_CODEC_ZLIB]) + zlib.compress(data, level)
+    
+    compressor = zlib.compressobj(level, zdict=dictionary)
+    return STEPS_DICTIONARY_HEADER.pack(STEPS_CODEC_ZLIB_DICT, dictionary_id) + compressor.compress(data) + compressor.flush()
+
+@observe_json('store_steps')
+def store_steps(steps, conn):
+    """Lưu steps vào step_blobs (nếu chưa có blob cùng nội dung), trả về giá trị cho cột steps.
+    Chỉ nén khi nội dung mới: lưu lại steps không đổi hay tạo bản sao không tốn thêm dung lượng"""
+    data = json.dumps(steps).encode('utf-8')
+    digest = hashlib.sha256(data).digest()
+    # Giữ khóa ghi tới khi dòng tham chiếu blob được commit: collect_step_blobs() cũng lấy khóa ghi
+    # nên không thể xóa blob (kể cả blob refcount = 0 đang chờ dọn) giữa lần kiểm tra và lần ghi
+    if not conn.in_transaction:
+        conn.execute('BEGIN IMMEDIATE')
+    if conn.execute('SELECT 1 FROM step_blobs WHERE sha256 = ?', (digest.hex(),)).fetchone() is None:
+        conn.execute('''
+            INSERT INTO step_blobs (sha256, steps, size) VALUES (?, ?, ?)
+            ON CONFLICT (sha256) DO NOTHING
+        ''', (digest.hex(), compress_steps_data(data, conn), len(data)))
+    return bytes([STEPS_CODEC_BLOB]) + digest
+
+def steps_blob_reference(sha256):
+    """Giá trị cột steps trỏ tới blob có SHA-256 (hex) cho trước"""
+    return bytes([STEPS_CODEC_BLOB]) + bytes.fromhex(sha256)
+
+def steps_blob_sha256(value):
+    """SHA-256 (hex) của blob mà cột steps tham chiếu, None nếu dòng lưu steps trực tiếp"""
+    if isinstance(value, bytes) and len(value) == 33 and value[0] == STEPS_CODEC_BLOB:
+        return value[1:].hex()
+    return None
+
+@observe_json('decode_steps')
+def decode_steps(value, conn):
+    """Giải nén và parse cột steps, chấp nhận cả dòng JSON chưa nén"""
+    if not value:
+        return []
+    if isinstance(value, str):
+        return json.loads(value)
+    
+    codec = value[0]
+    if codec == STEPS_CODEC_BLOB:
+        row = conn.execute('SELECT steps FROM step_blobs WHERE sha256 = ?', (value[1:].hex(),)).fetchone()
+        if row is None:
+            raise ValueError(f'Missing steps blob {value[1:].hex()}')
+        value = bytes(row[0])
+        codec = value[0]
+    if codec == STEPS_CODEC_ZLIB:
+        return json.loads(zlib.decompress(value[1:]))
+    if codec == STEPS_CODEC_ZLIB_DICT:
+        dictionary_id = STEPS_DICTIONARY_HEADER.unpack_from(value)[1]
+        decompressor = zlib.decompressobj(zdict=get_steps_dictionary(conn, dictionary_id))
+        data = decompressor.decompress(value[STEPS_DICTIONARY_HEADER.size:]) + decompressor.flush()
+        return json.loads(data)
+    raise ValueError(f'Unknown steps codec {codec}')
+
+# unicode61 bỏ dấu nhưng không coi Đ là D có dấu
+SEARCH_FOLD_TABLE = str.maketrans('Đđ', 'Dd')
+
+def search_fold(text):
+    """Chuẩn hóa văn bản trước khi đánh chỉ mục / tìm kiếm"""
+    return (text or '').translate(SEARCH_FOLD_TABLE)
+
+def steps_search_text(value, conn):
+    """Gom các chuỗi trong steps (URL, xpath, script...) thành văn bản để đánh chỉ mục"""
+    try:
+        steps = decode_steps(value, conn)
+    except (ValueError, zlib.error):
+        return value if isinstance(value, str) else ''
+    
+    texts = []
+    pending = [steps]
+    while pending:
+        item = pending.pop()
+        if isinstance(item, str):
+            texts.append(item)
+        elif isinstance(item, dict):
+            pending.extend(item.values())
+        elif isinstance(item, list):
+            pending.extend(item)
+    return ' '.join(reversed(texts))
+
+def refresh_search_index(conn):
+    """Đánh lại chỉ mục tìm kiếm cho các scenario trong scenarios_fts_pending (ghi bởi trigger,
+    kể cả từ kết nối ngoài app); gọi trước khi tìm kiếm và sau các lần ghi nhiều dòng"""
+    if conn.execute('SELECT 1 FROM scenarios_fts_pending LIMIT 1').fetchone() is None:
+        return
+    owns_transaction = not conn.in_transaction
+    if owns_transaction:
+        conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.execute('DELETE FROM scenarios_fts WHERE rowid IN (SELECT scenario_id FROM scenarios_fts_pending)')
+        conn.execute('''
+            INSERT INTO scenarios_fts (rowid, name, description, steps)
+            SELECT id, search_fold(name), search_fold(description), steps_text(steps)
+            FROM automation_scenarios WHERE id IN (SELECT scenario_id FROM scenarios_fts_pending)
+        ''')
+        conn.execute('DELETE FROM scenarios_fts_pending')
+        if owns_transaction:
+            conn.commit()
+    except Exception:
+        if owns_transaction:
+            conn.rollback()
+        raise
+
+def build_steps_dictionary(samples, size):
+    """Dựng dictionary zlib từ các đoạn JSON xuất hiện trong nhiều workflow mẫu"""
+    document_counts = Counter()
+    for sample in samples:
+        document_counts.update(set(STEPS_FRAGMENT_PATTERN.findall(sample)))
+    
+    ranked = sorted(
+        (fragment for fragment, count in document_counts.items() if count > 1),
+        key=lambda fragment: document_counts[fragment] * len(fragment),
+        reverse=True
+    )
+    chosen = []
+    total = 0
+    for fragment in ranked:
+        if total + len(fragment) > size:
+            continue
+        chosen.append(fragment)
+        total += len(fragment)
+    
+    # zlib tham chiếu phần cuối dictionary rẻ hơn, đặt đoạn phổ biến nhất ở cuối
+    return ''.join(reversed(chosen)).encode('utf-8')
+
+def train_steps_dictionary(cursor):
+    """Train dictionary từ các workflow hiện có nếu chưa có; trả về id hoặc None"""
+    size = app.config['STEPS_DICTIONARY_SIZE']
+    if not size or cursor.execute('SELECT 1 FROM steps_dictionaries LIMIT 1').fetchone():
+        return None
+    
+    conn = cursor.connection
+    samples = []
+    for row in cursor.execute(
+        'SELECT steps FROM automation_scenarios ORDER BY updated_at DESC LIMIT ?',
+        (STEPS_DICTIONARY_MAX_SAMPLES,)
+    ).fetchall():
+        try:
+            samples.append(json.dumps(decode_steps(row[0], conn)))
+        except (ValueError, zlib.error):
+            continue
+    if len(samples) < STEPS_DICTIONARY_MIN_SAMPLES:
+        return None
+    
+    dictionary = build_steps_dictionary(samples, size)
+    if not dictionary:
+        return None
+    cursor.execute('INSERT INTO steps_dictionaries (dictionary) VALUES (?)', (dictionary,))
+    with _steps_dictionaries_lock:
+        _active_steps_dictionaries.pop(app.config['DATABASE'], None)
+    return cursor.lastrowid
+
+def ensure_steps_dictionary(conn):
+    """Train dictionary khi database đã đủ mẫu; các lần ghi sau sẽ dùng nó"""
+    cursor = conn.cursor()
+    cursor.execute('BEGIN IMMEDIATE')
+    try:
+        train_steps_dictionary(cursor)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+_step_blob_gc_last_run = 0
+
+def collect_step_blobs(conn=None):
+    """Xóa blob steps không còn scenario hay revision nào tham chiếu (scenario đã xóa, revision cũ đã bị dọn)"""
+    global _step_blob_gc_last_run
+    conn = conn or get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('BEGIN IMMEDIATE')
+    try:
+        cursor.execute('DELETE FROM step_blobs WHERE refcount = 0')
+        deleted = cursor.rowcount
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    _step_blob_gc_last_run = time.time()
+    return deleted
+
+def collect_step_blobs_if_due(conn):
+    """Gọi sau các lần ghi có thể bỏ tham chiếu tới blob, dọn tối đa mỗi STEP_BLOB_GC_INTERVAL giây"""
+    if time.time() - _step_blob_gc_last_run > app.config['STEP_BLOB_GC_INTERVAL']:
+        collect_step_blobs(conn)
+
+def store_revision_settings(conn):
+    """Ghi SCENARIO_REVISION_WINDOW / SCENARIO_REVISION_LIMIT vào app_meta cho record_scenario_revisions()"""
+    conn.executemany('INSERT OR REPLACE INTO app_meta (key, value) VALUES (?, ?)', [
+        ('scenario_revision_window', max(int(app.config['SCENARIO_REVISION_WINDOW']), 0)),
+        ('scenario_revision_limit', max(int(app.config['SCENARIO_REVISION_LIMIT']), 1)),
+    ])
+    conn.commit()
+
+def record_scenario_revisions(conn, scenario_ids):
+    """Ghi revision cho các scenario vừa ghi, gọi trong cùng transaction sau INSERT / UPDATE.
+    Chỉ ghi khi name / description / steps khác revision mới nhất; revision mới thay revision
+    trước đó của cùng người trong cùng khung scenario_revision_window (autosave), rồi chỉ giữ
+    scenario_revision_limit revision mới nhất"""
+    settings = dict(conn.execute(
+        "SELECT key, value FROM app_meta WHERE key IN ('scenario_revision_window', 'scenario_revision_limit')"
+    ).fetchall())
+    window = settings.get('scenario_revision_window', 0)
+    limit = max(settings.get('scenario_revision_limit', 1), 1)
+    user_id = session_user_id()
+    now = time.time()
+    
+    for scenario_id in scenario_ids:
+        row = conn.execute(
+            'SELECT name, description, steps FROM automation_scenarios WHERE id = ?', (scenario_id,)
+        ).fetchone()
+        sha256 = steps_blob_sha256(row['steps']) if row else None
+        if sha256 is None:
+            continue
+        last = conn.execute('''
+            SELECT id, number, name, description, sha256, created_by, created_at FROM scenario_revisions
+            WHERE scenario_id = ? ORDER BY number DESC LIMIT 1
+        ''', (scenario_id,)).fetchone()
+        if last and (last['name'], last['description'], last['sha256']) == (row['name'], row['description'], sha256):
+            continue
+        
+        conn.execute('''
+            INSERT INTO scenario_revisions (scenario_id, number, name, description, sha256, created_by, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (scenario_id, (last['number'] if last else 0) + 1, row['name'], row['description'], sha256, user_id, now))
+        if (last and last['number'] > 1 and last['created_by'] == user_id and window
+                and int(last['created_at'] // window) == int(now // window)):
+            conn.execute('DELETE FROM scenario_revisions WHERE id = ?', (last['id'],))
+        conn.execute('''
+            DELETE FROM scenario_revisions
+            WHERE id IN (
+                SELECT id FROM scenario_revisions WHERE scenario_id = ?
+                ORDER BY number DESC LIMIT -1 OFFSET ?
+            )
+        ''', (scenario_id, limit))
+
+def insert_scenario(cursor, name, description, steps, is_public, created_by):
+    """Thêm scenario mới, trả về id"""
+    columns = {
+        'name': name,
+        'description': description,
+        'is_public': is_public,
+        'created_by': created_by,
+        'updated_at': datetime.now().isoformat(),
+        **scenario_steps_columns(steps, cursor.connection)
+    }
+    cursor.execute(f'''
+        INSERT INTO automation_scenarios ({', '.join(columns)})
+        VALUES ({', '.join('?' * len(columns))})
+    ''', list(columns.values()))
+    scenario_id = cursor.lastrowid
+    record_scenario_revisions(cursor.connection, [scenario_id])
+    return scenario_id
+
+def get_admin_stats(conn):
+    """Đọc thống kê đã được trigger cập nhật sẵn"""
+    stats = {name: value for name, value in conn.execute('SELECT name, value FROM scenario_stats').fetchall()}
+    for name in ('total_scenarios', 'public_scenarios', 'total_users'):
+        stats.setdefault(name, 0)
+    
+    histogram = dict(conn.execute('SELECT bucket, scenarios FROM step_count_histogram').fetchall())
+    stats['step_count_histogram'] = {label: histogram.get(label, 0) for label, _ in STEP_COUNT_BUCKETS}
+    return stats
+
+# Truy vấn danh sách, dùng chung cho route và audit_query_plans()
+# Trang web chỉ cần metadata và số bước, steps được tải khi mở preview
+PAGE_COLUMNS = '''
+    s.id, s.name, s.description, s.is_public, s.created_by, s.created_at,
+    s.updated_at, s.workflow_type, s.node_count, u.username as creator_name
+'''
+
+# Id của một trang: mỗi nhánh là SEARCH trên covering index theo đúng thứ tự, hai nhánh được
+# trộn (MERGE UNION ALL) nên OFFSET chỉ duyệt index; các dòng được đọc sau theo khóa chính
+AUTOMATION_PAGE_QUERY = '''
+    SELECT updated_at, id FROM automation_scenarios WHERE is_public = 1
+    UNION ALL
+    SELECT updated_at, id FROM automation_scenarios WHERE created_by = ? AND is_public = 0
+    ORDER BY updated_at DESC, id DESC
+    LIMIT ? OFFSET ?
+'''
+
+ADMIN_PAGE_QUERY = '''
+    SELECT updated_at, id FROM automation_scenarios WHERE is_public = 1
+    UNION ALL
+    SELECT updated_at, id FROM automation_scenarios WHERE is_public = 0
+    ORDER BY updated_at DESC, id DESC
+    LIMIT ? OFFSET ?
+'''
+
+def build_page_rows_query(count):
+    """Đọc các dòng của một trang theo danh sách id"""
+    return f'''
+        SELECT {PAGE_COLUMNS}
+        FROM automation_scenarios s
+        LEFT JOIN users u ON s.created_by = u.id
+        WHERE s.id IN ({', '.join('?' * count)})
+    '''
+
+def load_page_rows(conn, page_query, params):
+    """Các dòng của trang theo thứ tự của page_query"""
+    ids = [row['id'] for row in conn.execute(page_query, params).fetchall()]
+    if not ids:
+        return []
+    rows = {row['id']: row for row in conn.execute(build_page_rows_query(len(ids)), ids).fetchall()}
+    return [rows[scenario_id] for scenario_id in ids if scenario_id in rows]
+
+def build_public_list_query(columns, with_cursor=False, with_limit=False, with_type=False):
+    """Tạo truy vấn danh sách scenario công khai (keyset trên updated_at, id)"""
+    query = f'''
+        SELECT {', '.join(columns)}
+        FROM automation_scenarios
+        WHERE is_public = 1
+    '''
+    if with_type:
+        query += ' AND workflow_type = ?'
+    if with_cursor:
+        query += ' AND (updated_at, id) < (?, ?)'
+    query += ' ORDER BY updated_at DESC, id DESC'
+    if with_limit:
+        query += ' LIMIT ?'
+    return query
+
+SEARCH_RESULT_FIELDS = (
+    'id', 'name', 'description', 'is_public', 'created_at', 'updated_at',
+    'workflow_type', 'node_count', 'needs_upload', 'needs_download', 'uses_tabs'
+)
+
+def build_search_match(text):
+    """Chuyển chuỗi người dùng nhập thành biểu thức MATCH an toàn cho FTS5:
+    mọi từ đều phải có, từ cuối khớp theo tiền tố; None nếu không có từ nào"""
+    terms = re.findall(r'\w+', search_fold(text))
+    if not terms:
+        return None
+    return ' '.join(f'"{term}"' for term in terms) + '*'
+
+def build_search_query(columns, visibility, with_type=False):
+    """Truy vấn tìm kiếm theo thứ hạng bm25; visibility là điều kiện lọc trên s"""
+    query = f'''
+        SELECT {columns}
+        FROM scenarios_fts
+        JOIN automation_scenarios s ON s.id = scenarios_fts.rowid
+        LEFT JOIN users u ON s.created_by = u.id
+        WHERE scenarios_fts MATCH ? AND {visibility}
+    '''
+    if with_type:
+        query += ' AND s.workflow_type = ?'
+    return query
+
+def search_visibility(user_id, role):
+    """Điều kiện và tham số để chỉ trả về scenario mà người gọi được xem"""
+    if role == 'admin':
+        return '1 = 1', []
+    if user_id is not None:
+        return '(s.is_public = 1 OR s.created_by = ?)', [user_id]
+    return 's.is_public = 1', []
+
+def audit_query_plans(conn):
+    """Kiểm tra bằng EXPLAIN QUERY PLAN rằng truy vấn danh sách chỉ đọc bằng SEARCH trên index
+    (không SCAN bảng hay index) và không sort bằng temp B-tree; trả về danh sách (tên truy vấn, bước vi phạm)"""
+    listing_queries = {
+        'automation': (AUTOMATION_PAGE_QUERY, (0, 1, 0)),
+        'admin': (ADMIN_PAGE_QUERY, (1, 0)),
+        'page_rows': (build_page_rows_query(2), (1, 2)),
+        'api_public': (build_public_list_query(SCENARIO_LIST_FIELDS), ()),
+        'api_public_page': (build_public_list_query(SCENARIO_LIST_FIELDS, True, True), ('', 0, 1)),
+        'api_public_type_page': (build_public_list_query(SCENARIO_LIST_FIELDS, True, True, True), ('visual', '', 0, 1)),
+        'public_count': ('SELECT COUNT(*) FROM automation_scenarios WHERE is_public = 1', ()),
+    }
+    
+    problems = []
+    for name, (query, params) in listing_queries.items():
+        for row in conn.execute(f'EXPLAIN QUERY PLAN {query}', params).fetchall():
+            detail = row['detail']
+            # SCAN ... USING INDEX vẫn là duyệt cả index, với OFFSET thì không dừng sớm được
+            if detail.startswith('SCAN') or 'TEMP B-TREE' in detail:
+                problems.append((name, detail))
+    return problems
+
+def build_pagination(total):
+    """Thông tin phân trang cho ?page= của trang web"""
+    per_page = app.config['PAGE_SIZE']
+    pages = max((total + per_page - 1) // per_page, 1)
+    page = min(max(request.args.get('page', 1, type=int), 1), pages)
+    return {
+        'page': page,
+        'pages': pages,
+        'per_page': per_page,
+        'offset': (page - 1) * per_page,
+        'total': total,
+        'has_prev': page > 1,
+        'has_next': page < pages
+    }
+
 # Routes cho giao diện web
 @app.route('/')
 def index():
@@ -110,11 +2133,7 @@ def index():
     if 'user_id' not in session:
         return redirect(url_for('login'))
     
-    conn = get_db_connection()
-    user = conn.execute('SELECT role FROM users WHERE id = ?', (session['user_id'],)).fetchone()
-    conn.close()
-    
-    if user and user['role'] == 'admin':
+    if get_session_role() == 'admin':
         return redirect(url_for('admin'))
     else:
         return redirect(url_for('automation'))  # Updated redirect to automation
@@ -131,12 +2150,12 @@ def login():
             'SELECT id, username, password_hash, role FROM users WHERE username = ?', 
             (username,)
         ).fetchone()
-        conn.close()
         
         if user and check_password_hash(user['password_hash'], password):
             session['user_id'] = user['id']
             session['username'] = user['username']
             session['role'] = user['role']
+            session['role_checked_at'] = time.time()
             
             flash(f'Welcome back, {username}!', 'success')
             
@@ -161,19 +2180,33 @@ def logout():
 def automation():
     """Trang chính cho user"""
     conn = get_db_connection()
+    search = request.args.get('q', '').strip()
+    match = build_search_match(search)
     
-    # Lấy các scenario công khai và của user hiện tại
-    scenarios = conn.execute('''
-        SELECT s.*, u.username as creator_name
-        FROM automation_scenarios s
-        LEFT JOIN users u ON s.created_by = u.id
-        WHERE s.is_public = 1 OR s.created_by = ?
-        ORDER BY s.updated_at DESC
-    ''', (session['user_id'],)).fetchall()
-    
-    conn.close()
+    if match is not None:
+        # Tìm kiếm: chỉ các scenario khớp, xếp theo độ liên quan
+        refresh_search_index(conn)
+        visibility, params = search_visibility(session['user_id'], None)
+        total = conn.execute(build_search_query('COUNT(*)', visibility), [match, *params]).fetchone()[0]
+        pagination = build_pagination(total)
+        scenarios = conn.execute(
+            build_search_query(PAGE_COLUMNS, visibility) + ' ORDER BY scenarios_fts.rank LIMIT ? OFFSET ?',
+            [match, *params, pagination['per_page'], pagination['offset']]
+        ).fetchall()
+    else:
+        # Số scenario nhìn thấy = công khai + riêng tư của user, lấy từ bảng thống kê
+        stats = get_admin_stats(conn)
+        own = conn.execute('SELECT total, public FROM user_scenario_stats WHERE user_id = ?',
+                           (session['user_id'],)).fetchone()
+        total = stats['public_scenarios'] + (own['total'] - own['public'] if own else 0)
+        pagination = build_pagination(total)
+        
+        # Lấy các scenario công khai và của user hiện tại
+        scenarios = load_page_rows(conn, AUTOMATION_PAGE_QUERY, (
+            session['user_id'], pagination['per_page'], pagination['offset']
+        ))
     
-    return render_template('automation.html', scenarios=scenarios)  # Updated render template to automation.html
+    return render_template('automation.html', scenarios=scenarios, pagination=pagination, search=search)  # Updated render template to automation.html
 
 @app.route('/admin')
 @admin_required
@@ -181,78 +2214,405 @@ def admin():
     """Trang quản trị admin"""
     conn = get_db_connection()
     
-    # Lấy tất cả scenarios
-    scenarios = conn.execute('''
-        SELECT s.*, u.username as creator_name
-        FROM automation_scenarios s
-        LEFT JOIN users u ON s.created_by = u.id
-        ORDER BY s.updated_at DESC
-    ''').fetchall()
-    
     # Lấy thống kê
-    stats = {}
-    stats['total_scenarios'] = conn.execute('SELECT COUNT(*) FROM automation_scenarios').fetchone()[0]
-    stats['public_scenarios'] = conn.execute('SELECT COUNT(*) FROM automation_scenarios WHERE is_public = 1').fetchone()[0]
-    stats['total_users'] = conn.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+    stats = get_admin_stats(conn)
+    pagination = build_pagination(stats['total_scenarios'])
     
-    conn.close()
+    # Lấy scenarios của trang hiện tại
+    scenarios = load_page_rows(conn, ADMIN_PAGE_QUERY, (pagination['per_page'], pagination['offset']))
+    
+    return render_template('admin.html', scenarios=scenarios, stats=stats, pagination=pagination)
+
+@app.route('/api/admin/stats')
+@admin_required
+def api_admin_stats():
+    """API: Thống kê tổng hợp cho dashboard và monitoring"""
+    conn = get_db_connection()
+    stats = get_admin_stats(conn)
+    
+    users = conn.execute('''
+        SELECT st.user_id, u.username, st.total, st.public
+        FROM user_scenario_stats st
+        LEFT JOIN users u ON st.user_id = u.id
+        WHERE st.total > 0
+        ORDER BY st.total DESC
+    ''').fetchall()
+    stats['users'] = [dict(user) for user in users]
     
-    return render_template('admin.html', scenarios=scenarios, stats=stats)
+    return jsonify(stats)
 
 # API Routes
+def get_catalog_version(conn):
+    """Lấy version và thời điểm thay đổi cuối của catalogue scenario"""
+    meta = dict(conn.execute('''
+        SELECT key, value FROM app_meta
+        WHERE key IN ('scenarios_version', 'scenarios_modified_at')
+    ''').fetchall())
+    modified_at = datetime.fromtimestamp(meta.get('scenarios_modified_at', 0), timezone.utc)
+    return meta.get('scenarios_version', 0), modified_at
+
+def with_validators(response, etag, last_modified=None):
+    """Gắn ETag / Last-Modified để client có thể gửi conditional GET"""
+    # Bản nén khác bản gốc từng byte nên chỉ dùng ETag yếu
+    response.set_etag(etag, weak='Content-Encoding' in response.headers)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def not_modified_response(etag, last_modified=None):
+    """Trả về 304 nếu bản client đang giữ vẫn còn mới, ngược lại trả về None"""
+    if request.if_none_match:
+        if not request.if_none_match.contains_weak(etag):
+            return None
+    elif last_modified is None or request.if_modified_since is None:
+        return None
+    elif last_modified > request.if_modified_since:
+        return None
+    
+    return with_validators(app.response_class(status=304), etag, last_modified)
+
+# Các trường client có thể chọn qua ?fields=, id luôn được trả về
+SCENARIO_LIST_FIELDS = (
+    'id', 'name', 'description', 'steps', 'is_public', 'created_at', 'updated_at',
+    'workflow_type', 'node_count', 'needs_upload', 'needs_download', 'uses_tabs'
+)
+# Trường metadata kiểu boolean (lưu dạng 0/1)
+BOOLEAN_FIELDS = ('is_public', 'needs_upload', 'needs_download', 'uses_tabs')
+WORKFLOW_TYPES = ('linear', 'visual')
+MAX_PAGE_SIZE = 500
+
+def encode_cursor(updated_at, scenario_id):
+    """Mã hóa vị trí (updated_at, id) thành cursor cho trang kế tiếp"""
+    raw = json.dumps([updated_at, scenario_id]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    """Giải mã cursor, trả về (updated_at, id)"""
+    padded = cursor + '=' * (-len(cursor) % 4)
+    updated_at, scenario_id = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    return str(updated_at), int(scenario_id)
+
+def parse_field_names(value):
+    """Các trường được yêu cầu từ chuỗi 'id,name' hoặc list tên trường, mặc định mọi trường"""
+    if not value:
+        return SCENARIO_LIST_FIELDS
+    if isinstance(value, str):
+        value = value.split(',')
+    elif not isinstance(value, list) or not all(isinstance(field, str) for field in value):
+        raise ValueError('fields must be a comma-separated string or a list of strings')
+    
+    requested = {field.strip() for field in value if field.strip()}
+    unknown = requested - set(SCENARIO_LIST_FIELDS)
+    if unknown:
+        raise ValueError(f'Unknown fields: {", ".join(sorted(unknown))}')
+    return tuple(field for field in SCENARIO_LIST_FIELDS if field in requested or field == 'id')
+
+def parse_fields_param():
+    """Đọc ?fields=, mặc định trả về mọi trường"""
+    return parse_field_names(request.args.get('fields'))
+
+def parse_list_params():
+    """Đọc limit / cursor / fields từ query string"""
+    limit = request.args.get('limit', type=int)
+    if limit is not None and not 1 <= limit <= MAX_PAGE_SIZE:
+        raise ValueError(f'limit must be between 1 and {MAX_PAGE_SIZE}')
+    
+    cursor = None
+    if request.args.get('cursor'):
+        try:
+            cursor = decode_cursor(request.args['cursor'])
+        except Exception:
+            raise ValueError('Invalid cursor')
+        if limit is None:
+            limit = MAX_PAGE_SIZE
+    
+    fields = parse_fields_param()
+    
+    workflow_type = request.args.get('workflow_type')
+    if workflow_type is not None and workflow_type not in WORKFLOW_TYPES:
+        raise ValueError(f'workflow_type must be one of: {", ".join(WORKFLOW_TYPES)}')
+    
+    return limit, cursor, fields, workflow_type
+
 @app.route('/api/scenarios', methods=['GET'])
 def api_get_scenarios():
-    """API: Lấy danh sách scenarios công khai"""
+    """API: Lấy danh sách scenarios công khai (hỗ trợ limit/cursor/fields)"""
+    try:
+        limit, cursor, fields, workflow_type = parse_list_params()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
     conn = get_db_connection()
-    scenarios = conn.execute('''
-        SELECT id, name, description, steps, is_public, created_at, updated_at
-        FROM automation_scenarios 
-        WHERE is_public = 1
-        ORDER BY updated_at DESC
-    ''').fetchall()
-    conn.close()
+    
+    # Catalogue chưa đổi thì chỉ tốn một lần tra app_meta
+    version, modified_at = get_catalog_version(conn)
+    etag = f'scenarios-{version}'
+    if request.query_string:
+        etag += f'-{zlib.crc32(request.query_string):08x}'
+    
+    not_modified = not_modified_response(etag, modified_at)
+    if not_modified:
+        return not_modified
+    
+    # Trang đã serialize cho đúng version và query string này
+    cache_key = ('list', version, request.query_string)
+    cached_page = scenario_cache.get(cache_key)
+    if cached_page is None:
+        cached_page = build_scenario_list_page(conn, limit, cursor, fields, workflow_type)
+        # Chừa chỗ cho các bản nén được thêm vào payload sau này
+        scenario_cache.put(cache_key, cached_page, len(cached_page[0].body) * 2)
+    payload, next_cursor = cached_page
+    
+    response = with_validators(json_body_response(payload), etag, modified_at)
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+        next_args = request.args.to_dict()
+        next_args.update(cursor=next_cursor, limit=limit)
+        response.headers['Link'] = f'<{url_for("api_get_scenarios", **next_args)}>; rel="next"'
+    return response
+
+def build_scenario_list_page(conn, limit, cursor, fields, workflow_type=None):
+    """Đọc một trang danh sách, trả về (EncodedPayload, cursor trang sau)"""
+    # Luôn đọc updated_at để tạo cursor; steps lấy từ cache scenario thay vì parse lại
+    columns = [field for field in fields if field != 'steps']
+    columns += [field for field in ('updated_at', 'revision') if field not in columns]
+    query = build_public_list_query(columns, cursor is not None, limit is not None, workflow_type is not None)
+    params = []
+    
+    if workflow_type is not None:
+        params.append(workflow_type)
+    
+    if cursor:
+        params.extend(cursor)
+    
+    if limit is not None:
+        # Lấy dư một dòng để biết còn trang sau hay không
+        params.append(limit + 1)
+    
+    scenarios = conn.execute(query, params).fetchall()
+    
+    next_cursor = None
+    if limit is not None and len(scenarios) > limit:
+        scenarios = scenarios[:limit]
+        next_cursor = encode_cursor(scenarios[-1]['updated_at'], scenarios[-1]['id'])
+    
+    parsed = {}
+    if 'steps' in fields:
+        parsed = load_cached_scenarios([scenario['id'] for scenario in scenarios])
     
     result = []
     for scenario in scenarios:
-        steps_data = json.loads(scenario['steps']) if scenario['steps'] else []
-        result.append({
-            'id': scenario['id'],
-            'name': scenario['name'],
-            'description': scenario['description'],
-            'steps': steps_data,
-            'is_public': bool(scenario['is_public']),
-            'created_at': scenario['created_at'],
-            'updated_at': scenario['updated_at']
-        })
+        item = {field: scenario[field] for field in fields if field != 'steps'}
+        if 'steps' in fields:
+            cached = parsed.get(scenario['id'])
+            if cached is None or cached.revision != scenario['revision']:
+                # Dòng vừa bị ghi đè giữa hai lần đọc, lấy lại bản mới
+                scenario_cache.invalidate(scenario['id'])
+                cached = load_cached_scenario(scenario['id'])
+            item['steps'] = cached.record['steps'] if cached else []
+        for field in BOOLEAN_FIELDS:
+            if field in item:
+                item[field] = bool(item[field])
+        result.append(item)
     
-    return jsonify(result)
+    return EncodedPayload(app.json.dumps(result).encode('utf-8')), next_cursor
+
+# Dòng thay đổi của catalogue công khai theo thứ tự revision: scenario còn công khai
+# là cập nhật, scenario đã xóa hoặc chuyển sang riêng tư là bị gỡ. Tin gỡ chỉ dành cho
+# scenario đã công khai từ trước ?since= (client có thể đã thấy), các dòng riêng tư khác bị lọc bỏ
+CHANGE_FEED_QUERY = '''
+    SELECT id, revision, is_public AS live FROM automation_scenarios
+    WHERE revision > ? AND revision <= ? AND (is_public = 1 OR published_revision <= ?)
+    UNION ALL
+    SELECT scenario_id, revision, 0 FROM scenario_tombstones
+    WHERE revision > ? AND revision <= ? AND published_revision <= ?
+    ORDER BY revision
+    LIMIT ?
+'''
+
+@app.route('/api/scenarios/changes', methods=['GET'])
+def api_get_scenario_changes():
+    """API: Các thay đổi của catalogue công khai sau revision ?since= (hỗ trợ limit/fields)"""
+    since = request.args.get('since', 0, type=int)
+    limit = request.args.get('limit', MAX_PAGE_SIZE, type=int)
+    if since < 0 or not 1 <= limit <= MAX_PAGE_SIZE:
+        return jsonify({'error': f'since must not be negative, limit must be between 1 and {MAX_PAGE_SIZE}'}), 400
+    try:
+        fields = parse_fields_param()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    conn = get_db_connection()
+    # Cố định version trước để trang này không lẫn các lần ghi đang diễn ra
+    version, _ = get_catalog_version(conn)
+    # Lấy dư một dòng để biết còn trang sau hay không
+    rows = conn.execute(CHANGE_FEED_QUERY, (since, version, since, since, version, since, limit + 1)).fetchall()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    
+    live_ids = [row['id'] for row in rows if row['live']]
+    current = {}
+    if live_ids:
+        columns = [field for field in fields if field != 'steps']
+        columns += [field for field in ('revision', 'is_public') if field not in columns]
+        current = {row['id']: row for row in conn.execute(f'''
+            SELECT {', '.join(columns)} FROM automation_scenarios
+            WHERE id IN ({', '.join('?' * len(live_ids))})
+        ''', live_ids).fetchall()}
+    parsed = load_cached_scenarios(live_ids) if live_ids and 'steps' in fields else {}
+    
+    changes = []
+    for row in rows:
+        scenario = current.get(row['id'])
+        if not row['live'] or scenario is None or not scenario['is_public']:
+            # Lần đồng bộ đầu tiên không cần biết những gì đã bị gỡ
+            if since:
+                changes.append({'id': row['id'], 'revision': row['revision'], 'deleted': True})
+            continue
+        
+        item = {field: scenario[field] for field in fields if field != 'steps'}
+        if 'steps' in fields:
+            cached = parsed.get(row['id'])
+            if cached is None or cached.revision != scenario['revision']:
+                scenario_cache.invalidate(row['id'])
+                cached = load_cached_scenario(row['id'])
+            item['steps'] = cached.record['steps'] if cached else []
+        for field in BOOLEAN_FIELDS:
+            if field in item:
+                item[field] = bool(item[field])
+        item['revision'] = scenario['revision']
+        item['deleted'] = False
+        changes.append(item)
+    
+    return jsonify({
+        'changes': changes,
+        # Client gửi lại giá trị này làm ?since= cho lần đồng bộ sau
+        'revision': rows[-1]['revision'] if has_more else version,
+        'has_more': has_more
+    })
+
+@app.route('/api/scenarios/search', methods=['GET'])
+def api_search_scenarios():
+    """API: Tìm kiếm toàn văn, kết quả xếp theo độ liên quan (hỗ trợ limit/offset)"""
+    match = build_search_match(request.args.get('q', ''))
+    if match is None:
+        return jsonify({'error': 'Missing search query: q'}), 400
+    
+    limit = request.args.get('limit', 20, type=int)
+    offset = request.args.get('offset', 0, type=int)
+    if not 1 <= limit <= MAX_PAGE_SIZE or offset < 0:
+        return jsonify({'error': f'limit must be between 1 and {MAX_PAGE_SIZE}, offset must not be negative'}), 400
+    
+    workflow_type = request.args.get('workflow_type')
+    if workflow_type is not None and workflow_type not in WORKFLOW_TYPES:
+        return jsonify({'error': f'workflow_type must be one of: {", ".join(WORKFLOW_TYPES)}'}), 400
+    
+    # Người chưa đăng nhập chỉ thấy scenario công khai
+    visibility, params = search_visibility(session.get('user_id'), get_session_role())
+    query = build_search_query(
+        ', '.join(f's.{field}' for field in SEARCH_RESULT_FIELDS),
+        visibility, workflow_type is not None
+    )
+    query += ' ORDER BY scenarios_fts.rank LIMIT ? OFFSET ?'
+    params = [match, *params]
+    if workflow_type is not None:
+        params.append(workflow_type)
+    
+    conn = get_db_connection()
+    refresh_search_index(conn)
+    # Lấy dư một dòng để biết còn trang sau hay không
+    rows = conn.execute(query, [*params, limit + 1, offset]).fetchall()
+    
+    results = []
+    for row in rows[:limit]:
+        item = dict(row)
+        for field in BOOLEAN_FIELDS:
+            item[field] = bool(item[field])
+        results.append(item)
+    
+    response = jsonify(results)
+    if len(rows) > limit:
+        next_args = request.args.to_dict()
+        next_args.update(limit=limit, offset=offset + limit)
+        response.headers['Link'] = f'<{url_for("api_search_scenarios", **next_args)}>; rel="next"'
+    return response
 
 @app.route('/api/scenarios/<int:scenario_id>', methods=['GET'])
 def api_get_scenario(scenario_id):
     """API: Lấy chi tiết một scenario"""
-    conn = get_db_connection()
-    scenario = conn.execute('''
-        SELECT id, name, description, steps, is_public, created_at, updated_at
-        FROM automation_scenarios 
-        WHERE id = ? AND is_public = 1
-    ''', (scenario_id,)).fetchone()
-    conn.close()
+    scenario = load_cached_scenario(scenario_id)
     
-    if not scenario:
+    if not scenario or not scenario.is_public:
         return jsonify({'error': 'Scenario not found or not public'}), 404
     
-    steps_data = json.loads(scenario['steps']) if scenario['steps'] else []
-    result = {
-        'id': scenario['id'],
-        'name': scenario['name'],
-        'description': scenario['description'],
-        'steps': steps_data,
-        'is_public': bool(scenario['is_public']),
-        'created_at': scenario['created_at'],
-        'updated_at': scenario['updated_at']
-    }
+    etag = f'scenario-{scenario_id}-{scenario.revision}'
+    not_modified = not_modified_response(etag)
+    if not_modified:
+        return not_modified
     
-    return jsonify(result)
+    return with_validators(json_body_response(scenario.public_payload), etag)
+
+@app.route('/api/scenarios/<int:scenario_id>/plan', methods=['GET'])
+def api_get_scenario_plan(scenario_id):
+    """API: Execution plan đã biên dịch sẵn, runner thực thi plan.steps theo thứ tự"""
+    scenario = load_cached_scenario(scenario_id)
+    if not scenario or not can_read_scenario(scenario):
+        return jsonify({'error': 'Scenario not found or not public'}), 404
+    
+    etag = f'plan-{scenario_id}-{scenario.revision}-v{PLAN_VERSION}'
+    not_modified = not_modified_response(etag)
+    if not_modified:
+        return not_modified
+    
+    response = with_validators(json_body_response(scenario.plan_payload), etag)
+    response.headers['X-Scenario-Revision'] = str(scenario.revision)
+    return response
+
+def parse_id_list(values):
+    """Danh sách id duy nhất (giữ thứ tự) từ body JSON, tối đa MAX_PAGE_SIZE"""
+    if not isinstance(values, list) or not values:
+        raise ValueError('ids must be a non-empty list')
+    if len(values) > MAX_PAGE_SIZE:
+        raise ValueError(f'At most {MAX_PAGE_SIZE} ids per request')
+    if not all(isinstance(value, int) and not isinstance(value, bool) for value in values):
+        raise ValueError('ids must be integers')
+    return list(dict.fromkeys(values))
+
+@app.route('/api/scenarios/batch-get', methods=['POST'])
+def api_batch_get_scenarios():
+    """API: Lấy nhiều scenario trong một request (ids -> documents)"""
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Request body must be a JSON object'}), 400
+    try:
+        scenario_ids = parse_id_list(data.get('ids'))
+        fields = parse_field_names(data.get('fields'))
+    except (ValueError, TypeError) as e:
+        return jsonify({'error': str(e)}), 400
+    
+    conn = get_db_connection()
+    # Một snapshot cho mọi scenario chưa có trong cache
+    conn.execute('BEGIN')
+    try:
+        found = load_cached_scenarios(scenario_ids)
+    finally:
+        conn.rollback()
+    
+    # Một lần kiểm tra quyền cho cả request: như /api/scenarios/search
+    user_id = session.get('user_id')
+    is_admin = get_session_role() == 'admin'
+    
+    scenarios = []
+    missing = []
+    for scenario_id in scenario_ids:
+        cached = found.get(scenario_id)
+        if cached is None or not (cached.is_public or is_admin or (user_id is not None and cached.created_by == user_id)):
+            missing.append(scenario_id)
+            continue
+        scenarios.append({field: cached.record[field] for field in fields})
+    
+    return jsonify({'scenarios': scenarios, 'missing': missing})
 
 # Thêm route này vào server.py
 @app.route('/api/scenarios/<int:scenario_id>/edit', methods=['GET'])
@@ -260,43 +2620,18 @@ def api_get_scenario(scenario_id):
 def api_get_scenario_for_edit(scenario_id):
     """API: Lấy chi tiết scenario để edit"""
     try:
-        conn = get_db_connection()
-        
         # Kiểm tra quyền truy cập
-        scenario = conn.execute('''
-            SELECT s.*, u.username as creator_name
-            FROM automation_scenarios s
-            LEFT JOIN users u ON s.created_by = u.id
-            WHERE s.id = ?
-        ''', (scenario_id,)).fetchone()
+        scenario = load_cached_scenario(scenario_id)
         
         if not scenario:
-            conn.close()
             return jsonify({'error': 'Scenario not found'}), 404
         
-        user = conn.execute('SELECT role FROM users WHERE id = ?', (session['user_id'],)).fetchone()
-        
         # Kiểm tra quyền: chỉ owner hoặc admin mới có thể edit
-        if scenario['created_by'] != session['user_id'] and user['role'] != 'admin':
-            conn.close()
+        if scenario.created_by != session['user_id'] and get_session_role() != 'admin':
             return jsonify({'error': 'Permission denied'}), 403
         
-        conn.close()
-        
-        # Parse steps data
-        steps_data = json.loads(scenario['steps']) if scenario['steps'] else []
-        
-        result = {
-            'id': scenario['id'],
-            'name': scenario['name'],
-            'description': scenario['description'] or '',
-            'steps': steps_data,
-            'is_public': bool(scenario['is_public']),
-            'created_by': scenario['created_by'],
-            'creator_name': scenario['creator_name'],
-            'created_at': scenario['created_at'],
-            'updated_at': scenario['updated_at']
-        }
+        result = dict(scenario.record)
+        result['description'] = result['description'] or ''
         
         return jsonify(result)
         
@@ -307,7 +2642,10 @@ def api_get_scenario_for_edit(scenario_id):
 @login_required
 def update_scenario():
     # Lấy dữ liệu từ form
-    scenario_id = request.form['id']
+    try:
+        scenario_id = int(request.form['id'])
+    except ValueError:
+        return jsonify({'error': 'Invalid scenario id'}), 400
     name = request.form['name']
     description = request.form['description']
     
@@ -317,8 +2655,9 @@ def update_scenario():
         SET name = ?, description = ? 
         WHERE id = ?
     ''', (name, description, scenario_id))
+    record_scenario_revisions(conn, [scenario_id])
     conn.commit()
-    conn.close()
+    scenario_cache.invalidate(scenario_id)
     
     return jsonify({'message': 'Workflow updated successfully'}), 200
 
@@ -332,25 +2671,22 @@ def api_create_scenario():
         
         if not data or 'name' not in data or 'steps' not in data:
             return jsonify({'error': 'Missing required fields: name, steps'}), 400
+        if not isinstance(data.get('is_public', False), bool):
+            return jsonify({'error': 'is_public must be a boolean'}), 400
         
         conn = get_db_connection()
         cursor = conn.cursor()
         
-        cursor.execute('''
-            INSERT INTO automation_scenarios (name, description, steps, is_public, created_by, updated_at)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (
+        scenario_id = insert_scenario(
+            cursor,
             data['name'],
             data.get('description', ''),
-            json.dumps(data['steps']),
+            data['steps'],
             data.get('is_public', False),
-            session['user_id'],
-            datetime.now().isoformat()
-        ))
-        
-        scenario_id = cursor.lastrowid
+            session['user_id']
+        )
         conn.commit()
-        conn.close()
+        scenario_cache.invalidate(scenario_id)
         
         return jsonify({'id': scenario_id, 'message': 'Scenario created successfully'}), 201
         
@@ -366,6 +2702,8 @@ def api_update_scenario(scenario_id):
         
         if not data:
             return jsonify({'error': 'No data provided'}), 400
+        if not isinstance(data.get('is_public', False), bool):
+            return jsonify({'error': 'is_public must be a boolean'}), 400
         
         conn = get_db_connection()
         
@@ -375,13 +2713,9 @@ def api_update_scenario(scenario_id):
         ''', (scenario_id,)).fetchone()
         
         if not scenario:
-            conn.close()
             return jsonify({'error': 'Scenario not found'}), 404
         
-        user = conn.execute('SELECT role FROM users WHERE id = ?', (session['user_id'],)).fetchone()
-        
-        if scenario['created_by'] != session['user_id'] and user['role'] != 'admin':
-            conn.close()
+        if scenario['created_by'] != session['user_id'] and get_session_role() != 'admin':
             return jsonify({'error': 'Permission denied'}), 403
         
         # Cập nhật scenario
@@ -397,8 +2731,9 @@ def api_update_scenario(scenario_id):
             update_values.append(data['description'])
         
         if 'steps' in data:
-            update_fields.append('steps = ?')
-            update_values.append(json.dumps(data['steps']))
+            for column, value in scenario_steps_columns(data['steps']).items():
+                update_fields.append(f'{column} = ?')
+                update_values.append(value)
         
         if 'is_public' in data:
             update_fields.append('is_public = ?')
@@ -413,15 +2748,256 @@ def api_update_scenario(scenario_id):
             SET {', '.join(update_fields)}
             WHERE id = ?
         ''', update_values)
+        record_scenario_revisions(conn, [scenario_id])
         
         conn.commit()
-        conn.close()
+        scenario_cache.invalidate(scenario_id)
+        collect_step_blobs_if_due(conn)
         
         return jsonify({'message': 'Scenario updated successfully'})
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+class JsonPatchError(ValueError):
+    """Patch không hợp lệ hoặc không áp dụng được lên document"""
+
+class JsonPatchTestFailed(JsonPatchError):
+    """Thao tác test của patch không khớp với document hiện tại"""
+
+# Các trường của scenario có thể sửa bằng PATCH, cùng kiểu hợp lệ sau khi áp dụng
+PATCHABLE_FIELDS = {
+    'name': (str,),
+    'description': (str, type(None)),
+    'is_public': (bool,),
+    'steps': (list, dict),
+}
+
+def parse_json_pointer(pointer):
+    """Tách JSON Pointer (RFC 6901) thành danh sách token"""
+    if pointer == '':
+        return []
+    if not isinstance(pointer, str) or not pointer.startswith('/'):
+        raise JsonPatchError(f'Invalid JSON pointer: {pointer!r}')
+    return [token.replace('~1', '/').replace('~0', '~') for token in pointer[1:].split('/')]
+
+def _resolve_parent(document, tokens, pointer):
+    """Trả về container chứa phần tử cuối của pointer"""
+    target = document
+    for token in tokens[:-1]:
+        try:
+            target = target[_array_index(target, token, pointer) if isinstance(target, list) else token]
+        except (KeyError, IndexError, TypeError):
+            raise JsonPatchError(f'Path not found: {pointer}')
+    if not isinstance(target, (dict, list)):
+        raise JsonPatchError(f'Path not found: {pointer}')
+    return target
+
+def _array_index(array, token, pointer, allow_end=False):
+    """Chỉ số mảng hợp lệ từ token ('-' là cuối mảng khi thêm)"""
+    if allow_end and token == '-':
+        return len(array)
+    if not token.isdigit() or (len(token) > 1 and token.startswith('0')):
+        raise JsonPatchError(f'Invalid array index in {pointer}')
+    index = int(token)
+    if index > len(array) or (index == len(array) and not allow_end):
+        raise JsonPatchError(f'Array index out of range in {pointer}')
+    return index
+
+def _get_value(document, pointer):
+    tokens = parse_json_pointer(pointer)
+    if not tokens:
+        return document
+    parent = _resolve_parent(document, tokens, pointer)
+    try:
+        if isinstance(parent, list):
+            return parent[_array_index(parent, tokens[-1], pointer)]
+        return parent[tokens[-1]]
+    except KeyError:
+        raise JsonPatchError(f'Path not found: {pointer}')
+
+def _add_value(document, pointer, value):
+    tokens = parse_json_pointer(pointer)
+    if not tokens:
+        return value
+    parent = _resolve_parent(document, tokens, pointer)
+    if isinstance(parent, list):
+        parent.insert(_array_index(parent, tokens[-1], pointer, allow_end=True), value)
+    else:
+        parent[tokens[-1]] = value
+    return document
+
+def _remove_value(document, pointer):
+    tokens = parse_json_pointer(pointer)
+    if not tokens:
+        raise JsonPatchError('Cannot remove the whole document')
+    parent = _resolve_parent(document, tokens, pointer)
+    try:
+        if isinstance(parent, list):
+            return parent.pop(_array_index(parent, tokens[-1], pointer))
+        return parent.pop(tokens[-1])
+    except KeyError:
+        raise JsonPatchError(f'Path not found: {pointer}')
+
+def apply_json_patch(document, operations):
+    """Áp dụng patch RFC 6902 lên bản sao của document, trả về document mới"""
+    if not isinstance(operations, list):
+        raise JsonPatchError('Patch must be a JSON array of operations')
+    
+    document = copy.deepcopy(document)
+    for operation in operations:
+        if not isinstance(operation, dict) or 'path' not in operation:
+            raise JsonPatchError('Each operation must be an object with op and path')
+        op = operation.get('op')
+        path = operation['path']
+        
+        if op in ('add', 'replace', 'test') and 'value' not in operation:
+            raise JsonPatchError(f'Operation {op} requires a value')
+        if op in ('move', 'copy') and 'from' not in operation:
+            raise JsonPatchError(f'Operation {op} requires from')
+        
+        if op == 'add':
+            document = _add_value(document, path, copy.deepcopy(operation['value']))
+        elif op == 'remove':
+            _remove_value(document, path)
+        elif op == 'replace':
+            if not parse_json_pointer(path):
+                document = copy.deepcopy(operation['value'])
+            else:
+                _remove_value(document, path)
+                document = _add_value(document, path, copy.deepcopy(operation['value']))
+        elif op == 'move':
+            source = operation['from']
+            if path != source and path.startswith(source + '/'):
+                raise JsonPatchError(f'Cannot move {source} into its own child')
+            document = _add_value(document, path, _remove_value(document, source))
+        elif op == 'copy':
+            document = _add_value(document, path, copy.deepcopy(_get_value(document, operation['from'])))
+        elif op == 'test':
+            current = _get_value(document, path)
+            # So sánh kiểu JSON: true khác 1
+            if current != operation['value'] or type(current) is not type(operation['value']):
+                raise JsonPatchTestFailed(f'Test failed at {path}')
+        else:
+            raise JsonPatchError(f'Unknown operation: {op!r}')
+    return document
+
+def parse_if_match_revision(scenario_id):
+    """Revision mà client yêu cầu từ header If-Match (ETag scenario-<id>-<revision>
+    hoặc số revision), None nếu không có"""
+    if not request.if_match:
+        return None
+    for etag in request.if_match.as_set(include_weak=True):
+        prefix = f'scenario-{scenario_id}-'
+        value = etag[len(prefix):] if etag.startswith(prefix) else etag
+        if value.isdigit():
+            return int(value)
+    return -1
+
+@app.route('/api/scenarios/<int:scenario_id>', methods=['PATCH'])
+@login_required
+def api_patch_scenario(scenario_id):
+    """API: Sửa một phần scenario bằng JSON Patch (RFC 6902), kiểm tra revision
+    qua If-Match hoặc trường revision để không ghi đè thay đổi của người khác"""
+    data = request.get_json(force=True, silent=True)
+    if isinstance(data, dict):
+        operations = data.get('patch')
+        expected_revision = data.get('revision')
+    else:
+        operations = data
+        expected_revision = None
+    if expected_revision is not None and (not isinstance(expected_revision, int) or isinstance(expected_revision, bool)):
+        return jsonify({'error': 'revision must be an integer'}), 400
+    if expected_revision is None:
+        expected_revision = parse_if_match_revision(scenario_id)
+    if expected_revision is None:
+        return jsonify({'error': 'Missing revision: send If-Match or a revision field'}), 428
+    
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        # Giữ khóa ghi từ lúc đọc tới lúc ghi để kiểm tra revision là nguyên tử
+        cursor.execute('BEGIN IMMEDIATE')
+        scenario = cursor.execute('''
+            SELECT name, description, is_public, steps, created_by, revision
+            FROM automation_scenarios WHERE id = ?
+        ''', (scenario_id,)).fetchone()
+        
+        if not scenario:
+            conn.rollback()
+            return jsonify({'error': 'Scenario not found'}), 404
+        
+        if scenario['created_by'] != session['user_id'] and get_session_role() != 'admin':
+            conn.rollback()
+            return jsonify({'error': 'Permission denied'}), 403
+        
+        if scenario['revision'] != expected_revision:
+            conn.rollback()
+            return jsonify({
+                'error': 'Scenario was modified by someone else',
+                'revision': scenario['revision']
+            }), 412
+        
+        document = {
+            'name': scenario['name'],
+            'description': scenario['description'],
+            'is_public': bool(scenario['is_public']),
+            'steps': decode_steps(scenario['steps'], conn)
+        }
+        try:
+            patched = apply_json_patch(document, operations)
+        except JsonPatchTestFailed as e:
+            conn.rollback()
+            return jsonify({'error': str(e)}), 409
+        except JsonPatchError as e:
+            conn.rollback()
+            return jsonify({'error': str(e)}), 400
+        
+        if not isinstance(patched, dict) or set(patched) != set(PATCHABLE_FIELDS):
+            conn.rollback()
+            return jsonify({'error': f'Patch may only modify: {", ".join(PATCHABLE_FIELDS)}'}), 400
+        for field, types in PATCHABLE_FIELDS.items():
+            if not isinstance(patched[field], types):
+                conn.rollback()
+                return jsonify({'error': f'Invalid type for {field}'}), 400
+        if not patched['name'].strip():
+            conn.rollback()
+            return jsonify({'error': 'Name is required'}), 400
+        
+        # Chỉ ghi các cột thực sự thay đổi
+        columns = {
+            field: patched[field]
+            for field in ('name', 'description', 'is_public')
+            if patched[field] != document[field]
+        }
+        if patched['steps'] != document['steps']:
+            columns.update(scenario_steps_columns(patched['steps'], conn))
+        if not columns:
+            conn.rollback()
+            return jsonify({'message': 'No changes', 'revision': scenario['revision']})
+        
+        columns['updated_at'] = datetime.now().isoformat()
+        cursor.execute(f'''
+            UPDATE automation_scenarios
+            SET {', '.join(f'{column} = ?' for column in columns)}
+            WHERE id = ?
+        ''', [*columns.values(), scenario_id])
+        record_scenario_revisions(conn, [scenario_id])
+        revision = cursor.execute(
+            'SELECT revision FROM automation_scenarios WHERE id = ?', (scenario_id,)
+        ).fetchone()[0]
+        conn.commit()
+        scenario_cache.invalidate(scenario_id)
+        collect_step_blobs_if_due(conn)
+        
+        response = jsonify({'message': 'Scenario updated successfully', 'revision': revision})
+        response.set_etag(f'scenario-{scenario_id}-{revision}')
+        return response
+    
+    except Exception as e:
+        conn.rollback()
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/scenarios/<int:scenario_id>', methods=['DELETE'])
 @login_required
 def api_delete_scenario(scenario_id):
@@ -435,24 +3011,546 @@ def api_delete_scenario(scenario_id):
         ''', (scenario_id,)).fetchone()
         
         if not scenario:
-            conn.close()
             return jsonify({'error': 'Scenario not found'}), 404
         
-        user = conn.execute('SELECT role FROM users WHERE id = ?', (session['user_id'],)).fetchone()
+        if scenario['created_by'] != session['user_id'] and get_session_role() != 'admin':
+            return jsonify({'error': 'Permission denied'}), 403
+        
+        # Xóa scenario
+        conn.execute('DELETE FROM automation_scenarios WHERE id = ?', (scenario_id,))
+        conn.commit()
+        scenario_cache.invalidate(scenario_id)
+        collect_step_blobs_if_due(conn)
+        
+        return jsonify({'message': 'Scenario deleted successfully'})
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+BULK_ACTIONS = ('toggle_public', 'delete', 'update')
+# Trường được sửa hàng loạt bằng action update
+BULK_UPDATE_FIELDS = {
+    'name': (str,),
+    'description': (str, type(None)),
+    'is_public': (bool,),
+    'steps': (list, dict),
+}
+
+@app.route('/api/scenarios/bulk', methods=['POST'])
+@login_required
+def api_bulk_scenarios():
+    """API: toggle_public / delete / update nhiều scenario trong một transaction;
+    nếu có scenario không tồn tại hoặc không có quyền thì không thay đổi gì"""
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Request body must be a JSON object'}), 400
+    action = data.get('action')
+    if action not in BULK_ACTIONS:
+        return jsonify({'error': f'action must be one of: {", ".join(BULK_ACTIONS)}'}), 400
+    try:
+        scenario_ids = parse_id_list(data.get('ids'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    changes = data.get('changes') or {}
+    if action == 'update':
+        if not isinstance(changes, dict) or not changes:
+            return jsonify({'error': 'update requires a non-empty changes object'}), 400
+        for field, value in changes.items():
+            if field not in BULK_UPDATE_FIELDS:
+                return jsonify({'error': f'Field cannot be updated: {field}'}), 400
+            if not isinstance(value, BULK_UPDATE_FIELDS[field]):
+                return jsonify({'error': f'Invalid type for {field}'}), 400
+        if 'name' in changes and not changes['name'].strip():
+            return jsonify({'error': 'Name is required'}), 400
+    
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    placeholders = ', '.join('?' * len(scenario_ids))
+    try:
+        cursor.execute('BEGIN IMMEDIATE')
+        
+        # Một lần kiểm tra tồn tại và quyền cho cả danh sách
+        owners = dict(cursor.execute(f'''
+            SELECT id, created_by FROM automation_scenarios WHERE id IN ({placeholders})
+        ''', scenario_ids).fetchall())
+        missing = [scenario_id for scenario_id in scenario_ids if scenario_id not in owners]
+        if missing:
+            conn.rollback()
+            return jsonify({'error': 'Scenarios not found', 'ids': missing}), 404
+        
+        if get_session_role() != 'admin':
+            forbidden = [scenario_id for scenario_id in scenario_ids if owners[scenario_id] != session['user_id']]
+            if forbidden:
+                conn.rollback()
+                return jsonify({'error': 'Permission denied', 'ids': forbidden}), 403
+        
+        if action == 'toggle_public':
+            cursor.execute(f'''
+                UPDATE automation_scenarios
+                SET is_public = NOT is_public, updated_at = ?
+                WHERE id IN ({placeholders})
+            ''', [datetime.now().isoformat(), *scenario_ids])
+        elif action == 'delete':
+            cursor.execute(f'DELETE FROM automation_scenarios WHERE id IN ({placeholders})', scenario_ids)
+        else:
+            columns = {field: value for field, value in changes.items() if field != 'steps'}
+            if 'steps' in changes:
+                # Cùng một steps cho mọi scenario nên chỉ nén một lần
+                columns.update(scenario_steps_columns(changes['steps'], conn))
+            columns['updated_at'] = datetime.now().isoformat()
+            cursor.execute(f'''
+                UPDATE automation_scenarios
+                SET {', '.join(f'{column} = ?' for column in columns)}
+                WHERE id IN ({placeholders})
+            ''', [*columns.values(), *scenario_ids])
+        
+        affected = cursor.rowcount
+        if action == 'update':
+            record_scenario_revisions(conn, scenario_ids)
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        return jsonify({'error': str(e)}), 500
+    
+    scenario_cache.invalidate_many(scenario_ids)
+    collect_step_blobs_if_due(conn)
+    
+    return jsonify({'action': action, 'affected': affected})
+
+def scenario_owner_error(conn, scenario_id):
+    """Response lỗi nếu scenario không tồn tại hoặc user hiện tại không phải owner / admin"""
+    scenario = conn.execute('SELECT created_by FROM automation_scenarios WHERE id = ?', (scenario_id,)).fetchone()
+    if not scenario:
+        return jsonify({'error': 'Scenario not found'}), 404
+    if scenario['created_by'] != session['user_id'] and get_session_role() != 'admin':
+        return jsonify({'error': 'Permission denied'}), 403
+    return None
+
+def escape_json_pointer(token):
+    return str(token).replace('~', '~0').replace('/', '~1')
+
+def diff_json(source, target, path=''):
+    """JSON Patch (RFC 6902) biến source thành target: apply_json_patch(source, patch) == target.
+    Mảng được so theo phần đầu / phần cuối chung rồi so từng cặp phần tử ở giữa"""
+    if type(source) is not type(target):
+        return [{'op': 'replace', 'path': path, 'value': target}]
+    
+    if isinstance(source, dict):
+        operations = [{'op': 'remove', 'path': f'{path}/{escape_json_pointer(key)}'} for key in source if key not in target]
+        for key, value in target.items():
+            pointer = f'{path}/{escape_json_pointer(key)}'
+            if key not in source:
+                operations.append({'op': 'add', 'path': pointer, 'value': value})
+            else:
+                operations.extend(diff_json(source[key], value, pointer))
+        return operations
+    
+    if isinstance(source, list):
+        prefix = 0
+        while prefix < min(len(source), len(target)) and source[prefix] == target[prefix]:
+            prefix += 1
+        suffix = 0
+        while (suffix < min(len(source), len(target)) - prefix
+               and source[-1 - suffix] == target[-1 - suffix]):
+            suffix += 1
+        removed = source[prefix:len(source) - suffix]
+        added = target[prefix:len(target) - suffix]
+        
+        operations = []
+        for index in range(min(len(removed), len(added))):
+            operations.extend(diff_json(removed[index], added[index], f'{path}/{prefix + index}'))
+        # Xóa từ cuối để chỉ số của các phần tử còn lại không đổi
+        for index in range(len(removed) - 1, len(added) - 1, -1):
+            operations.append({'op': 'remove', 'path': f'{path}/{prefix + index}'})
+        for index in range(len(removed), len(added)):
+            operations.append({'op': 'add', 'path': f'{path}/{prefix + index}', 'value': added[index]})
+        return operations
+    
+    if source != target:
+        return [{'op': 'replace', 'path': path, 'value': target}]
+    return []
+
+# Revision trong lịch sử được đánh số riêng cho từng scenario (number), khác với
+# revision của change feed / ETag tăng theo mọi lần ghi trong catalogue
+REVISION_QUERY = '''
+    SELECT r.number, r.name, r.description, r.sha256, b.size, r.created_by,
+           u.username AS author, r.created_at
+    FROM scenario_revisions r
+    JOIN step_blobs b ON b.sha256 = r.sha256
+    LEFT JOIN users u ON u.id = r.created_by
+    WHERE r.scenario_id = ?
+'''
+
+def load_scenario_revision(conn, scenario_id, number):
+    return conn.execute(f'{REVISION_QUERY} AND r.number = ?', (scenario_id, number)).fetchone()
+
+def latest_revision_number(conn, scenario_id):
+    return conn.execute(
+        'SELECT MAX(number) FROM scenario_revisions WHERE scenario_id = ?', (scenario_id,)
+    ).fetchone()[0]
+
+@app.route('/api/scenarios/<int:scenario_id>/revisions', methods=['GET'])
+@login_required
+def api_list_scenario_revisions(scenario_id):
+    """API: Lịch sử revision, mới nhất trước (hỗ trợ limit / before=<number>)"""
+    conn = get_db_connection()
+    error = scenario_owner_error(conn, scenario_id)
+    if error:
+        return error
+    
+    limit = request.args.get('limit', 50, type=int)
+    before = request.args.get('before', type=int)
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        return jsonify({'error': f'limit must be between 1 and {MAX_PAGE_SIZE}'}), 400
+    
+    query = REVISION_QUERY
+    params = [scenario_id]
+    if before is not None:
+        query += ' AND r.number < ?'
+        params.append(before)
+    rows = conn.execute(f'{query} ORDER BY r.number DESC LIMIT ?', [*params, limit + 1]).fetchall()
+    
+    current = latest_revision_number(conn, scenario_id)
+    revisions = []
+    for row in rows[:limit]:
+        item = dict(row)
+        item['current'] = row['number'] == current
+        revisions.append(item)
+    
+    response = jsonify({'scenario_id': scenario_id, 'current': current, 'revisions': revisions})
+    if len(rows) > limit:
+        next_url = url_for('api_list_scenario_revisions', scenario_id=scenario_id,
+                           limit=limit, before=revisions[-1]['number'])
+        response.headers['Link'] = f'<{next_url}>; rel="next"'
+    return response
+
+@app.route('/api/scenarios/<int:scenario_id>/revisions/<int:number>', methods=['GET'])
+@login_required
+def api_get_scenario_revision(scenario_id, number):
+    """API: Một revision kèm steps"""
+    conn = get_db_connection()
+    error = scenario_owner_error(conn, scenario_id)
+    if error:
+        return error
+    
+    row = load_scenario_revision(conn, scenario_id, number)
+    if row is None:
+        return jsonify({'error': 'Revision not found'}), 404
+    
+    result = dict(row)
+    result['current'] = number == latest_revision_number(conn, scenario_id)
+    result['steps'] = decode_steps(steps_blob_reference(row['sha256']), conn)
+    return jsonify(result)
+
+@app.route('/api/scenarios/<int:scenario_id>/revisions/<int:number>/diff', methods=['GET'])
+@login_required
+def api_diff_scenario_revisions(scenario_id, number):
+    """API: JSON Patch từ revision <number> tới revision ?to= (mặc định revision hiện tại),
+    áp dụng lên document {name, description, steps}. Steps cùng blob thì không cần giải nén"""
+    conn = get_db_connection()
+    error = scenario_owner_error(conn, scenario_id)
+    if error:
+        return error
+    
+    to_number = request.args.get('to', type=int)
+    if to_number is None:
+        to_number = latest_revision_number(conn, scenario_id)
+    source = load_scenario_revision(conn, scenario_id, number)
+    target = load_scenario_revision(conn, scenario_id, to_number)
+    if source is None or target is None:
+        return jsonify({'error': 'Revision not found'}), 404
+    
+    patch = []
+    for field in ('name', 'description'):
+        patch.extend(diff_json(source[field], target[field], f'/{field}'))
+    steps_changed = source['sha256'] != target['sha256']
+    if steps_changed:
+        patch.extend(diff_json(
+            decode_steps(steps_blob_reference(source['sha256']), conn),
+            decode_steps(steps_blob_reference(target['sha256']), conn),
+            '/steps'
+        ))
+    
+    return jsonify({'from': number, 'to': to_number, 'steps_changed': steps_changed, 'patch': patch})
+
+@app.route('/api/scenarios/<int:scenario_id>/revisions/<int:number>/restore', methods=['POST'])
+@login_required
+def api_restore_scenario_revision(scenario_id, number):
+    """API: Khôi phục name / description / steps của một revision, tạo revision mới.
+    Steps dùng lại blob sẵn có, không nén lại; kiểm tra revision (If-Match) nếu client gửi"""
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Request body must be a JSON object'}), 400
+    expected_revision = data.get('revision')
+    if expected_revision is not None and (not isinstance(expected_revision, int) or isinstance(expected_revision, bool)):
+        return jsonify({'error': 'revision must be an integer'}), 400
+    if expected_revision is None:
+        expected_revision = parse_if_match_revision(scenario_id)
+    
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute('BEGIN IMMEDIATE')
+        scenario = cursor.execute('''
+            SELECT name, description, steps, created_by, revision
+            FROM automation_scenarios WHERE id = ?
+        ''', (scenario_id,)).fetchone()
+        
+        if not scenario:
+            conn.rollback()
+            return jsonify({'error': 'Scenario not found'}), 404
         
-        if scenario['created_by'] != session['user_id'] and user['role'] != 'admin':
-            conn.close()
+        if scenario['created_by'] != session['user_id'] and get_session_role() != 'admin':
+            conn.rollback()
             return jsonify({'error': 'Permission denied'}), 403
         
-        # Xóa scenario
-        conn.execute('DELETE FROM automation_scenarios WHERE id = ?', (scenario_id,))
-        conn.commit()
-        conn.close()
+        if expected_revision is not None and scenario['revision'] != expected_revision:
+            conn.rollback()
+            return jsonify({
+                'error': 'Scenario was modified by someone else',
+                'revision': scenario['revision']
+            }), 412
         
-        return jsonify({'message': 'Scenario deleted successfully'})
+        target = load_scenario_revision(conn, scenario_id, number)
+        if target is None:
+            conn.rollback()
+            return jsonify({'error': 'Revision not found'}), 404
+        
+        columns = {
+            field: target[field]
+            for field in ('name', 'description')
+            if target[field] != scenario[field]
+        }
+        if steps_blob_sha256(scenario['steps']) != target['sha256']:
+            reference = steps_blob_reference(target['sha256'])
+            steps = decode_steps(reference, conn)
+            columns.update({
+                'steps': reference,
+                **derive_workflow_metadata(steps),
+                **execution_plan_columns(steps)
+            })
+        if not columns:
+            conn.rollback()
+            return jsonify({'message': 'No changes', 'revision': scenario['revision']})
         
+        columns['updated_at'] = datetime.now().isoformat()
+        cursor.execute(f'''
+            UPDATE automation_scenarios
+            SET {', '.join(f'{column} = ?' for column in columns)}
+            WHERE id = ?
+        ''', [*columns.values(), scenario_id])
+        record_scenario_revisions(conn, [scenario_id])
+        revision = cursor.execute(
+            'SELECT revision FROM automation_scenarios WHERE id = ?', (scenario_id,)
+        ).fetchone()[0]
+        current = latest_revision_number(conn, scenario_id)
+        conn.commit()
     except Exception as e:
+        conn.rollback()
         return jsonify({'error': str(e)}), 500
+    
+    scenario_cache.invalidate(scenario_id)
+    collect_step_blobs_if_due(conn)
+    
+    response = jsonify({
+        'message': f'Scenario restored to revision {number}',
+        'revision': revision,
+        'current': current
+    })
+    response.set_etag(f'scenario-{scenario_id}-{revision}')
+    return response
+
+# Cột do scenario_steps_columns() ghi: bản sao dùng lại nguyên giá trị, kể cả tham chiếu blob
+DUPLICATED_STEPS_COLUMNS = (
+    'steps', 'workflow_type', 'node_count', 'needs_upload', 'needs_download', 'uses_tabs', 'plan', 'plan_version'
+)
+
+@app.route('/api/scenarios/<int:scenario_id>/duplicate', methods=['POST'])
+@login_required
+def api_duplicate_scenario(scenario_id):
+    """API: Tạo bản sao riêng tư của một scenario xem được, thuộc về user hiện tại.
+    Bản sao trỏ tới cùng blob steps nên không giải nén, nén hay biên dịch lại workflow"""
+    scenario = load_cached_scenario(scenario_id)
+    if not scenario or not can_read_scenario(scenario):
+        return jsonify({'error': 'Scenario not found'}), 404
+    
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Request body must be a JSON object'}), 400
+    name = data.get('name') or f"{scenario.record['name']} (copy)"
+    if not isinstance(name, str) or not name.strip():
+        return jsonify({'error': 'Name is required'}), 400
+    
+    conn = get_db_connection()
+    columns = ', '.join(DUPLICATED_STEPS_COLUMNS)
+    cursor = conn.execute(f'''
+        INSERT INTO automation_scenarios (name, description, is_public, created_by, updated_at, {columns})
+        SELECT ?, description, 0, ?, ?, {columns}
+        FROM automation_scenarios WHERE id = ?
+    ''', (name, session['user_id'], datetime.now().isoformat(), scenario_id))
+    if cursor.rowcount == 0:
+        conn.rollback()
+        return jsonify({'error': 'Scenario not found'}), 404
+    duplicate_id = cursor.lastrowid
+    record_scenario_revisions(conn, [duplicate_id])
+    conn.commit()
+    scenario_cache.invalidate(duplicate_id)
+    
+    return jsonify({'id': duplicate_id, 'message': 'Scenario duplicated successfully'}), 201
+
+EXPORT_FIELDS = ('id', 'name', 'description', 'steps', 'is_public', 'created_at', 'updated_at', 'creator_name')
+
+@app.route('/api/scenarios/export', methods=['GET'])
+@login_required
+def api_export_scenarios():
+    """API: Export các scenario được xem dưới dạng NDJSON, stream từng lô theo id"""
+    visibility, params = search_visibility(session['user_id'], get_session_role())
+    query = f'''
+        SELECT s.id, s.name, s.description, s.steps, s.is_public, s.created_at, s.updated_at,
+               u.username as creator_name
+        FROM automation_scenarios s
+        LEFT JOIN users u ON s.created_by = u.id
+        WHERE s.id > ? AND {visibility}
+        ORDER BY s.id
+        LIMIT ?
+    '''
+    batch_size = app.config['EXPORT_BATCH_SIZE']
+    
+    def generate():
+        conn = get_db_connection()
+        last_id = 0
+        while True:
+            # Mỗi lô là một truy vấn riêng để không giữ snapshot đọc suốt quá trình export
+            rows = conn.execute(query, [last_id, *params, batch_size]).fetchall()
+            lines = []
+            for row in rows:
+                item = {field: row[field] for field in EXPORT_FIELDS}
+                try:
+                    item['steps'] = decode_steps(row['steps'], conn)
+                except (ValueError, zlib.error):
+                    item['steps'] = []
+                item['is_public'] = bool(item['is_public'])
+                lines.append(app.json.dumps(item) + '\n')
+            if lines:
+                yield ''.join(lines)
+            if len(rows) < batch_size:
+                break
+            last_id = rows[-1]['id']
+    
+    filename = f'scenarios-{datetime.now().strftime("%Y%m%d-%H%M%S")}.ndjson'
+    return app.response_class(
+        stream_with_context(generate()),
+        mimetype='application/x-ndjson',
+        headers={'Content-Disposition': f'attachment; filename={filename}'}
+    )
+
+def parse_import_line(line):
+    """Đọc một dòng NDJSON thành (name, description, steps, is_public)"""
+    item = json.loads(line)
+    if not isinstance(item, dict):
+        raise ValueError('Line must be a JSON object')
+    name = item.get('name')
+    if not isinstance(name, str) or not name.strip():
+        raise ValueError('Missing required field: name')
+    steps = item.get('steps')
+    if isinstance(steps, str):
+        steps = json.loads(steps)
+    if not isinstance(steps, (list, dict)):
+        raise ValueError('Missing required field: steps')
+    description = item.get('description') or ''
+    if not isinstance(description, str):
+        raise ValueError('description must be a string')
+    is_public = item.get('is_public', False)
+    if not isinstance(is_public, bool):
+        raise ValueError('is_public must be a boolean')
+    return name, description, steps, is_public
+
+def iter_request_lines(stream, max_line_bytes):
+    """Đọc body theo từng dòng mà không nạp cả body vào bộ nhớ;
+    trả về (số dòng, bytes) hoặc (số dòng, None) nếu dòng quá dài"""
+    line_number = 0
+    while True:
+        line = stream.readline(max_line_bytes + 1)
+        if not line:
+            return
+        line_number += 1
+        if len(line) > max_line_bytes and not line.endswith(b'\n'):
+            # Bỏ phần còn lại của dòng quá dài
+            while line and not line.endswith(b'\n'):
+                line = stream.readline(max_line_bytes)
+            yield line_number, None
+            continue
+        yield line_number, line
+
+@app.route('/api/scenarios/import', methods=['POST'])
+@login_required
+def api_import_scenarios():
+    """API: Import scenario từ NDJSON (mỗi dòng một scenario), commit theo lô
+    và báo lỗi theo số dòng; scenario được import thuộc về user hiện tại"""
+    request.max_content_length = app.config['IMPORT_MAX_CONTENT_LENGTH']
+    batch_size = app.config['IMPORT_BATCH_SIZE']
+    max_errors = app.config['IMPORT_MAX_ERRORS']
+    
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    imported = 0
+    failed = 0
+    errors = []
+    pending = 0
+    
+    def record_error(line_number, message):
+        nonlocal failed
+        failed += 1
+        if len(errors) < max_errors:
+            errors.append({'line': line_number, 'error': message})
+    
+    try:
+        # request.stream không có buffer, readline() trực tiếp sẽ đọc từng byte
+        stream = io.BufferedReader(request.stream, buffer_size=256 * 1024)
+        for line_number, line in iter_request_lines(stream, app.config['MAX_CONTENT_LENGTH']):
+            if line is None:
+                record_error(line_number, 'Line too long')
+                continue
+            if not line.strip():
+                continue
+            try:
+                name, description, steps, is_public = parse_import_line(line)
+            except (ValueError, UnicodeDecodeError) as e:
+                record_error(line_number, str(e))
+                continue
+            
+            if pending == 0:
+                cursor.execute('BEGIN IMMEDIATE')
+            insert_scenario(cursor, name, description, steps, is_public, session['user_id'])
+            pending += 1
+            if pending >= batch_size:
+                refresh_search_index(conn)
+                conn.commit()
+                imported += pending
+                pending = 0
+        
+        if pending:
+            refresh_search_index(conn)
+            conn.commit()
+            imported += pending
+            pending = 0
+    except Exception as e:
+        # Các lô đã commit được giữ lại, lô đang dở bị hủy
+        conn.rollback()
+        failed += pending
+        return jsonify({'error': str(e), 'imported': imported, 'failed': failed, 'errors': errors}), 500
+    finally:
+        if imported:
+            # Scenario mới chưa có trong cache, chỉ cần bỏ các trang danh sách đã serialize
+            scenario_cache.invalidate_many([])
+    
+    return jsonify({
+        'imported': imported,
+        'failed': failed,
+        'errors': errors,
+        'errors_truncated': failed > len(errors)
+    })
 
 # Routes cho AJAX requests từ giao diện web
 @app.route('/web/scenarios', methods=['POST'])
@@ -478,20 +3576,10 @@ def web_create_scenario():
         conn = get_db_connection()
         cursor = conn.cursor()
         
-        cursor.execute('''
-            INSERT INTO automation_scenarios (name, description, steps, is_public, created_by, updated_at)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (
-            name,
-            description,
-            json.dumps(steps),
-            is_public,
-            session['user_id'],
-            datetime.now().isoformat()
-        ))
+        scenario_id = insert_scenario(cursor, name, description, steps, is_public, session['user_id'])
         
         conn.commit()
-        conn.close()
+        scenario_cache.invalidate(scenario_id)
         
         flash('Scenario created successfully!', 'success')
         return redirect(url_for('automation'))  # Updated redirect to automation
@@ -516,14 +3604,10 @@ def web_update_scenario(scenario_id):
         
         if not scenario:
             flash('Scenario not found', 'error')
-            conn.close()
             return redirect(url_for('automation'))  # Updated redirect to automation
         
-        user = conn.execute('SELECT role FROM users WHERE id = ?', (session['user_id'],)).fetchone()
-        
-        if scenario['created_by'] != session['user_id'] and user['role'] != 'admin':
+        if scenario['created_by'] != session['user_id'] and get_session_role() != 'admin':
             flash('Permission denied', 'error')
-            conn.close()
             return redirect(url_for('automation'))  # Updated redirect to automation
         
         if action == 'toggle_public':
@@ -549,32 +3633,32 @@ def web_update_scenario(scenario_id):
             
             if not name or not steps_json:
                 flash('Name and steps are required', 'error')
-                conn.close()
                 return redirect(url_for('automation'))  # Updated redirect to automation
             
             try:
                 steps = json.loads(steps_json)
             except json.JSONDecodeError:
                 flash('Invalid steps format', 'error')
-                conn.close()
                 return redirect(url_for('automation'))  # Updated redirect to automation
             
-            conn.execute('''
+            columns = {
+                'name': name,
+                'description': description,
+                'is_public': is_public,
+                'updated_at': datetime.now().isoformat(),
+                **scenario_steps_columns(steps)
+            }
+            conn.execute(f'''
                 UPDATE automation_scenarios 
-                SET name = ?, description = ?, steps = ?, is_public = ?, updated_at = ?
+                SET {', '.join(f'{column} = ?' for column in columns)}
                 WHERE id = ?
-            ''', (
-                name,
-                description,
-                json.dumps(steps),
-                is_public,
-                datetime.now().isoformat(),
-                scenario_id
-            ))
+            ''', [*columns.values(), scenario_id])
+            record_scenario_revisions(conn, [scenario_id])
             flash('Scenario updated successfully', 'success')
         
         conn.commit()
-        conn.close()
+        scenario_cache.invalidate(scenario_id)
+        collect_step_blobs_if_due(conn)
         
         # Redirect dựa trên role
         if session.get('role') == 'admin':
@@ -604,37 +3688,1250 @@ def allowed_file(filename):
     ALLOWED_EXTENSIONS = {'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif', 'zip', 'json'}
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-@app.route('/upload', methods=['POST'])
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+SHA256_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+def upload_blob_path(sha256):
+    """Đường dẫn blob theo nội dung: blobs/ab/abcdef..."""
+    return os.path.join(app.config['UPLOAD_FOLDER'], 'blobs', sha256[:2], sha256)
+
+def store_upload_stream(stream):
+    """Ghi stream ra file tạm theo từng chunk, vừa ghi vừa băm;
+    trả về (đường dẫn file tạm, sha256, kích thước)"""
+    digest = hashlib.sha256()
+    size = 0
+    temp_path = os.path.join(app.config['UPLOAD_FOLDER'], 'tmp', uuid.uuid4().hex)
+    try:
+        with open(temp_path, 'wb') as temp_file:
+            while True:
+                chunk = stream.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                temp_file.write(chunk)
+                size += len(chunk)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    return temp_path, digest.hexdigest(), size
+
+def register_upload(conn, temp_path, sha256, size, original_filename):
+    """Đưa file tạm vào kho (hoặc bỏ nếu nội dung đã có) và tạo tham chiếu
+    cho user hiện tại; trả về (id tham chiếu, đã có sẵn hay chưa)"""
+    blob_path = upload_blob_path(sha256)
+    expires_at = time.time() + app.config['UPLOAD_REF_TTL']
+    cursor = conn.cursor()
+    # Đặt file và ghi bảng trong cùng khóa ghi để không đua với collect_upload_garbage
+    cursor.execute('BEGIN IMMEDIATE')
+    try:
+        existing = cursor.execute('SELECT 1 FROM upload_blobs WHERE sha256 = ?', (sha256,)).fetchone()
+        deduplicated = existing is not None and os.path.exists(blob_path)
+        if deduplicated:
+            os.unlink(temp_path)
+        else:
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            os.replace(temp_path, blob_path)
+            cursor.execute('''
+                INSERT INTO upload_blobs (sha256, size, unreferenced_since) VALUES (?, ?, ?)
+                ON CONFLICT (sha256) DO NOTHING
+            ''', (sha256, size, time.time()))
+        
+        # Cùng user upload lại cùng file thì chỉ gia hạn tham chiếu cũ
+        ref = cursor.execute('''
+            SELECT id FROM upload_refs WHERE user_id = ? AND sha256 = ? AND original_filename = ?
+        ''', (session['user_id'], sha256, original_filename)).fetchone()
+        if ref:
+            ref_id = ref['id']
+            cursor.execute('UPDATE upload_refs SET expires_at = ? WHERE id = ?', (expires_at, ref_id))
+        else:
+            ref_id = uuid.uuid4().hex
+            cursor.execute('''
+                INSERT INTO upload_refs (id, sha256, user_id, original_filename, expires_at)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (ref_id, sha256, session['user_id'], original_filename, expires_at))
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+    return ref_id, deduplicated
+
+_upload_gc_lock = threading.Lock()
+_upload_gc_last_run = 0
+
+def collect_upload_garbage(conn=None):
+    """Xóa tham chiếu hết hạn, rồi xóa blob đã không còn tham chiếu quá UPLOAD_BLOB_TTL"""
+    global _upload_gc_last_run
+    if not _upload_gc_lock.acquire(blocking=False):
+        return 0
+    try:
+        conn = conn or get_db_connection()
+        now = time.time()
+        cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            cursor.execute('DELETE FROM upload_refs WHERE expires_at < ?', (now,))
+            expired = [row[0] for row in cursor.execute('''
+                SELECT sha256 FROM upload_blobs
+                WHERE refcount = 0 AND unreferenced_since < ?
+            ''', (now - app.config['UPLOAD_BLOB_TTL'],)).fetchall()]
+            for sha256 in expired:
+                cursor.execute('DELETE FROM upload_blobs WHERE sha256 = ?', (sha256,))
+                # Xóa file khi vẫn giữ khóa ghi: register_upload không thể đặt lại file giữa chừng
+                try:
+                    os.unlink(upload_blob_path(sha256))
+                except FileNotFoundError:
+                    pass
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        _upload_gc_last_run = now
+        return len(expired)
+    finally:
+        _upload_gc_lock.release()
+
+@app.route('/upload', methods=['POST', 'PUT'])
 @login_required
 def upload_file():
-    """Upload file tạm thời"""
+    """Upload file: multipart (trường file) hoặc body thô kèm ?filename=.
+    Nội dung được băm SHA-256 khi ghi ra đĩa và chỉ lưu một bản cho mỗi nội dung"""
     try:
-        if 'file' not in request.files:
-            return jsonify({'error': 'No file part'}), 400
-        
-        file = request.files['file']
+        if request.mimetype == 'multipart/form-data':
+            if 'file' not in request.files:
+                return jsonify({'error': 'No file part'}), 400
+            file = request.files['file']
+            original_filename = file.filename
+            stream = file.stream
+        else:
+            # Body thô được đọc thẳng từ socket, không qua bộ đệm form của Werkzeug
+            original_filename = request.args.get('filename') or request.headers.get('X-Filename', '')
+            stream = request.stream
         
-        if file.filename == '':
+        if original_filename == '':
             return jsonify({'error': 'No selected file'}), 400
         
-        if file and allowed_file(file.filename):
-            filename = secure_filename(file.filename)
-            # Tạo tên file unique
-            unique_filename = f"{uuid.uuid4()}_{filename}"
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-            file.save(filepath)
-            
-            return jsonify({
-                'message': 'File uploaded successfully',
-                'filename': unique_filename,
-                'original_filename': filename
-            })
-        else:
+        if not allowed_file(original_filename):
             return jsonify({'error': 'File type not allowed'}), 400
+        
+        filename = secure_filename(original_filename)
+        conn = get_db_connection()
+        temp_path, sha256, size = store_upload_stream(stream)
+        ref_id, deduplicated = register_upload(conn, temp_path, sha256, size, filename)
+        
+        if time.time() - _upload_gc_last_run > app.config['UPLOAD_GC_INTERVAL']:
+            collect_upload_garbage(conn)
+        
+        return jsonify({
+            'message': 'File uploaded successfully',
+            'filename': ref_id,
+            'original_filename': filename,
+            'sha256': sha256,
+            'size': size,
+            'deduplicated': deduplicated,
+            'url': url_for('get_upload_blob', sha256=sha256)
+        })
             
-    except Exception as e:
+    except HTTPException:
+        # RequestEntityTooLarge khi body vượt MAX_CONTENT_LENGTH: giữ nguyên mã 413
+        raise
+    except (OSError, sqlite3.Error) as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/upload/<ref_id>', methods=['DELETE'])
+@login_required
+def delete_upload(ref_id):
+    """Bỏ tham chiếu tới file đã upload; blob bị xóa sau UPLOAD_BLOB_TTL nếu không ai dùng"""
+    conn = get_db_connection()
+    deleted = conn.execute(
+        'DELETE FROM upload_refs WHERE id = ? AND user_id = ?', (ref_id, session['user_id'])
+    ).rowcount
+    conn.commit()
+    if not deleted:
+        return jsonify({'error': 'Upload not found'}), 404
+    return jsonify({'message': 'Upload released'})
+
+def upload_reader_id(conn):
+    """User được đọc upload trong request này: user đăng nhập, hoặc người yêu cầu của run
+    đang chạy mà runner chứng minh bằng ?run=<id> và header X-Run-Token"""
+    if session.get('user_id') is not None:
+        return session['user_id']
+    run_id = request.args.get('run', type=int)
+    if run_id is None:
+        return None
+    row = conn.execute('SELECT requested_by, ingest_token, status FROM runs WHERE id = ?', (run_id,)).fetchone()
+    if row is None or row['status'] != 'running' or not check_ingest_token(row):
+        return None
+    return row['requested_by']
+
+@app.route('/api/uploads/<sha256>', methods=['GET'])
+def get_upload_blob(sha256):
+    """API: Tải file theo SHA-256 (hỗ trợ Range và conditional GET); chỉ user còn giữ
+    tham chiếu tới nội dung này (đã upload và chưa hết hạn) mới tải được"""
+    if not SHA256_PATTERN.match(sha256):
+        return jsonify({'error': 'Invalid content hash'}), 400
+    
+    conn = get_db_connection()
+    user_id = upload_reader_id(conn)
+    # Không phân biệt "không có quyền" với "không tồn tại" để hash không lộ việc file có trên server
+    if user_id is None or conn.execute('''
+        SELECT 1 FROM upload_refs WHERE user_id = ? AND sha256 = ? AND expires_at > ? LIMIT 1
+    ''', (user_id, sha256, time.time())).fetchone() is None:
+        return jsonify({'error': 'Upload not found'}), 404
+    
+    blob_path = upload_blob_path(sha256)
+    if not os.path.exists(blob_path):
+        return jsonify({'error': 'Upload not found'}), 404
+    
+    # Nội dung không bao giờ đổi với cùng hash, nhưng chỉ trình duyệt của user được lưu lại
+    response = send_file(
+        os.path.abspath(blob_path),
+        mimetype='application/octet-stream',
+        etag=sha256,
+        conditional=True,
+        max_age=365 * 24 * 3600
+    )
+    response.headers['Cache-Control'] = 'private, max-age=31536000, immutable'
+    return response
+
+# Hàng đợi run: server chỉ ghi vào bảng runs, worker.py nhận và thực thi
+RUN_FINISHED_STATUSES = ('succeeded', 'failed', 'cancelled', 'timed_out')
+
+def format_timestamp(value):
+    """Epoch (REAL) -> ISO 8601 UTC cho payload API"""
+    if value is None:
+        return None
+    return datetime.fromtimestamp(value, timezone.utc).isoformat()
+
+def run_payload(row):
+    """Trạng thái một run trả về cho client"""
+    return {
+        'id': row['id'],
+        'scenario_id': row['scenario_id'],
+        'scenario_revision': row['scenario_revision'],
+        'source': row['source'],
+        'status': row['status'],
+        'attempts': row['attempts'],
+        'cancel_requested': bool(row['cancel_requested']),
+        'deadline_seconds': row['deadline_seconds'],
+        'steps_total': row['steps_total'],
+        'steps_succeeded': row['steps_succeeded'],
+        'error': row['error'],
+        'created_at': format_timestamp(row['created_at']),
+        'started_at': format_timestamp(row['started_at']),
+        'finished_at': format_timestamp(row['finished_at']),
+    }
+
+def load_execution_plan(conn, scenario_id):
+    """Execution plan hiện tại của scenario (plan cũ được biên dịch lại), None nếu không có"""
+    row = conn.execute(
+        'SELECT steps, plan, plan_version FROM automation_scenarios WHERE id = ?', (scenario_id,)
+    ).fetchone()
+    if row is None:
+        return None
+    if row['plan'] is not None and row['plan_version'] == PLAN_VERSION:
+        return json.loads(gzip.decompress(row['plan']))
+    return compile_workflow(decode_steps(row['steps'], conn))
+
+# Các bước mở URL; run trên server thực thi scenario của mọi user nên URL bị giới hạn
+RUN_URL_STEP_TYPES = ('open_browser', 'new_tab', 'open_url')
+
+def run_url_error(url, resolve=True):
+    """Lý do trình duyệt của worker không được mở URL (file:, loopback, mạng nội bộ...), None
+    nếu được phép. resolve=False chỉ xét scheme và host dạng địa chỉ IP, không tra DNS"""
+    if not url or url == 'about:blank' or app.config['RUN_ALLOW_PRIVATE_URLS']:
+        return None
+    try:
+        parts = urlsplit(url)
+        port = parts.port
+    except ValueError:
+        return f'Invalid URL: {url[:200]}'
+    if parts.scheme not in ('http', 'https'):
+        return f"URL scheme '{parts.scheme}' is not allowed"
+    host = parts.hostname
+    if not host:
+        return 'URL has no host'
+    if host == 'localhost' or host.endswith('.localhost'):
+        return f"Host '{host}' is not allowed"
+    try:
+        addresses = [ipaddress.ip_address(host)]
+    except ValueError:
+        if not resolve:
+            return None
+        try:
+            infos = socket.getaddrinfo(host, port or (443 if parts.scheme == 'https' else 80), proto=socket.IPPROTO_TCP)
+        except (OSError, UnicodeError):
+            # Trình duyệt cũng không phân giải được host này
+            return None
+        addresses = [ipaddress.ip_address(info[4][0].split('%')[0]) for info in infos]
+    for address in addresses:
+        if not address.is_global:
+            return f"Host '{host}' is not a public address ({address})"
+    return None
+
+def run_plan_url_error(steps, resolve=True):
+    """Lỗi của URL đầu tiên bị chặn trong plan ('Step N: ...'), None nếu không có"""
+    for index, step in enumerate(steps, 1):
+        if step.get('type') in RUN_URL_STEP_TYPES:
+            error = run_url_error(step.get('url'), resolve)
+            if error:
+                return f'Step {index}: {error}'
+    return None
+
+def requeue_expired_runs(conn):
+    """Trả lại hàng đợi các run mà worker đã ngừng gia hạn (worker chết);
+    run đã nhận đủ RUN_MAX_ATTEMPTS lần thì đánh dấu thất bại"""
+    now = time.time()
+    cursor = conn.cursor()
+    cursor.execute('BEGIN IMMEDIATE')
+    try:
+        cursor.execute('''
+            UPDATE runs SET status = 'failed', finished_at = ?, worker_id = NULL, lease_expires_at = NULL,
+                error = CASE source WHEN 'desktop' THEN 'Runner stopped reporting' ELSE 'Worker stopped responding' END
+            WHERE status = 'running' AND lease_expires_at < ? AND (source = 'desktop' OR attempts >= ?)
+        ''', (now, now, app.config['RUN_MAX_ATTEMPTS']))
+        requeued = cursor.execute('''
+            UPDATE runs SET status = 'queued', worker_id = NULL, lease_expires_at = NULL
+            WHERE status = 'running' AND lease_expires_at < ? AND source = 'server'
+        ''', (now,)).rowcount
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return requeued
+
+def claim_next_run(conn, worker_id):
+    """Nhận run cũ nhất đang chờ cho worker_id, trả về dòng runs hoặc None"""
+    # Đọc trước (không cần khóa ghi) để worker rảnh không tranh khóa với API
+    if conn.execute("SELECT 1 FROM runs WHERE status = 'queued' LIMIT 1").fetchone() is None:
+        return None
+    
+    now = time.time()
+    row = conn.execute('''
+        UPDATE runs
+        SET status = 'running', worker_id = ?, attempts = attempts + 1,
+            started_at = ?, lease_expires_at = ?, ingest_token = ?
+        WHERE id = (SELECT id FROM runs WHERE status = 'queued' ORDER BY id LIMIT 1)
+        RETURNING *
+    ''', (worker_id, now, now + app.config['RUN_LEASE_SECONDS'], uuid.uuid4().hex)).fetchone()
+    conn.commit()
+    return row
+
+def renew_run_leases(conn, worker_id, progress):
+    """Gia hạn mọi run worker đang chạy và ghi tiến độ (run id -> số bước thành công);
+    trả về id các run đã được yêu cầu hủy"""
+    lease_expires_at = time.time() + app.config['RUN_LEASE_SECONDS']
+    cursor = conn.cursor()
+    cursor.execute('BEGIN IMMEDIATE')
+    try:
+        cursor.executemany('''
+            UPDATE runs SET lease_expires_at = ?, steps_succeeded = ?
+            WHERE id = ? AND worker_id = ? AND status = 'running'
+        ''', [(lease_expires_at, succeeded, run_id, worker_id) for run_id, succeeded in progress.items()])
+        cancelled = {row[0] for row in cursor.execute('''
+            SELECT id FROM runs WHERE worker_id = ? AND status = 'running' AND cancel_requested = 1
+        ''', (worker_id,)).fetchall()}
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return cancelled
+
+def finish_run(conn, run_id, worker_id, status, steps_total, steps_succeeded, error=None):
+    """Ghi kết quả cuối của run; bỏ qua nếu run không còn thuộc worker này"""
+    updated = conn.execute('''
+        UPDATE runs
+        SET status = ?, steps_total = ?, steps_succeeded = ?, error = ?,
+            finished_at = ?, worker_id = NULL, lease_expires_at = NULL
+        WHERE id = ? AND worker_id = ? AND status = 'running'
+    ''', (status, steps_total, steps_succeeded, error, time.time(), run_id, worker_id)).rowcount
+    conn.commit()
+    return bool(updated)
+
+def can_read_scenario(scenario):
+    """Scenario công khai, của user hiện tại hoặc user hiện tại là admin"""
+    user_id = session.get('user_id')
+    return scenario.is_public or get_session_role() == 'admin' or (
+        user_id is not None and scenario.created_by == user_id
+    )
+
+def load_visible_run(conn, run_id):
+    """Run của user hiện tại (admin xem được mọi run), None nếu không có quyền"""
+    row = conn.execute('SELECT * FROM runs WHERE id = ?', (run_id,)).fetchone()
+    if row is None or (row['requested_by'] != session.get('user_id') and get_session_role() != 'admin'):
+        return None
+    return row
+
+@app.route('/api/scenarios/<int:scenario_id>/runs', methods=['POST'])
+@login_required
+def api_enqueue_run(scenario_id):
+    """API: Đưa scenario vào hàng đợi chạy trên server"""
+    scenario = load_cached_scenario(scenario_id)
+    if not scenario or not can_read_scenario(scenario):
+        return jsonify({'error': 'Scenario not found'}), 404
+    
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Request body must be a JSON object'}), 400
+    deadline_seconds = data.get('deadline_seconds', app.config['RUN_DEFAULT_DEADLINE'])
+    if (not isinstance(deadline_seconds, int) or isinstance(deadline_seconds, bool)
+            or not 0 < deadline_seconds <= app.config['RUN_MAX_DEADLINE']):
+        return jsonify({'error': f"deadline_seconds must be an integer between 1 and {app.config['RUN_MAX_DEADLINE']}"}), 400
+    
+    conn = get_db_connection()
+    # Worker kiểm tra lại khi chạy (kèm tra DNS), ở đây chỉ từ chối sớm các URL hiển nhiên bị chặn
+    plan = load_execution_plan(conn, scenario_id)
+    url_error = run_plan_url_error(plan['steps'], resolve=False) if plan else None
+    if url_error:
+        return jsonify({'error': url_error}), 400
+    
+    cursor = conn.cursor()
+    cursor.execute('BEGIN IMMEDIATE')
+    try:
+        queued = cursor.execute('''
+            SELECT COUNT(*) FROM runs WHERE requested_by = ? AND status = 'queued'
+        ''', (session['user_id'],)).fetchone()[0]
+        if queued >= app.config['RUN_MAX_QUEUED_PER_USER']:
+            conn.rollback()
+            return jsonify({'error': 'Too many queued runs'}), 429
+        
+        cursor.execute('''
+            INSERT INTO runs (scenario_id, scenario_revision, requested_by, deadline_seconds, created_at)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (scenario_id, scenario.revision, session['user_id'], deadline_seconds, time.time()))
+        row = cursor.execute('SELECT * FROM runs WHERE id = ?', (cursor.lastrowid,)).fetchone()
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    
+    response = jsonify(run_payload(row))
+    response.status_code = 202
+    response.headers['Location'] = url_for('api_get_run', run_id=row['id'])
+    return response
+
+@app.route('/api/runs/<int:run_id>', methods=['GET'])
+@login_required
+def api_get_run(run_id):
+    """API: Trạng thái của một run"""
+    row = load_visible_run(get_db_connection(), run_id)
+    if row is None:
+        return jsonify({'error': 'Run not found'}), 404
+    return jsonify(run_payload(row))
+
+@app.route('/api/runs/<int:run_id>/cancel', methods=['POST'])
+@login_required
+def api_cancel_run(run_id):
+    """API: Hủy run; run đang chờ bị hủy ngay, run đang chạy dừng sau bước hiện tại"""
+    conn = get_db_connection()
+    row = load_visible_run(conn, run_id)
+    if row is None:
+        return jsonify({'error': 'Run not found'}), 404
+    
+    cancelled = conn.execute('''
+        UPDATE runs SET status = 'cancelled', cancel_requested = 1, finished_at = ?
+        WHERE id = ? AND status = 'queued'
+    ''', (time.time(), run_id)).rowcount
+    if not cancelled:
+        conn.execute("UPDATE runs SET cancel_requested = 1 WHERE id = ? AND status = 'running'", (run_id,))
+    conn.commit()
+    if cancelled:
+        release_db_connection(None)
+        publish_run_events(run_id, [], ('cancelled', 'Cancelled by user', None))
+        conn = get_db_connection()
+    
+    row = conn.execute('SELECT * FROM runs WHERE id = ?', (run_id,)).fetchone()
+    if row['status'] in RUN_FINISHED_STATUSES and row['status'] != 'cancelled':
+        return jsonify({'error': f"Run already {row['status']}", 'run': run_payload(row)}), 409
+    return jsonify(run_payload(row)), 202 if row['status'] == 'running' else 200
+
+# Lịch sử run: step event được ghi theo nhóm (group commit) và cộng vào histogram độ trễ
+RUN_STEP_OUTCOMES = ('succeeded', 'failed', 'skipped')
+RUN_LIVE_EVENT_KINDS = ('step-started', 'step-finished', 'log')
+LATENCY_BUCKETS_PER_OCTAVE = 4  # Bucket rộng ~19%: sai số của p50/p95
+
+def latency_bucket(duration_ms):
+    """Bucket logarit của độ trễ; bucket b chứa các giá trị trong (2^((b-1)/4), 2^(b/4)] ms"""
+    if duration_ms <= 1:
+        return 0
+    return math.ceil(math.log2(duration_ms) * LATENCY_BUCKETS_PER_OCTAVE)
+
+def latency_bucket_upper_ms(bucket):
+    return round(2 ** (bucket / LATENCY_BUCKETS_PER_OCTAVE), 1)
+
+def latency_percentiles(histogram):
+    """count, p50, p95 (cận trên của bucket, ms) từ histogram bucket -> số bước"""
+    total = sum(histogram.values())
+    result = {'count': total, 'p50': None, 'p95': None}
+    if not total:
+        return result
+    
+    targets = [('p50', 0.5 * total), ('p95', 0.95 * total)]
+    seen = 0
+    for bucket in sorted(histogram):
+        seen += histogram[bucket]
+        while targets and seen >= targets[0][1]:
+            result[targets.pop(0)[0]] = latency_bucket_upper_ms(bucket)
+    return result
+
+def parse_step_event(value, position, now):
+    """Kiểm tra một step event (kết quả một bước) từ runner, trả về dict đã chuẩn hóa"""
+    step_index = value.get('step_index')
+    step_type = value.get('type')
+    duration_ms = value.get('duration_ms')
+    outcome = value.get('outcome')
+    started_at = value.get('started_at', now)
+    error = value.get('error')
+    node_id = value.get('node_id')
+    if not isinstance(step_index, int) or isinstance(step_index, bool) or step_index < 0:
+        raise ValueError(f'events[{position}].step_index must be a non-negative integer')
+    if not isinstance(step_type, str) or not 0 < len(step_type) <= 64:
+        raise ValueError(f'events[{position}].type must be a short string')
+    if not isinstance(duration_ms, (int, float)) or isinstance(duration_ms, bool) or not 0 <= duration_ms < 1e9:
+        raise ValueError(f'events[{position}].duration_ms must be a non-negative number')
+    if outcome not in RUN_STEP_OUTCOMES:
+        raise ValueError(f"events[{position}].outcome must be one of {', '.join(RUN_STEP_OUTCOMES)}")
+    if not isinstance(started_at, (int, float)) or isinstance(started_at, bool) or not 0 < started_at <= now + 3600:
+        raise ValueError(f'events[{position}].started_at must be a Unix timestamp')
+    if error is not None and not isinstance(error, str):
+        raise ValueError(f'events[{position}].error must be a string')
+    return {
+        'step_index': step_index,
+        'type': step_type,
+        'node_id': None if node_id is None else str(node_id)[:128],
+        'outcome': outcome,
+        'duration_ms': float(duration_ms),
+        'error': error[:2000] if error else None,
+        'started_at': float(started_at),
+    }
+
+def parse_run_events(values):
+    """Kiểm tra danh sách event từ runner theo thứ tự phát sinh. kind mặc định là
+    step-finished (được lưu vào run_steps); step-started và log chỉ được phát trực tiếp.
+    Trả về (các step event cần lưu, danh sách (kind, data) để phát)"""
+    if not isinstance(values, list):
+        raise ValueError('events must be a list')
+    if len(values) > app.config['RUN_EVENT_MAX_BATCH']:
+        raise ValueError(f"At most {app.config['RUN_EVENT_MAX_BATCH']} events per request")
+    
+    now = time.time()
+    steps = []
+    live = []
+    for position, value in enumerate(values):
+        if not isinstance(value, dict):
+            raise ValueError(f'events[{position}] must be an object')
+        kind = value.get('kind', 'step-finished')
+        if kind == 'step-finished':
+            event = parse_step_event(value, position, now)
+            steps.append(event)
+        elif kind == 'step-started':
+            step_index = value.get('step_index')
+            if not isinstance(step_index, int) or isinstance(step_index, bool) or step_index < 0:
+                raise ValueError(f'events[{position}].step_index must be a non-negative integer')
+            event = {'step_index': step_index, 'type': str(value.get('type') or 'unknown')[:64]}
+        elif kind == 'log':
+            message = value.get('message')
+            if not isinstance(message, str):
+                raise ValueError(f'events[{position}].message must be a string')
+            event = {'level': str(value.get('level') or 'INFO')[:16], 'message': message[:2000]}
+        else:
+            raise ValueError(f"events[{position}].kind must be one of {', '.join(RUN_LIVE_EVENT_KINDS)}")
+        live.append((kind, event))
+    return steps, live
+
+def parse_run_finish(data):
+    """Trạng thái cuối runner gửi kèm batch event: (status, error, steps_total) hoặc None"""
+    if data.get('status') is None:
+        return None
+    if data['status'] not in RUN_FINISHED_STATUSES:
+        raise ValueError(f"status must be one of {', '.join(RUN_FINISHED_STATUSES)}")
+    error = data.get('error')
+    steps_total = data.get('steps_total')
+    if error is not None and not isinstance(error, str):
+        raise ValueError('error must be a string')
+    if steps_total is not None and (not isinstance(steps_total, int) or isinstance(steps_total, bool)):
+        raise ValueError('steps_total must be an integer')
+    return data['status'], error[:2000] if error else None, steps_total
+
+class StepEventBatch:
+    """Một lần submit: các event của một run, kèm trạng thái cuối nếu run đã xong"""
+    
+    def __init__(self, run_id, scenario_id, events, finish=None, live=()):
+        self.run_id = run_id
+        self.scenario_id = scenario_id  # None: không ghi vào histogram độ trễ
+        self.events = events
+        self.finish = finish  # (status, error, steps_total) hoặc None
+        self.live = live  # (kind, data) ghi vào run_event_log cho SSE
+        self.succeeded = sum(event['outcome'] == 'succeeded' for event in events)
+        self.done = threading.Event()
+        self.error = None
+    
+    def wait(self, timeout=None):
+        """Chờ tới khi batch đã được commit, ném lại lỗi nếu transaction thất bại"""
+        if not self.done.wait(timeout):
+            raise TimeoutError('Step events were not committed in time')
+        if self.error is not None:
+            raise self.error
+
+class StepEventWriter:
+    """Một thread ghi duy nhất cho mỗi process: mọi batch đến trong lúc transaction
+    trước đang commit được gom vào transaction kế tiếp, nên nhiều run đồng thời
+    chỉ tốn một lần fsync thay vì mỗi request một lần và không tranh khóa ghi"""
+    
+    def __init__(self, path):
+        self.path = path
+        self._pending = []
+        self._condition = threading.Condition()
+        self.transactions = 0
+        self.batches = 0
+        self._pruned_at = 0
+        self._thread = threading.Thread(target=self._run, name='step-event-writer', daemon=True)
+        self._thread.start()
+    
+    def submit(self, run_id, scenario_id, events, finish=None, wait=True, live=()):
+        """Đưa batch vào hàng đợi ghi; mặc định chờ tới khi đã commit"""
+        batch = StepEventBatch(run_id, scenario_id, events, finish, live)
+        with self._condition:
+            self._pending.append(batch)
+            self._condition.notify()
+        if wait:
+            batch.wait()
+        return batch
+    
+    def flush(self):
+        """Chờ mọi batch đã submit trước đó được commit"""
+        self.submit(None, None, []).wait()
+    
+    def _take_group(self):
+        with self._condition:
+            while not self._pending:
+                self._condition.wait()
+            group = []
+            size = 0
+            while self._pending and (not group or size + len(self._pending[0].events) + len(self._pending[0].live)
+                                     <= app.config['RUN_EVENT_GROUP_SIZE']):
+                batch = self._pending.pop(0)
+                group.append(batch)
+                size += len(batch.events) + len(batch.live)
+            return group
+    
+    def _run(self):
+        conn = run_blocking_sqlite(open_db_connection, self.path)
+        while True:
+            group = self._take_group()
+            try:
+                run_blocking_sqlite(self._write, conn, group)
+                error = None
+            except Exception as e:
+                run_blocking_sqlite(conn.rollback)
+                app.logger.exception('Failed to write %d step event batch(es)', len(group))
+                error = e
+            for batch in group:
+                batch.error = error
+                batch.done.set()
+    
+    def _write(self, conn, group):
+        rows = []
+        histogram = Counter()
+        for batch in group:
+            for event in batch.events:
+                rows.append((batch.run_id, event['step_index'], event['type'], event['node_id'], event['outcome'],
+                             event['duration_ms'], event['error'], event['started_at']))
+                if batch.scenario_id is not None and event['outcome'] != 'skipped':
+                    day = int(event['started_at'] // 86400)
+                    histogram[batch.scenario_id, event['type'], day, latency_bucket(event['duration_ms'])] += 1
+        
+        now = time.time()
+        lease_expires_at = now + app.config['RUN_REPORT_TIMEOUT']
+        cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.executemany('''
+            INSERT INTO run_steps (run_id, step_index, step_type, node_id, outcome, duration_ms, error, started_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', rows)
+        cursor.executemany('''
+            INSERT INTO step_latency_histogram (scenario_id, step_type, day, bucket, count)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (scenario_id, step_type, day, bucket) DO UPDATE SET count = count + excluded.count
+        ''', [(*key, count) for key, count in histogram.items()])
+        # Run desktop: tiến độ theo event và gia hạn thời gian chờ báo cáo
+        # (run của worker.py tự ghi tiến độ qua renew_run_leases)
+        cursor.executemany('''
+            UPDATE runs SET steps_succeeded = steps_succeeded + ?, lease_expires_at = ?
+            WHERE id = ? AND source = 'desktop' AND status = 'running'
+        ''', [(batch.succeeded, lease_expires_at, batch.run_id)
+              for batch in group if batch.run_id is not None and not batch.finish])
+        cursor.executemany('''
+            UPDATE runs SET steps_succeeded = steps_succeeded + ?, steps_total = COALESCE(?, steps_total),
+                status = ?, error = ?, finished_at = ?, lease_expires_at = NULL
+            WHERE id = ? AND source = 'desktop' AND status = 'running'
+        ''', [(batch.succeeded, batch.finish[2], batch.finish[0], batch.finish[1], now, batch.run_id)
+              for batch in group if batch.finish])
+        cursor.executemany('INSERT INTO run_event_log (run_id, kind, data, created_at) VALUES (?, ?, ?, ?)', [
+            (batch.run_id, kind, app.json.dumps(data), now) for batch in group for kind, data in batch.live
+        ])
+        if now - self._pruned_at > 60:
+            # id tăng theo thời gian: xóa từ đầu bảng tới event đầu tiên còn trong hạn giữ
+            cursor.execute('''
+                DELETE FROM run_event_log WHERE id < COALESCE(
+                    (SELECT id FROM run_event_log WHERE created_at >= ? ORDER BY id LIMIT 1),
+                    (SELECT MAX(id) + 1 FROM run_event_log))
+            ''', (now - app.config['RUN_EVENT_RETENTION'],))
+            self._pruned_at = now
+        conn.commit()
+        self.transactions += 1
+        self.batches += len(group)
+
+_step_event_writer = None
+_step_event_writer_lock = threading.Lock()
+
+def get_step_event_writer():
+    """Thread ghi step event của process (tạo lại nếu đổi database hoặc sau fork)"""
+    global _step_event_writer
+    with _step_event_writer_lock:
+        writer = _step_event_writer
+        if writer is None or writer.path != app.config['DATABASE'] or not writer._thread.is_alive():
+            writer = _step_event_writer = StepEventWriter(app.config['DATABASE'])
+        return writer
+
+def check_ingest_token(row):
+    """Runner desktop chứng minh quyền ghi event bằng token nhận khi tạo run"""
+    token = request.headers.get('X-Run-Token', '')
+    return bool(row['ingest_token']) and hmac.compare_digest(token, row['ingest_token'])
+
+@app.route('/api/runs', methods=['POST'])
+def api_start_desktop_run():
+    """API: Runner desktop báo bắt đầu chạy một scenario, nhận id và token để gửi step event"""
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Request body must be a JSON object'}), 400
+    scenario_id = data.get('scenario_id')
+    steps_total = data.get('steps_total')
+    if not isinstance(scenario_id, int) or isinstance(scenario_id, bool):
+        return jsonify({'error': 'scenario_id must be an integer'}), 400
+    if steps_total is not None and (not isinstance(steps_total, int) or isinstance(steps_total, bool) or steps_total < 0):
+        return jsonify({'error': 'steps_total must be a non-negative integer'}), 400
+    
+    scenario = load_cached_scenario(scenario_id)
+    if not scenario or not can_read_scenario(scenario):
+        return jsonify({'error': 'Scenario not found'}), 404
+    
+    now = time.time()
+    token = uuid.uuid4().hex
+    user_id = session.get('user_id')
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('BEGIN IMMEDIATE')
+    try:
+        # Runner chưa đăng nhập được giới hạn theo địa chỉ IP
+        if user_id is not None:
+            open_runs = cursor.execute('''
+                SELECT COUNT(*) FROM runs WHERE requested_by = ? AND status = 'running' AND source = 'desktop'
+            ''', (user_id,)).fetchone()[0]
+        else:
+            open_runs = cursor.execute('''
+                SELECT COUNT(*) FROM runs
+                WHERE client_address = ? AND source = 'desktop' AND status = 'running' AND requested_by IS NULL
+            ''', (request.remote_addr,)).fetchone()[0]
+        if open_runs >= app.config['RUN_MAX_OPEN_DESKTOP_PER_CLIENT']:
+            conn.rollback()
+            return jsonify({'error': 'Too many open desktop runs'}), 429
+        
+        cursor.execute('''
+            INSERT INTO runs (scenario_id, scenario_revision, requested_by, client_address, source, ingest_token,
+                              status, deadline_seconds, attempts, steps_total, created_at, started_at, lease_expires_at)
+            VALUES (?, ?, ?, ?, 'desktop', ?, 'running', 0, 1, ?, ?, ?, ?)
+        ''', (scenario_id, scenario.revision, user_id, request.remote_addr, token, steps_total, now, now,
+              now + app.config['RUN_REPORT_TIMEOUT']))
+        row = cursor.execute('SELECT * FROM runs WHERE id = ?', (cursor.lastrowid,)).fetchone()
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    
+    result = run_payload(row)
+    result['ingest_token'] = token
+    response = jsonify(result)
+    response.status_code = 201
+    response.headers['Location'] = url_for('api_get_run', run_id=row['id'])
+    return response
+
+@app.route('/api/runs/<int:run_id>/steps', methods=['POST'])
+def api_ingest_run_steps(run_id):
+    """API: Nhận một batch step event (và trạng thái cuối nếu có) từ runner desktop"""
+    conn = get_db_connection()
+    row = conn.execute('''
+        SELECT id, scenario_id, requested_by, source, status, ingest_token FROM runs WHERE id = ?
+    ''', (run_id,)).fetchone()
+    if row is None or not check_ingest_token(row):
+        return jsonify({'error': 'Run not found'}), 404
+    if row['status'] != 'running':
+        return jsonify({'error': f"Run already {row['status']}"}), 409
+    
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Request body must be a JSON object'}), 400
+    try:
+        events, live = parse_run_events(data.get('events', []))
+        finish = parse_run_finish(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    # Trả kết nối request về pool trước khi chờ thread ghi
+    release_db_connection(None)
+    # Lịch sử và event trực tiếp nằm trong cùng transaction: client đọc qua REST thấy cùng dữ liệu
+    # Run chưa đăng nhập vẫn có lịch sử riêng nhưng không được tính vào p50/p95 dùng chung
+    latency_scenario_id = row['scenario_id'] if row['requested_by'] is not None else None
+    publish_run_events(run_id, live, finish, latency_scenario_id, events)
+    return jsonify({'accepted': len(live)}), 202
+
+@app.route('/api/runs/<int:run_id>/events', methods=['POST'])
+def api_publish_run_events(run_id):
+    """API: Phát event trực tiếp của run do worker.py thực thi (worker tự lưu lịch sử)"""
+    conn = get_db_connection()
+    row = conn.execute('SELECT id, source, status, ingest_token FROM runs WHERE id = ?', (run_id,)).fetchone()
+    if row is None or not check_ingest_token(row):
+        return jsonify({'error': 'Run not found'}), 404
+    
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Request body must be a JSON object'}), 400
+    try:
+        _, live = parse_run_events(data.get('events', []))
+        finish = parse_run_finish(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    release_db_connection(None)
+    publish_run_events(run_id, live, finish)
+    return jsonify({'accepted': len(live)}), 202
+
+@app.route('/api/runs/<int:run_id>/steps', methods=['GET'])
+@login_required
+def api_get_run_steps(run_id):
+    """API: Các bước đã ghi nhận của một run"""
+    conn = get_db_connection()
+    if load_visible_run(conn, run_id) is None:
+        return jsonify({'error': 'Run not found'}), 404
+    rows = conn.execute('''
+        SELECT step_index, step_type, node_id, outcome, duration_ms, error, started_at
+        FROM run_steps WHERE run_id = ? ORDER BY step_index, id
+    ''', (run_id,)).fetchall()
+    return jsonify({'run_id': run_id, 'steps': [
+        {**dict(row), 'started_at': format_timestamp(row['started_at'])} for row in rows
+    ]})
+
+@app.route('/api/scenarios/<int:scenario_id>/runs', methods=['GET'])
+@login_required
+def api_list_scenario_runs(scenario_id):
+    """API: Lịch sử run của scenario, mới nhất trước (keyset theo ?before=<run id>)"""
+    scenario = load_cached_scenario(scenario_id)
+    if not scenario or not can_read_scenario(scenario):
+        return jsonify({'error': 'Scenario not found'}), 404
+    
+    limit = request.args.get('limit', app.config['PAGE_SIZE'], type=int)
+    before = request.args.get('before', type=int)
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    
+    # User chỉ thấy run của mình, admin thấy mọi run
+    visibility, params = '', []
+    if get_session_role() != 'admin':
+        visibility, params = 'AND requested_by = ?', [session['user_id']]
+    if before is not None:
+        visibility += ' AND id < ?'
+        params.append(before)
+    rows = get_db_connection().execute(f'''
+        SELECT * FROM runs WHERE scenario_id = ? {visibility}
+        ORDER BY id DESC LIMIT ?
+    ''', [scenario_id, *params, limit]).fetchall()
+    return jsonify({'runs': [run_payload(row) for row in rows]})
+
+class RunEventSubscriber:
+    """Một kết nối SSE: hàng đợi có giới hạn, đầy thì bị đánh dấu overflow để ngắt"""
+    
+    def __init__(self, run_id, max_pending):
+        self.run_id = run_id
+        self.max_pending = max_pending
+        self.pending = deque()
+        self.overflowed = False
+        self.wakeup = threading.Event()
+    
+    def push(self, event):
+        if self.overflowed:
+            return
+        if len(self.pending) >= self.max_pending:
+            # Client quá chậm: bỏ hàng đợi, client nối lại bằng Last-Event-ID
+            self.overflowed = True
+            self.pending.clear()
+        else:
+            self.pending.append(event)
+        self.wakeup.set()
+
+class RunEventBroadcaster:
+    """Chia event trong run_event_log cho các kết nối SSE của process này.
+    Mọi process (worker gunicorn, worker.py) ghi event vào bảng đó qua thread ghi;
+    mỗi process có một thread đọc tiếp bảng theo id, nên client nối vào worker nào
+    cũng nhận đủ event và id của event giống nhau ở mọi worker (dùng cho Last-Event-ID)"""
+    
+    def __init__(self, path):
+        self.path = path
+        self._subscribers = {}  # run_id -> set các RunEventSubscriber
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        conn = open_db_connection(path)
+        # Event đã có trước khi process bắt đầu theo dõi được gửi qua backlog của từng kết nối
+        self._last_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM run_event_log').fetchone()[0]
+        self._thread = threading.Thread(target=self._run, args=(conn,), name='run-event-tail', daemon=True)
+        self._thread.start()
+    
+    def subscribe(self, run_id):
+        """Đăng ký trước khi đọc backlog: mọi event commit sau lần đọc tiếp theo đều được đẩy tới"""
+        subscriber = RunEventSubscriber(run_id, app.config['RUN_EVENT_SUBSCRIBER_BUFFER'])
+        with self._lock:
+            self._subscribers.setdefault(run_id, set()).add(subscriber)
+        return subscriber
+    
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            subscribers = self._subscribers.get(subscriber.run_id)
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self._subscribers[subscriber.run_id]
+    
+    def notify(self):
+        """Có event vừa được commit trong process này, đọc ngay thay vì chờ lần poll kế tiếp"""
+        self._wakeup.set()
+    
+    def take(self, subscriber):
+        """Lấy các event đang chờ của subscriber"""
+        with self._lock:
+            subscriber.wakeup.clear()
+            events = list(subscriber.pending)
+            subscriber.pending.clear()
+            return events
+    
+    def counts(self):
+        """(số run đang được theo dõi, số kết nối)"""
+        with self._lock:
+            return len(self._subscribers), sum(len(subscribers) for subscribers in self._subscribers.values())
+    
+    def _run(self, conn):
+        while True:
+            self._wakeup.wait(app.config['RUN_EVENT_POLL_INTERVAL'])
+            self._wakeup.clear()
+            try:
+                self._poll(conn)
+            except sqlite3.Error:
+                app.logger.exception('Failed to read run events')
+    
+    def _poll(self, conn):
+        if not self._subscribers:
+            # Không ai theo dõi: chỉ dời mốc, kiểm tra lại dưới lock vì có thể vừa có người đăng ký
+            last_id = run_blocking_sqlite(
+                lambda: conn.execute('SELECT COALESCE(MAX(id), 0) FROM run_event_log').fetchone()[0])
+            with self._lock:
+                if not self._subscribers:
+                    self._last_id = last_id
+                    return
+        
+        while True:
+            rows = run_blocking_sqlite(lambda: conn.execute('''
+                SELECT id, run_id, kind, data FROM run_event_log WHERE id > ? ORDER BY id LIMIT 1000
+            ''', (self._last_id,)).fetchall())
+            if not rows:
+                return
+            with self._lock:
+                for event_id, run_id, kind, data in rows:
+                    for subscriber in self._subscribers.get(run_id, ()):
+                        subscriber.push((event_id, kind, data))
+                self._last_id = rows[-1][0]
+            if len(rows) < 1000:
+                return
+
+_run_events = None
+_run_events_lock = threading.Lock()
+
+def get_run_event_broadcaster():
+    """Broadcaster của process (tạo lại nếu đổi database)"""
+    global _run_events
+    with _run_events_lock:
+        broadcaster = _run_events
+        if broadcaster is None or broadcaster.path != app.config['DATABASE'] or not broadcaster._thread.is_alive():
+            broadcaster = _run_events = RunEventBroadcaster(app.config['DATABASE'])
+        return broadcaster
+
+def build_live_events(live, finish=None):
+    """Các (kind, data) cần ghi vào run_event_log, kèm run-finished nếu runner báo đã xong"""
+    events = list(live)
+    if finish:
+        events.append(('run-finished', {'status': finish[0], 'error': finish[1], 'steps_total': finish[2]}))
+    return events
+
+def publish_run_events(run_id, live, finish=None, scenario_id=None, steps=()):
+    """Ghi event trực tiếp (và step event nếu có) trong cùng transaction của thread ghi,
+    rồi báo broadcaster của process đọc ngay; các process khác thấy ở lần poll kế tiếp"""
+    live = build_live_events(live, finish)
+    get_step_event_writer().submit(run_id, scenario_id, list(steps), finish, live=live)
+    if live and _run_events is not None:
+        _run_events.notify()
+
+def load_finished_run(run_id):
+    """Run đã kết thúc (có thể do process khác ghi) hoặc None; dùng kết nối pool trong thời gian ngắn"""
+    pool = get_db_pool()
+    conn = pool.acquire()
+    try:
+        row = conn.execute('SELECT * FROM runs WHERE id = ?', (run_id,)).fetchone()
+    finally:
+        pool.release(conn)
+    if row is None or row['status'] in RUN_FINISHED_STATUSES:
+        return row
+    return None
+
+def format_sse(kind, data, event_id=None):
+    """Một event theo định dạng text/event-stream (data là JSON một dòng)"""
+    prefix = f'id: {event_id}\n' if event_id is not None else ''
+    return f'{prefix}event: {kind}\ndata: {data}\n\n'
+
+@app.route('/api/runs/<int:run_id>/events', methods=['GET'])
+@login_required
+def api_stream_run_events(run_id):
+    """API: Server-Sent Events tiến độ của run (step-started, step-finished, log, run-finished).
+    Client nối lại với Last-Event-ID (hoặc ?last_event_id=) để nhận tiếp các event đã lỡ"""
+    conn = get_db_connection()
+    row = load_visible_run(conn, run_id)
+    if row is None:
+        return jsonify({'error': 'Run not found'}), 404
+    
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id') or 0
+    try:
+        last_event_id = max(0, int(last_event_id))
+    except ValueError:
+        return jsonify({'error': 'Invalid Last-Event-ID'}), 400
+    
+    broadcaster = get_run_event_broadcaster()
+    subscriber = broadcaster.subscribe(run_id)
+    # Đọc backlog sau khi đăng ký: event trùng giữa hai nguồn được bỏ theo id
+    history = app.config['RUN_EVENT_HISTORY']
+    backlog = conn.execute('''
+        SELECT id, kind, data FROM run_event_log WHERE run_id = ? AND id > ? ORDER BY id DESC LIMIT ?
+    ''', (run_id, last_event_id, history + 1)).fetchall()
+    # Quá nhiều event bị lỡ: chỉ gửi các event gần nhất, client nên tải lại qua /api/runs/<id>/steps
+    missed = len(backlog) > history
+    backlog = [tuple(event) for event in reversed(backlog[:history])]
+    snapshot = app.json.dumps(run_payload(row))
+    run_finished = row['status'] in RUN_FINISHED_STATUSES
+    # Stream có thể kéo dài nhiều phút, không giữ kết nối database của pool
+    release_db_connection(None)
+    keepalive = app.config['RUN_EVENT_KEEPALIVE']
+    
+    def generate():
+        last_sent = last_event_id
+        yield 'retry: 3000\n\n'
+        # Trạng thái hiện tại (không có id nên không ảnh hưởng Last-Event-ID)
+        yield format_sse('run', snapshot)
+        if missed:
+            yield format_sse('reset', '{}')
+        for event_id, kind, data in backlog:
+            yield format_sse(kind, data, event_id)
+            last_sent = event_id
+        if run_finished or any(kind == 'run-finished' for _, kind, _ in backlog):
+            return
+        
+        while True:
+            if not subscriber.wakeup.wait(keepalive):
+                # Run có thể kết thúc mà không có run-finished (deadline, runner mất kết nối)
+                finished = load_finished_run(run_id)
+                if finished is not None:
+                    yield format_sse('run', app.json.dumps(run_payload(finished)))
+                    return
+                yield ': keepalive\n\n'
+                continue
+            events = [event for event in broadcaster.take(subscriber) if event[0] > last_sent]
+            for event_id, kind, data in events:
+                yield format_sse(kind, data, event_id)
+                last_sent = event_id
+            if subscriber.overflowed or any(kind == 'run-finished' for _, kind, _ in events):
+                # Overflow: đóng stream, EventSource tự nối lại với Last-Event-ID cuối cùng
+                return
+    
+    response = app.response_class(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+    # Gọi cả khi client ngắt trước khi stream bắt đầu
+    response.call_on_close(lambda: broadcaster.unsubscribe(subscriber))
+    return response
+
+def parse_latency_days():
+    """?days= của truy vấn độ trễ, trả về (số ngày, ngày bắt đầu tính theo UTC)"""
+    days = request.args.get('days', 7, type=int)
+    if not 0 < days <= app.config['RUN_LATENCY_MAX_DAYS']:
+        raise ValueError(f"days must be between 1 and {app.config['RUN_LATENCY_MAX_DAYS']}")
+    return days, int(time.time() // 86400) - days + 1
+
+def build_latency_report(rows):
+    """Gộp các dòng (step_type, bucket, count) thành p50/p95 theo loại bước và tổng"""
+    overall = Counter()
+    by_type = {}
+    for step_type, bucket, count in rows:
+        overall[bucket] += count
+        by_type.setdefault(step_type, Counter())[bucket] += count
+    return latency_percentiles(overall), {
+        step_type: latency_percentiles(histogram) for step_type, histogram in sorted(by_type.items())
+    }
+
+@app.route('/api/scenarios/<int:scenario_id>/step-latency', methods=['GET'])
+@login_required
+def api_scenario_step_latency(scenario_id):
+    """API: p50/p95 độ trễ của các bước trong một scenario, tổng và theo loại bước"""
+    scenario = load_cached_scenario(scenario_id)
+    if not scenario or not can_read_scenario(scenario):
+        return jsonify({'error': 'Scenario not found'}), 404
+    try:
+        days, first_day = parse_latency_days()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    rows = get_db_connection().execute('''
+        SELECT step_type, bucket, SUM(count) FROM step_latency_histogram
+        WHERE scenario_id = ? AND day >= ?
+        GROUP BY step_type, bucket
+    ''', (scenario_id, first_day)).fetchall()
+    overall, by_type = build_latency_report(rows)
+    return jsonify({'scenario_id': scenario_id, 'days': days, 'overall': overall, 'step_types': by_type})
+
+@app.route('/api/step-latency', methods=['GET'])
+@login_required
+def api_step_latency():
+    """API: p50/p95 độ trễ theo loại bước trên mọi scenario (?step_type= để lọc)"""
+    try:
+        days, first_day = parse_latency_days()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    step_type = request.args.get('step_type')
+    query = 'SELECT step_type, bucket, SUM(count) FROM step_latency_histogram WHERE day >= ?'
+    params = [first_day]
+    if step_type:
+        query += ' AND step_type = ?'
+        params.append(step_type)
+    rows = get_db_connection().execute(query + ' GROUP BY step_type, bucket', params).fetchall()
+    overall, by_type = build_latency_report(rows)
+    return jsonify({'days': days, 'overall': overall, 'step_types': by_type})
+
+def collect_pool_connections():
+    pool = _db_pool
+    if pool is None:
+        return []
+    opened, idle = pool.counts()
+    return [(('idle',), idle), (('in_use',), opened - idle)]
+
+def collect_step_event_writer(attribute):
+    writer = _step_event_writer
+    return [((), getattr(writer, attribute) if writer is not None else 0)]
+
+def collect_run_event_streams():
+    broadcaster = _run_events
+    runs, subscribers = broadcaster.counts() if broadcaster is not None else (0, 0)
+    return [(('runs',), runs), (('subscribers',), subscribers)]
+
+PROCESS_STARTED_AT = time.time()
+app_metrics.callback('process_start_time_seconds', 'Start time of the process (Unix epoch)',
+                     lambda: [((), PROCESS_STARTED_AT)], per_process=True)
+app_metrics.callback('db_pool_connections', 'SQLite connections held by the request pool', collect_pool_connections,
+                     ('state',))
+app_metrics.callback('scenario_cache_hits_total', 'Scenario cache lookups that hit',
+                     lambda: [((), scenario_cache.hits)], type='counter')
+app_metrics.callback('scenario_cache_misses_total', 'Scenario cache lookups that missed',
+                     lambda: [((), scenario_cache.misses)], type='counter')
+app_metrics.callback('scenario_cache_hit_ratio', 'Hit rate of the scenario cache since start', lambda: [(
+    (), scenario_cache.hits / (scenario_cache.hits + scenario_cache.misses)
+    if scenario_cache.hits + scenario_cache.misses else 0.0
+)], per_process=True)
+app_metrics.callback('scenario_cache_bytes', 'Estimated size of the scenario cache',
+                     lambda: [((), scenario_cache._size)])
+app_metrics.callback('scenario_cache_entries', 'Entries in the scenario cache',
+                     lambda: [((), len(scenario_cache._entries))])
+app_metrics.callback('step_event_batches_total', 'Step event batches written by the group-commit writer',
+                     lambda: collect_step_event_writer('batches'), type='counter')
+app_metrics.callback('step_event_transactions_total', 'Transactions committed by the group-commit writer',
+                     lambda: collect_step_event_writer('transactions'), type='counter')
+app_metrics.callback('run_event_streams', 'Runs followed over SSE and open SSE connections', collect_run_event_streams,
+                     ('kind',))
+
+class MetricsPublisher:
+    """Thread ghi snapshot metric của process vào metric_snapshots mỗi METRICS_PUBLISH_INTERVAL
+    giây, để worker nhận scrape gộp được metric của các worker khác"""
+    
+    def __init__(self, path):
+        self.path = path
+        # pid kèm thời điểm bắt đầu: process mới trùng pid không ghi đè counter của process đã dừng
+        self.process = f'{os.getpid()}-{int(time.time())}'
+        self._thread = threading.Thread(target=self._run, name='metrics-publisher', daemon=True)
+        self._thread.start()
+    
+    def _run(self):
+        conn = run_blocking_sqlite(open_db_connection, self.path)
+        while True:
+            try:
+                run_blocking_sqlite(self.publish, conn)
+            except sqlite3.Error:
+                app.logger.exception('Failed to publish metrics')
+            time.sleep(app.config['METRICS_PUBLISH_INTERVAL'])
+    
+    def publish(self, conn):
+        conn.execute('''
+            INSERT INTO metric_snapshots (process, data, updated_at) VALUES (?, ?, ?)
+            ON CONFLICT (process) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at
+        ''', (self.process, json.dumps(app_metrics.snapshot()), time.time()))
+        conn.commit()
+
+_metrics_publisher = None
+_metrics_publisher_lock = threading.Lock()
+
+def get_metrics_publisher():
+    """Thread ghi snapshot metric của process (tạo lại nếu đổi database hoặc sau fork)"""
+    global _metrics_publisher
+    with _metrics_publisher_lock:
+        publisher = _metrics_publisher
+        if publisher is None or publisher.path != app.config['DATABASE'] or not publisher._thread.is_alive():
+            publisher = _metrics_publisher = MetricsPublisher(app.config['DATABASE'])
+        return publisher
+
+def load_metric_snapshots(conn, process):
+    """Snapshot của các process khác [(process, snapshot, live)]. Process không ghi trong ba chu kỳ
+    được coi là đã dừng: counter / histogram của nó vẫn được cộng, gauge thì bỏ"""
+    live_after = time.time() - 3 * app.config['METRICS_PUBLISH_INTERVAL']
+    rows = conn.execute('SELECT process, data, updated_at FROM metric_snapshots WHERE process != ?',
+                        (process,)).fetchall()
+    return [(row['process'], json.loads(row['data']), row['updated_at'] >= live_after) for row in rows]
+
+def clear_metric_snapshots():
+    """Bỏ snapshot của các process lần chạy trước (gọi một lần khi server khởi động)"""
+    conn = open_db_connection()
+    try:
+        conn.execute('DELETE FROM metric_snapshots')
+        conn.commit()
+    finally:
+        conn.close()
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Metric theo định dạng text exposition của Prometheus: của process nhận request,
+    hoặc của mọi process khi bật METRICS_SHARED"""
+    token = app.config['METRICS_TOKEN']
+    if token and not hmac.compare_digest(request.headers.get('Authorization', '').encode(), f'Bearer {token}'.encode()):
+        return jsonify({'error': 'Unauthorized'}), 401
+    if not app.config['METRICS_SHARED']:
+        return app.response_class(app_metrics.render(), content_type=metrics.CONTENT_TYPE)
+    
+    process = get_metrics_publisher().process
+    others = load_metric_snapshots(get_db_connection(), process)
+    return app.response_class(app_metrics.render(others, process), content_type=metrics.CONTENT_TYPE)
+
 if __name__ == '__main__':
     # Khởi tạo database khi start server
     init_database()
@@ -1600,6 +1600,105 @@ function loadAdminScenarioPreview(scenarioId, stepsJson) {
     }
 }
 
+// Admin table only renders step counts; steps are fetched when a preview is expanded
+async function toggleAdminStepPreview(scenarioId) {
+    const preview = document.getElementById('adminStepPreview' + scenarioId);
+    if (!preview) return;
+    
+    if (preview.style.display !== 'none') {
+        preview.style.display = 'none';
+        return;
+    }
+    
+    preview.style.display = 'block';
+    if (preview.dataset.loaded) return;
+    
+    preview.innerHTML = '<div class="loading"></div>';
+    try {
+        const response = await fetch(`/api/scenarios/${scenarioId}/edit`);
+        if (!response.ok) throw new Error(`Server returned status ${response.status}`);
+        
+        const scenario = await response.json();
+        preview.innerHTML = renderStepPreview(scenario.steps);
+        preview.dataset.loaded = 'true';
+    } catch (error) {
+        console.error('Error loading steps preview:', error);
+        preview.textContent = 'Error loading steps';
+    }
+}
+
+// Bulk actions on the admin table: one request and one transaction for all selected rows
+function getSelectedAdminIds() {
+    return Array.from(document.querySelectorAll('.admin-row-select:checked'))
+        .map(checkbox => parseInt(checkbox.value, 10));
+}
+
+function updateBulkButtons() {
+    const hasSelection = getSelectedAdminIds().length > 0;
+    ['bulkToggleBtn', 'bulkDeleteBtn'].forEach(id => {
+        const button = document.getElementById(id);
+        if (button) button.disabled = !hasSelection;
+    });
+}
+
+function toggleAllAdminRows(checked) {
+    document.querySelectorAll('.admin-row-select').forEach(checkbox => {
+        if (checkbox.closest('tr').style.display !== 'none') checkbox.checked = checked;
+    });
+    updateBulkButtons();
+}
+
+async function bulkAdminAction(action) {
+    const ids = getSelectedAdminIds();
+    if (ids.length === 0) return;
+    
+    if (action === 'delete' && !confirm(`Are you sure you want to delete ${ids.length} scenarios?`)) {
+        return;
+    }
+    
+    try {
+        const response = await fetch('/api/scenarios/bulk', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ action: action, ids: ids })
+        });
+        const result = await response.json();
+        if (!response.ok) throw new Error(result.error || `Server returned status ${response.status}`);
+        
+        window.location.reload();
+    } catch (error) {
+        console.error('Bulk action failed:', error);
+        alert('Bulk action failed: ' + error.message);
+    }
+}
+
+// Streams an NDJSON backup of every scenario (see /api/scenarios/export)
+function exportScenarios() {
+    window.location.href = '/api/scenarios/export';
+}
+
+function adminViewScenario(scenarioId) {
+    toggleAdminStepPreview(scenarioId);
+}
+
+function renderStepPreview(stepsData) {
+    let steps = [];
+    if (stepsData && Array.isArray(stepsData.nodes)) {
+        steps = stepsData.nodes.filter(node => node.type !== 'start');
+    } else if (Array.isArray(stepsData)) {
+        steps = stepsData;
+    }
+    
+    if (steps.length === 0) return '<small class="text-muted">No steps</small>';
+    
+    const items = steps.map(step => {
+        const item = document.createElement('li');
+        item.textContent = step.type || 'unknown';
+        return item.outerHTML;
+    });
+    return `<ol>${items.join('')}</ol>`;
+}
+
 function viewWorkflow(scenarioId) {
     fetch(`/api/scenarios/${scenarioId}`)
         .then(response => response.json())
@@ -1807,10 +1906,20 @@ function refreshWorkflows() {
     window.location.reload(); 
 }
 
-function duplicateWorkflow(scenarioId) { 
-    if (confirm('Create a copy of this enhanced workflow?')) {
-        console.log('Duplicating enhanced workflow:', scenarioId);
-        // Implementation would be added here
+// The copy is made server-side and shares the original's stored steps, nothing is re-uploaded
+async function duplicateWorkflow(scenarioId) {
+    if (!confirm('Create a copy of this enhanced workflow?')) return;
+    
+    try {
+        const response = await fetch(`/api/scenarios/${scenarioId}/duplicate`, { method: 'POST' });
+        const result = await response.json();
+        if (!response.ok) throw new Error(result.error || `Server returned status ${response.status}`);
+        
+        showSuccessMessage('Workflow duplicated successfully!');
+        setTimeout(() => window.location.reload(), 1000);
+    } catch (error) {
+        console.error('Error duplicating workflow:', error);
+        alert('Error duplicating workflow: ' + error.message);
     }
 }
 
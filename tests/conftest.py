@@ -0,0 +1,26 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    """App trên một database mới tạo bằng init_database()"""
+    monkeypatch.setitem(server.app.config, 'DATABASE', str(tmp_path / 'test.db'))
+    monkeypatch.setitem(server.app.config, 'UPLOAD_FOLDER', str(tmp_path / 'uploads'))
+    server.ensure_upload_folders()
+    server.init_database()
+    server.scenario_cache.invalidate()
+    yield server.app
+    server.get_db_pool().close_all()
+
+@pytest.fixture
+def client(app):
+    """Test client đã đăng nhập bằng user demo"""
+    client = app.test_client()
+    client.post('/login', data={'username': 'demo', 'password': 'demo123'})
+    return client
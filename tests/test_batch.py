@@ -0,0 +1,24 @@
+import pytest
+
+@pytest.fixture
+def scenario_ids(client):
+    return [
+        client.post('/api/scenarios', json={'name': f's{index}', 'steps': [], 'is_public': True}).get_json()['id']
+        for index in range(2)
+    ]
+
+@pytest.mark.parametrize('url', ['/api/scenarios/batch-get', '/api/scenarios/bulk'])
+def test_non_object_body_is_400(client, url):
+    response = client.post(url, json=[1, 2])
+    assert response.status_code == 400
+
+@pytest.mark.parametrize('fields', ['id,name', ['id', 'name'], ' name , id '])
+def test_batch_get_fields_as_string_or_list(client, scenario_ids, fields):
+    response = client.post('/api/scenarios/batch-get', json={'ids': scenario_ids, 'fields': fields})
+    assert response.status_code == 200
+    assert response.get_json()['scenarios'] == [{'id': scenario_ids[0], 'name': 's0'}, {'id': scenario_ids[1], 'name': 's1'}]
+
+@pytest.mark.parametrize('fields', ['id,bogus', [1], {'id': True}])
+def test_batch_get_rejects_bad_fields(client, scenario_ids, fields):
+    response = client.post('/api/scenarios/batch-get', json={'ids': scenario_ids, 'fields': fields})
+    assert response.status_code == 400
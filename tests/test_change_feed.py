@@ -0,0 +1,44 @@
+def create(client, name, is_public):
+    response = client.post('/api/scenarios', json={'name': name, 'steps': [], 'is_public': is_public})
+    assert response.status_code == 201
+    return response.get_json()['id']
+
+def changes(client, since):
+    response = client.get(f'/api/scenarios/changes?since={since}&fields=id,name')
+    assert response.status_code == 200
+    return response.get_json()
+
+def test_private_scenarios_never_appear_in_feed(client):
+    public_id = create(client, 'public', True)
+    private_id = create(client, 'private', False)
+    since = changes(client, 0)['revision']
+    
+    client.put(f'/api/scenarios/{private_id}', json={'name': 'still private'})
+    client.delete(f'/api/scenarios/{private_id}')
+    client.put(f'/api/scenarios/{public_id}', json={'name': 'renamed'})
+    
+    for revision in (0, since, since + 1):
+        ids = [change['id'] for change in changes(client, revision)['changes']]
+        assert private_id not in ids
+    assert [change['id'] for change in changes(client, since)['changes']] == [public_id]
+
+def test_unpublished_and_deleted_public_scenarios_are_removed(client):
+    hidden_id = create(client, 'hidden later', True)
+    deleted_id = create(client, 'deleted later', True)
+    since = changes(client, 0)['revision']
+    
+    client.put(f'/api/scenarios/{hidden_id}', json={'is_public': False})
+    client.delete(f'/api/scenarios/{deleted_id}')
+    
+    feed = changes(client, since)['changes']
+    assert [(change['id'], change['deleted']) for change in feed] == [(hidden_id, True), (deleted_id, True)]
+    assert changes(client, 0)['changes'] == []
+
+def test_scenario_published_after_since_is_not_removed(client):
+    create(client, 'public', True)
+    since = changes(client, 0)['revision']
+    scenario_id = create(client, 'draft', False)
+    client.put(f'/api/scenarios/{scenario_id}', json={'is_public': True})
+    client.put(f'/api/scenarios/{scenario_id}', json={'is_public': False})
+    
+    assert changes(client, since)['changes'] == []
@@ -0,0 +1,30 @@
+import json
+
+def import_lines(client, items):
+    body = '\n'.join(json.dumps(item) for item in items).encode('utf-8')
+    return client.post('/api/scenarios/import', data=body, content_type='application/x-ndjson')
+
+def test_import_requires_boolean_is_public(app, client):
+    response = import_lines(client, [
+        {'name': 'string false', 'steps': [], 'is_public': 'false'},
+        {'name': 'zero', 'steps': [], 'is_public': 0},
+        {'name': 'private', 'steps': [], 'is_public': False},
+        {'name': 'public', 'steps': [], 'is_public': True},
+        {'name': 'default', 'steps': []},
+    ])
+    result = response.get_json()
+    assert response.status_code == 200
+    assert result['imported'] == 3
+    assert [(error['line'], error['error']) for error in result['errors']] == [
+        (1, 'is_public must be a boolean'),
+        (2, 'is_public must be a boolean'),
+    ]
+    
+    public = [item['name'] for item in client.get('/api/scenarios?fields=name').get_json()]
+    assert public == ['public']
+
+def test_export_round_trips_through_import(client):
+    import_lines(client, [{'name': 'a', 'steps': [{'type': 'wait'}], 'is_public': True}])
+    exported = client.get('/api/scenarios/export').get_data()
+    response = client.post('/api/scenarios/import', data=exported, content_type='application/x-ndjson')
+    assert response.get_json()['failed'] == 0
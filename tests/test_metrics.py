@@ -0,0 +1,72 @@
+import pytest
+
+import metrics
+import server
+
+@pytest.mark.parametrize('sql, label', [
+    ('SELECT id, name FROM automation_scenarios WHERE id = ?', 'SELECT automation_scenarios'),
+    ('SELECT name, steps, revision FROM automation_scenarios WHERE id IN (?, ?, ?)', 'SELECT automation_scenarios'),
+    ("\n  SELECT value FROM app_meta WHERE key = 'scenarios_version'", 'SELECT app_meta'),
+    ('INSERT OR REPLACE INTO scenario_tombstones (scenario_id, revision) VALUES (?, ?)', 'INSERT scenario_tombstones'),
+    ('UPDATE automation_scenarios SET updated_at = ? WHERE id = ?', 'UPDATE automation_scenarios'),
+    ('DELETE FROM step_blobs WHERE refcount = 0', 'DELETE step_blobs'),
+    ('-- comment\nSELECT 1', 'SELECT'),
+    ('CREATE INDEX IF NOT EXISTS idx ON automation_scenarios (revision)', None),
+    ('PRAGMA user_version', None),
+    ('BEGIN IMMEDIATE', None),
+])
+def test_sql_fingerprint(sql, label):
+    assert metrics.sql_fingerprint(sql) == label
+
+def test_statement_labels_stay_bounded(app, monkeypatch):
+    monkeypatch.setitem(app.config, 'METRICS_ENABLED', True)
+    monkeypatch.setattr(server, '_statement_labels', {})
+    monkeypatch.setattr(server, '_statement_fingerprints', set())
+    
+    conn = server.open_db_connection()
+    server.migrate_database(conn)
+    for fields in (['id'], ['id', 'name'], ['name', 'description', 'revision']):
+        conn.execute(f'SELECT {", ".join(fields)} FROM automation_scenarios').fetchall()
+    conn.execute('CREATE TABLE IF NOT EXISTS scratch (id INTEGER)')
+    conn.close()
+    
+    assert server._statement_fingerprints == {'SELECT automation_scenarios'}
+
+def test_registry_merges_other_process_snapshots():
+    registry = metrics.Registry()
+    requests = registry.counter('requests_total', 'Requests', ('route',))
+    latency = registry.histogram('latency_seconds', 'Latency', buckets=(1,))
+    registry.callback('pool_connections', 'Connections', lambda: [((), 2)])
+    registry.callback('started_at', 'Start time', lambda: [((), 100)], per_process=True)
+    requests.inc('/a')
+    latency.observe(0.5)
+    
+    other = registry.snapshot()
+    requests.inc('/b')
+    text = registry.render([('p2', other, True), ('p3', other, False)], process='p1')
+    
+    assert 'requests_total{route="/a"} 3' in text
+    assert 'requests_total{route="/b"} 1' in text
+    assert 'latency_seconds_count 3' in text
+    # Gauge của process đã dừng (p3) không được cộng
+    assert 'pool_connections 4' in text
+    assert 'started_at{process="p1"} 100' in text and 'started_at{process="p2"} 100' in text
+    assert 'process="p3"' not in text
+
+def test_shared_metrics_include_other_workers(app, client, monkeypatch):
+    monkeypatch.setitem(app.config, 'METRICS_SHARED', True)
+    client.get('/metrics')
+    publisher = server.get_metrics_publisher()
+    conn = server.open_db_connection()
+    publisher.publish(conn)
+    conn.execute('INSERT INTO metric_snapshots (process, data, updated_at) VALUES (?, ?, ?)', (
+        'other', '{"sqlite_statement_errors_total": [[["SELECT missing"], 5]]}', server.time.time(),
+    ))
+    conn.commit()
+    
+    assert conn.execute('SELECT COUNT(*) FROM metric_snapshots WHERE process = ?',
+                        (publisher.process,)).fetchone()[0] == 1
+    conn.close()
+    text = client.get('/metrics').get_data(as_text=True)
+    assert 'sqlite_statement_errors_total{statement="SELECT missing"} 5' in text
+    assert f'process_start_time_seconds{{process="{publisher.process}"}}' in text
@@ -0,0 +1,55 @@
+import pytest
+
+import server
+
+LISTING_QUERIES = {
+    'automation': (server.AUTOMATION_PAGE_QUERY, (1, 50, 100)),
+    'admin': (server.ADMIN_PAGE_QUERY, (50, 100)),
+    'page_rows': (server.build_page_rows_query(3), (1, 2, 3)),
+    'api_public': (server.build_public_list_query(server.SCENARIO_LIST_FIELDS), ()),
+    'api_public_page': (server.build_public_list_query(server.SCENARIO_LIST_FIELDS, True, True), ('', 0, 1)),
+    'api_public_type_page': (server.build_public_list_query(server.SCENARIO_LIST_FIELDS, True, True, True), ('visual', '', 0, 1)),
+    'public_count': ('SELECT COUNT(*) FROM automation_scenarios WHERE is_public = 1', ()),
+}
+
+@pytest.fixture
+def conn(app):
+    conn = server.open_db_connection()
+    yield conn
+    conn.close()
+
+@pytest.mark.parametrize('name', LISTING_QUERIES)
+def test_listing_query_is_index_backed(conn, name):
+    query, params = LISTING_QUERIES[name]
+    plan = [row['detail'] for row in conn.execute(f'EXPLAIN QUERY PLAN {query}', params).fetchall()]
+    
+    assert not [detail for detail in plan if detail.startswith('SCAN')], plan
+    assert not [detail for detail in plan if 'TEMP B-TREE' in detail], plan
+    assert any(detail.startswith('SEARCH') for detail in plan), plan
+
+def test_audit_query_plans_is_clean(conn):
+    assert server.audit_query_plans(conn) == []
+
+def test_pages_keep_order_and_visibility(app, conn):
+    demo = conn.execute("SELECT id FROM users WHERE username = 'demo'").fetchone()[0]
+    admin = conn.execute("SELECT id FROM users WHERE username = 'admin'").fetchone()[0]
+    cursor = conn.cursor()
+    expected = []
+    for index, (owner, is_public) in enumerate([(admin, True), (demo, False), (admin, False), (demo, True)]):
+        scenario_id = server.insert_scenario(cursor, f's{index}', '', [], is_public, owner)
+        cursor.execute('UPDATE automation_scenarios SET updated_at = ? WHERE id = ?', (f'2024-01-0{index + 1}', scenario_id))
+        expected.append(scenario_id)
+    conn.commit()
+    
+    visible = server.load_page_rows(conn, server.AUTOMATION_PAGE_QUERY, (demo, 2, 0))
+    assert [row['id'] for row in visible] == [expected[3], expected[1]]
+    visible = server.load_page_rows(conn, server.AUTOMATION_PAGE_QUERY, (demo, 2, 2))
+    assert [row['id'] for row in visible] == [expected[0]]
+    
+    everything = server.load_page_rows(conn, server.ADMIN_PAGE_QUERY, (10, 0))
+    assert [row['id'] for row in everything] == expected[::-1]
+    assert everything[0]['creator_name'] == 'demo'
+
+def test_api_rejects_non_boolean_is_public(client):
+    response = client.post('/api/scenarios', json={'name': 'a', 'steps': [], 'is_public': 'yes'})
+    assert response.status_code == 400
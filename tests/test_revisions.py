@@ -0,0 +1,88 @@
+import sqlite3
+
+import pytest
+
+import server
+
+def create(client):
+    response = client.post('/api/scenarios', json={'name': 'a', 'steps': [], 'is_public': True})
+    assert response.status_code == 201
+    return response.get_json()['id']
+
+def current_revision(client, scenario_id):
+    etag = client.get(f'/api/scenarios/{scenario_id}').headers['ETag'].strip('"')
+    return int(etag.rsplit('-', 1)[1])
+
+@pytest.mark.parametrize('revision', ['1', 1.0, True, [1], {'n': 1}])
+def test_patch_rejects_non_integer_revision(client, revision):
+    scenario_id = create(client)
+    response = client.patch(f'/api/scenarios/{scenario_id}', json={
+        'revision': revision,
+        'patch': [{'op': 'replace', 'path': '/name', 'value': 'b'}],
+    })
+    assert response.status_code == 400
+
+def test_patch_with_integer_revision(client):
+    scenario_id = create(client)
+    response = client.patch(f'/api/scenarios/{scenario_id}', json={
+        'revision': current_revision(client, scenario_id),
+        'patch': [{'op': 'replace', 'path': '/name', 'value': 'b'}],
+    })
+    assert response.status_code == 200
+
+@pytest.mark.parametrize('revision', ['1', 1.5, False])
+def test_restore_rejects_non_integer_revision(client, revision):
+    scenario_id = create(client)
+    response = client.post(f'/api/scenarios/{scenario_id}/revisions/1/restore', json={'revision': revision})
+    assert response.status_code == 400
+
+def test_restore_rejects_non_object_body(client):
+    scenario_id = create(client)
+    response = client.post(f'/api/scenarios/{scenario_id}/revisions/1/restore', json=[1])
+    assert response.status_code == 400
+
+def revision_numbers(client, scenario_id):
+    return [item['number'] for item in client.get(f'/api/scenarios/{scenario_id}/revisions').get_json()['revisions']]
+
+def test_plain_sqlite_connection_can_write_scenarios(app, client):
+    scenario_id = create(client)
+    
+    # Không có hàm SQL của app: như sqlite3 CLI hay script vận hành
+    conn = sqlite3.connect(app.config['DATABASE'])
+    conn.execute("UPDATE automation_scenarios SET name = 'renamed' WHERE id = ?", (scenario_id,))
+    conn.execute("INSERT INTO automation_scenarios (name, steps) VALUES ('raw', '[]')")
+    conn.commit()
+    conn.close()
+    
+    server.scenario_cache.invalidate(scenario_id)
+    assert client.get(f'/api/scenarios/{scenario_id}').get_json()['name'] == 'renamed'
+    assert [item['name'] for item in client.get('/api/scenarios/search?q=renamed').get_json()] == ['renamed']
+
+def test_revision_settings_come_from_app_meta(app, client, monkeypatch):
+    monkeypatch.setitem(app.config, 'SCENARIO_REVISION_WINDOW', 0)
+    monkeypatch.setitem(app.config, 'SCENARIO_REVISION_LIMIT', 3)
+    conn = server.open_db_connection()
+    server.store_revision_settings(conn)
+    conn.close()
+    # Process khác với cấu hình khác vẫn dùng giới hạn đã lưu trong database
+    monkeypatch.setitem(app.config, 'SCENARIO_REVISION_LIMIT', 100)
+    
+    scenario_id = create(client)
+    for index in range(5):
+        client.put(f'/api/scenarios/{scenario_id}', json={'steps': [{'type': 'wait', 'duration': index}]})
+    assert revision_numbers(client, scenario_id) == [6, 5, 4]
+    
+    client.put(f'/api/scenarios/{scenario_id}', json={'is_public': True})
+    assert revision_numbers(client, scenario_id) == [6, 5, 4]
+
+def test_revisions_within_window_are_coalesced(app, client):
+    scenario_id = create(client)
+    for index in range(3):
+        client.put(f'/api/scenarios/{scenario_id}', json={'name': f'n{index}'})
+    revisions = client.get(f'/api/scenarios/{scenario_id}/revisions').get_json()['revisions']
+    assert [item['number'] for item in revisions] == [4, 1]
+
+def test_duplicate_rejects_non_object_body(client):
+    scenario_id = create(client)
+    assert client.post(f'/api/scenarios/{scenario_id}/duplicate', json=['copy']).status_code == 400
+    assert client.post(f'/api/scenarios/{scenario_id}/duplicate', json={'name': 'copy'}).status_code == 201
@@ -0,0 +1,92 @@
+import pytest
+
+import server
+
+@pytest.mark.parametrize('url', [
+    'file:///etc/passwd',
+    'ftp://example.com/',
+    'http://localhost:5000/',
+    'http://127.0.0.1/',
+    'http://10.0.0.5/admin',
+    'http://169.254.169.254/latest/meta-data/',
+    'http://[::1]/',
+    'http://[::ffff:127.0.0.1]/',
+])
+def test_run_url_error_blocks_local_targets(app, url):
+    assert server.run_url_error(url, resolve=False)
+
+@pytest.mark.parametrize('url', ['about:blank', 'https://93.184.216.34/', 'https://example.com/path'])
+def test_run_url_error_allows_public_targets(app, url):
+    assert server.run_url_error(url, resolve=False) is None
+
+def test_run_url_error_resolves_hosts(app, monkeypatch):
+    monkeypatch.setattr(server.socket, 'getaddrinfo', lambda *args, **kwargs: [(2, 1, 6, '', ('192.168.1.10', 80))])
+    assert server.run_url_error('http://intranet.example/')
+    assert server.run_url_error('http://intranet.example/', resolve=False) is None
+
+def test_enqueue_rejects_blocked_urls(client):
+    response = client.post('/api/scenarios', json={
+        'name': 'reader',
+        'steps': [{'type': 'open_url', 'url': 'file:///etc/passwd'}, {'type': 'get_text', 'xpath': '//body'}],
+    })
+    scenario_id = response.get_json()['id']
+    response = client.post(f'/api/scenarios/{scenario_id}/runs', json={})
+    assert response.status_code == 400
+    assert response.get_json()['error'].startswith('Step 1:')
+
+def test_enqueue_accepts_public_urls(client):
+    response = client.post('/api/scenarios', json={
+        'name': 'public', 'steps': [{'type': 'open_url', 'url': 'https://example.com/'}],
+    })
+    scenario_id = response.get_json()['id']
+    assert client.post(f'/api/scenarios/{scenario_id}/runs', json={}).status_code == 202
+
+def test_enqueue_rejects_non_object_body(client):
+    response = client.post('/api/scenarios', json={
+        'name': 'public', 'steps': [{'type': 'open_url', 'url': 'https://example.com/'}],
+    })
+    scenario_id = response.get_json()['id']
+    assert client.post(f'/api/scenarios/{scenario_id}/runs', json=[60]).status_code == 400
+
+def create_public_scenario(client):
+    response = client.post('/api/scenarios', json={
+        'name': 'desktop', 'is_public': True, 'steps': [{'type': 'wait', 'duration': 1}],
+    })
+    return response.get_json()['id']
+
+def histogram_total(app):
+    conn = server.open_db_connection(app.config['DATABASE'])
+    try:
+        return conn.execute('SELECT COALESCE(SUM(count), 0) FROM step_latency_histogram').fetchone()[0]
+    finally:
+        conn.close()
+
+def test_desktop_runs_are_capped_per_anonymous_client(app, client, monkeypatch):
+    monkeypatch.setitem(app.config, 'RUN_MAX_OPEN_DESKTOP_PER_CLIENT', 2)
+    scenario_id = create_public_scenario(client)
+    anonymous = app.test_client()
+    for _ in range(2):
+        assert anonymous.post('/api/runs', json={'scenario_id': scenario_id}).status_code == 201
+    assert anonymous.post('/api/runs', json={'scenario_id': scenario_id}).status_code == 429
+    other = anonymous.post('/api/runs', json={'scenario_id': scenario_id}, environ_base={'REMOTE_ADDR': '10.1.2.3'})
+    assert other.status_code == 201
+    # Run của user đăng nhập được đếm riêng
+    assert client.post('/api/runs', json={'scenario_id': scenario_id}).status_code == 201
+
+def test_anonymous_desktop_runs_skip_latency_histogram(app, client):
+    scenario_id = create_public_scenario(client)
+    event = {'step_index': 0, 'type': 'wait', 'duration_ms': 12.5, 'outcome': 'succeeded'}
+    for runner in (app.test_client(), client):
+        run = runner.post('/api/runs', json={'scenario_id': scenario_id}).get_json()
+        response = runner.post(f"/api/runs/{run['id']}/steps", json={'events': [event], 'status': 'succeeded'},
+                               headers={'X-Run-Token': run['ingest_token']})
+        assert response.status_code == 202
+    assert histogram_total(app) == 1
+
+def test_desktop_run_endpoints_reject_non_object_bodies(app, client):
+    scenario_id = create_public_scenario(client)
+    assert client.post('/api/runs', json=[scenario_id]).status_code == 400
+    run = client.post('/api/runs', json={'scenario_id': scenario_id}).get_json()
+    headers = {'X-Run-Token': run['ingest_token']}
+    assert client.post(f"/api/runs/{run['id']}/steps", json=[{}], headers=headers).status_code == 400
+    assert client.post(f"/api/runs/{run['id']}/events", json=[{}], headers=headers).status_code == 400
@@ -0,0 +1,18 @@
+import pytest
+
+def create(client):
+    response = client.post('/api/scenarios', json={'name': 'a', 'steps': [], 'is_public': True})
+    assert response.status_code == 201
+    return response.get_json()['id']
+
+@pytest.mark.parametrize('scenario_id', ['abc', '1.5', ''])
+def test_form_update_rejects_invalid_id(client, scenario_id):
+    response = client.post('/api/scenarios/update', data={'id': scenario_id, 'name': 'b', 'description': ''})
+    assert response.status_code == 400
+
+def test_form_update_invalidates_cached_scenario(client):
+    scenario_id = create(client)
+    assert client.get(f'/api/scenarios/{scenario_id}').get_json()['name'] == 'a'
+    response = client.post('/api/scenarios/update', data={'id': str(scenario_id), 'name': 'b', 'description': ''})
+    assert response.status_code == 200
+    assert client.get(f'/api/scenarios/{scenario_id}').get_json()['name'] == 'b'
@@ -0,0 +1,33 @@
+import sqlite3
+
+import server
+
+def search(client, text):
+    return [item['name'] for item in client.get(f'/api/scenarios/search?q={text}').get_json()]
+
+def test_search_follows_api_writes(client):
+    scenario_id = client.post('/api/scenarios', json={
+        'name': 'Đăng nhập', 'steps': [{'type': 'open_url', 'url': 'https://example.com/login'}], 'is_public': True,
+    }).get_json()['id']
+    assert search(client, 'dang nhap') == ['Đăng nhập']
+    assert search(client, 'example') == ['Đăng nhập']
+    
+    client.put(f'/api/scenarios/{scenario_id}', json={'name': 'Checkout'})
+    assert search(client, 'dang') == []
+    assert search(client, 'checkout') == ['Checkout']
+
+def test_plain_sqlite_connection_can_delete(app, client):
+    scenario_id = client.post('/api/scenarios', json={'name': 'Orphan', 'steps': [], 'is_public': True}).get_json()['id']
+    assert search(client, 'orphan') == ['Orphan']
+    
+    # Không có hàm SQL của app: như sqlite3 CLI hay script vận hành
+    conn = sqlite3.connect(app.config['DATABASE'])
+    conn.execute('DELETE FROM automation_scenarios WHERE id = ?', (scenario_id,))
+    conn.commit()
+    conn.close()
+    
+    assert search(client, 'orphan') == []
+    conn = server.open_db_connection()
+    assert conn.execute('SELECT COUNT(*) FROM scenarios_fts_pending').fetchone()[0] == 0
+    assert conn.execute("INSERT INTO scenarios_fts (scenarios_fts, rank) VALUES ('integrity-check', 1)").fetchall() == []
+    conn.close()
@@ -0,0 +1,49 @@
+import threading
+import time
+
+import server
+
+STEPS = [{'type': 'open_url', 'url': 'https://example.com'}, {'type': 'wait', 'duration': 1}]
+
+def test_blob_survives_collection_between_store_and_write(app):
+    """Blob refcount = 0 (scenario đã xóa) được dùng lại: GC chạy giữa store_steps và lần ghi không được xóa nó"""
+    writer = server.open_db_connection()
+    scenario_id = server.insert_scenario(writer.cursor(), 'a', '', STEPS, False, None)
+    writer.commit()
+    writer.execute('DELETE FROM automation_scenarios WHERE id = ?', (scenario_id,))
+    writer.commit()
+    
+    reference = server.store_steps(STEPS, writer)
+    collector_conn = server.open_db_connection()
+    collector = threading.Thread(target=server.collect_step_blobs, args=(collector_conn,))
+    collector.start()
+    time.sleep(0.2)  # GC đang chờ khóa ghi
+    writer.execute('INSERT INTO automation_scenarios (name, steps) VALUES (?, ?)', ('b', reference))
+    writer.commit()
+    collector.join()
+    
+    assert server.decode_steps(reference, writer) == STEPS
+    assert writer.execute('SELECT refcount FROM step_blobs').fetchone()[0] == 1
+    writer.close()
+    collector_conn.close()
+
+def test_delete_resave_collect(client):
+    scenario_id = client.post('/api/scenarios', json={'name': 'a', 'steps': STEPS}).get_json()['id']
+    assert client.delete(f'/api/scenarios/{scenario_id}').status_code == 200
+    
+    scenario_id = client.post('/api/scenarios', json={'name': 'b', 'steps': STEPS}).get_json()['id']
+    conn = server.open_db_connection()
+    server.collect_step_blobs(conn)
+    conn.close()
+    
+    assert client.get(f'/api/scenarios/{scenario_id}/edit').get_json()['steps'] == STEPS
+    assert client.get(f'/api/scenarios/{scenario_id}/revisions/1').get_json()['steps'] == STEPS
+
+def test_unreferenced_blobs_are_collected(client):
+    scenario_id = client.post('/api/scenarios', json={'name': 'a', 'steps': STEPS}).get_json()['id']
+    client.delete(f'/api/scenarios/{scenario_id}')
+    
+    conn = server.open_db_connection()
+    assert server.collect_step_blobs(conn) == 1
+    assert conn.execute('SELECT COUNT(*) FROM step_blobs').fetchone()[0] == 0
+    conn.close()
@@ -0,0 +1,41 @@
+import io
+
+def test_upload_deduplicates_content(client):
+    first = client.post('/upload?filename=a.txt', data=b'hello')
+    second = client.post('/upload', data={'file': (io.BytesIO(b'hello'), 'b.txt')})
+    assert first.status_code == 200 and second.status_code == 200
+    assert second.get_json()['deduplicated'] is True
+    assert first.get_json()['sha256'] == second.get_json()['sha256']
+
+def test_oversize_raw_upload_is_413(app, client, monkeypatch):
+    monkeypatch.setitem(app.config, 'MAX_CONTENT_LENGTH', 1024)
+    response = client.post('/upload?filename=big.txt', data=b'x' * 4096)
+    assert response.status_code == 413
+
+def test_oversize_multipart_upload_is_413(app, client, monkeypatch):
+    monkeypatch.setitem(app.config, 'MAX_CONTENT_LENGTH', 1024)
+    response = client.post('/upload', data={'file': (io.BytesIO(b'x' * 4096), 'big.txt')})
+    assert response.status_code == 413
+
+def test_blob_requires_live_reference(app, client):
+    digest = client.post('/upload?filename=secret.txt', data=b'secret').get_json()['sha256']
+    
+    response = client.get(f'/api/uploads/{digest}')
+    assert response.status_code == 200 and response.data == b'secret'
+    assert response.headers['Cache-Control'].startswith('private')
+    
+    assert app.test_client().get(f'/api/uploads/{digest}').status_code == 404
+    other = app.test_client()
+    other.post('/login', data={'username': 'admin', 'password': 'admin123'})
+    assert other.get(f'/api/uploads/{digest}').status_code == 404
+
+def test_blob_readable_by_runner_of_owner(app, client):
+    digest = client.post('/upload?filename=data.txt', data=b'a,b').get_json()['sha256']
+    scenario_id = client.post('/api/scenarios', json={'name': 's', 'steps': []}).get_json()['id']
+    run = client.post('/api/runs', json={'scenario_id': scenario_id}).get_json()
+    
+    runner = app.test_client()
+    url = f"/api/uploads/{digest}?run={run['id']}"
+    assert runner.get(url).status_code == 404
+    assert runner.get(url, headers={'X-Run-Token': 'wrong'}).status_code == 404
+    assert runner.get(url, headers={'X-Run-Token': run['ingest_token']}).data == b'a,b'
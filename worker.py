@@ -0,0 +1,373 @@
+"""Worker headless thực thi các run trong hàng đợi của server (bảng runs).
+
+Chạy trên máy dùng chung database và thư mục uploads với server:
+
+    python worker.py --concurrency 4
+
+Mỗi slot nhận một run, mở Chrome headless và thực thi execution plan bằng
+chính step engine của AutomationApp (main.py). SIGTERM / Ctrl+C: ngừng nhận
+run mới và chờ các run đang chạy tối đa RUN_DRAIN_TIMEOUT giây; nhấn Ctrl+C
+lần nữa để dừng ngay.
+
+Chrome chạy với sandbox và web security như mặc định (scenario là của bất kỳ
+user nào), nên worker phải chạy bằng user không phải root.
+"""
+import argparse
+import os
+import shutil
+import signal
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from urllib.parse import urlsplit
+
+from selenium import webdriver
+from werkzeug.utils import secure_filename
+
+import server
+from main import AutomationApp
+
+# Nghỉ giữa hai bước như runner desktop
+STEP_DELAY = 0.5
+
+# Giây giữa hai vòng giám sát: độ trễ tối đa khi áp dụng hủy / deadline
+SUPERVISE_INTERVAL = 5
+
+# Cờ của runner desktop tắt cơ chế bảo vệ của Chrome, không dùng cho scenario của user khác
+UNSAFE_CHROME_ARGUMENTS = ('--no-sandbox', '--disable-web-security', '--allow-running-insecure-content')
+
+# Trang do chính Chrome tạo, không có nội dung từ mạng hay file
+INTERNAL_URL_SCHEMES = ('about', 'data', 'chrome-error')
+
+class Setting:
+    """Thay cho tk.StringVar / tk.BooleanVar khi chạy không có giao diện"""
+    
+    def __init__(self, value):
+        self.value = value
+    
+    def get(self):
+        return self.value
+    
+    def set(self, value):
+        self.value = value
+
+class RunRejected(Exception):
+    """Run không thể thực thi trên server (scenario đã xóa, thiếu file upload...)"""
+
+class HeadlessAutomation(AutomationApp):
+    """Step engine của AutomationApp không có Tk: log ra stdout, file nằm trong thư mục của run"""
+    
+    def __init__(self, run_id, workspace):
+        # Không gọi AutomationApp.__init__ vì nó dựng giao diện Tk
+        self.run_id = run_id
+        self.workspace = workspace
+        self.driver = None
+        self.tab_handles = {}
+        self.current_tab = None
+        self.variables = {}
+        self.execution_stopped = False
+        self.show_browser = Setting(False)
+        self.upload_folder = Setting(os.path.abspath(os.path.join(workspace, 'uploads')))
+        self.download_path = Setting(os.path.abspath(os.path.join(workspace, 'downloads')))
+        self.status = ''
+        self.publishing = True
+        self.checked_url = None
+    
+    def log_message(self, message, level="INFO"):
+        print(f"[{time.strftime('%H:%M:%S')}] run {self.run_id} {level}: {message}", flush=True)
+        self.publish('log', level=level, message=str(message)[:2000], at=time.time())
+    
+    def publish(self, kind, **data):
+        """Ghi event trực tiếp vào run_event_log (server đọc và phát qua SSE), không chờ commit"""
+        if self.publishing:
+            server.get_step_event_writer().submit(self.run_id, None, [], live=[(kind, data)], wait=False)
+    
+    def update_status(self, status):
+        self.status = status
+    
+    def build_chrome_options(self):
+        """Tùy chọn của runner desktop, bỏ các cờ tắt sandbox / same-origin policy"""
+        options = super().build_chrome_options()
+        options.arguments[:] = [argument for argument in options.arguments if argument not in UNSAFE_CHROME_ARGUMENTS]
+        return options
+    
+    def check_current_url(self):
+        """Rời trang hiện tại nếu nó nằm ở địa chỉ bị chặn (JavaScript hay redirect có thể
+        điều hướng tới đó dù URL trong plan hợp lệ)"""
+        url = self.driver.current_url if self.driver else None
+        if not url or url == self.checked_url or urlsplit(url).scheme in INTERNAL_URL_SCHEMES:
+            return
+        error = server.run_url_error(url)
+        if error:
+            self.driver.get('about:blank')
+            raise RunRejected(f'Navigation blocked: {error}')
+        self.checked_url = url
+    
+    def execute_step(self, step):
+        """Như AutomationApp, kiểm tra trang hiện tại trước và sau bước để bước sau
+        không đọc được nội dung của địa chỉ bị chặn"""
+        self.check_current_url()
+        result = super().execute_step(step)
+        self.check_current_url()
+        return result
+    
+    def setup_webdriver(self):
+        """Mở Chrome headless; lỗi được ném ra để run bị đánh dấu thất bại"""
+        self.driver = webdriver.Chrome(options=self.build_chrome_options())
+        self.driver.implicitly_wait(10)
+        self.tab_handles = {"main_tab": self.driver.current_window_handle}
+        self.current_tab = "main_tab"
+        return True
+    
+    def close(self):
+        """Đóng trình duyệt; bước đang chờ trình duyệt sẽ thoát ra với lỗi"""
+        driver, self.driver = self.driver, None
+        if driver:
+            try:
+                driver.quit()
+            except Exception:
+                pass
+    
+    def prepare_workspace(self, conn, user_id, steps):
+        """Tạo thư mục của run và giới hạn mọi đường dẫn trong plan vào đó.
+        file_path của bước upload là tên file user đã upload lên server (POST /upload)."""
+        os.makedirs(self.upload_folder.get(), exist_ok=True)
+        os.makedirs(self.download_path.get(), exist_ok=True)
+        screenshots = os.path.abspath(os.path.join(self.workspace, 'screenshots'))
+        
+        for index, step in enumerate(steps, 1):
+            step_type = step.get('type')
+            if step_type == 'upload' and step.get('file_path'):
+                filename = secure_filename(os.path.basename(step['file_path']))
+                ref = conn.execute('''
+                    SELECT sha256 FROM upload_refs
+                    WHERE user_id = ? AND original_filename = ? AND expires_at > ?
+                    ORDER BY created_at DESC LIMIT 1
+                ''', (user_id, filename, time.time())).fetchone()
+                if ref is None:
+                    raise RunRejected(f"Step {index}: upload '{filename}' not found, upload it first")
+                
+                target = os.path.join(self.upload_folder.get(), filename)
+                if not os.path.exists(target):
+                    # Hard link giữ nội dung kể cả khi blob bị dọn trong lúc chạy
+                    try:
+                        os.link(server.upload_blob_path(ref['sha256']), target)
+                    except OSError:
+                        shutil.copyfile(server.upload_blob_path(ref['sha256']), target)
+                step['file_path'] = filename
+            elif step_type in server.RUN_URL_STEP_TYPES:
+                error = server.run_url_error(step.get('url'))
+                if error:
+                    raise RunRejected(f"Step {index}: {error}")
+            elif step_type == 'download':
+                step['save_path'] = ''
+            elif step_type == 'screenshot':
+                filename = secure_filename(os.path.basename(step.get('save_path') or '')) or f'step_{index}.png'
+                step['save_path'] = os.path.join(screenshots, filename)
+
+class ActiveRun:
+    """Run đang thực thi trong một slot"""
+    
+    def __init__(self, row, automation):
+        self.id = row['id']
+        self.automation = automation
+        self.deadline_seconds = row['deadline_seconds']
+        self.deadline_at = time.time() + row['deadline_seconds']
+        self.steps_succeeded = 0
+        self.stop_status = None
+        self.stop_error = None
+    
+    def stop(self, status, error, force=False):
+        """Dừng sau bước hiện tại; force (hoặc lần yêu cầu thứ hai) đóng luôn trình duyệt"""
+        if self.stop_status is None:
+            self.stop_status, self.stop_error = status, error
+            self.automation.execution_stopped = True
+            self.automation.log_message(f"Stopping: {error}", "WARNING")
+            if not force:
+                return
+        self.automation.close()
+
+class RunWorkerPool:
+    """Các slot thực thi run song song cùng một vòng giám sát (gia hạn lease, hủy, deadline)"""
+    
+    def __init__(self, concurrency, worker_id=None):
+        self.concurrency = concurrency
+        self.worker_id = worker_id or f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}'
+        self.draining = threading.Event()
+        self.force_stop = threading.Event()
+        self.active = {}
+        self.active_lock = threading.Lock()
+    
+    def drain(self):
+        """Ngừng nhận run mới; gọi lần nữa để dừng ngay các run đang chạy"""
+        if self.draining.is_set():
+            self.force_stop.set()
+        self.draining.set()
+    
+    def serve(self):
+        """Chạy các slot và vòng giám sát cho tới khi drain xong"""
+        slots = [
+            threading.Thread(target=self.slot_loop, name=f'run-slot-{index}', daemon=True)
+            for index in range(self.concurrency)
+        ]
+        for slot in slots:
+            slot.start()
+        print(f"Worker {self.worker_id} running {self.concurrency} slot(s)", flush=True)
+        
+        conn = server.open_db_connection()
+        interval = min(SUPERVISE_INTERVAL, server.app.config['RUN_LEASE_SECONDS'] / 3)
+        try:
+            while not self.draining.is_set():
+                self.supervise(conn)
+                self.draining.wait(interval)
+            
+            print(f"Draining: waiting for {len(self.active)} run(s)", flush=True)
+            drain_deadline = time.time() + server.app.config['RUN_DRAIN_TIMEOUT']
+            while any(slot.is_alive() for slot in slots):
+                if self.force_stop.is_set() or time.time() > drain_deadline:
+                    with self.active_lock:
+                        active = list(self.active.values())
+                    for run in active:
+                        run.stop('failed', 'Worker shut down', force=True)
+                self.supervise(conn)
+                for slot in slots:
+                    slot.join(timeout=min(interval, 1))
+        finally:
+            conn.close()
+    
+    def supervise(self, conn):
+        """Gia hạn lease, áp dụng yêu cầu hủy và deadline, trả lại run của worker đã chết"""
+        with self.active_lock:
+            active = dict(self.active)
+        try:
+            cancelled = set()
+            if active:
+                cancelled = server.renew_run_leases(
+                    conn, self.worker_id, {run_id: run.steps_succeeded for run_id, run in active.items()}
+                )
+            now = time.time()
+            for run_id, run in active.items():
+                if run_id in cancelled:
+                    run.stop('cancelled', 'Cancelled by user')
+                elif now > run.deadline_at:
+                    run.stop('timed_out', f'Deadline of {run.deadline_seconds}s exceeded')
+            server.requeue_expired_runs(conn)
+        except sqlite3.Error as e:
+            print(f"Supervisor error: {e}", flush=True)
+    
+    def slot_loop(self):
+        """Nhận và thực thi từng run cho tới khi drain"""
+        conn = server.open_db_connection()
+        try:
+            while not self.draining.is_set():
+                try:
+                    row = server.claim_next_run(conn, self.worker_id)
+                except sqlite3.OperationalError as e:
+                    print(f"Failed to claim run: {e}", flush=True)
+                    row = None
+                if row is None:
+                    self.draining.wait(server.app.config['RUN_POLL_INTERVAL'])
+                    continue
+                self.execute(conn, row)
+        finally:
+            conn.close()
+    
+    def execute(self, conn, row):
+        """Thực thi một run đã nhận và ghi kết quả"""
+        workspace = os.path.join(server.app.config['RUN_WORKSPACE_FOLDER'], str(row['id']))
+        automation = HeadlessAutomation(row['id'], workspace)
+        run = ActiveRun(row, automation)
+        with self.active_lock:
+            self.active[run.id] = run
+        
+        steps_total = None
+        try:
+            plan = server.load_execution_plan(conn, row['scenario_id'])
+            if plan is None:
+                raise RunRejected('Scenario no longer exists')
+            steps = plan['steps']
+            steps_total = len(steps)
+            if not steps:
+                raise RunRejected('No executable steps found in workflow')
+            
+            automation.prepare_workspace(conn, row['requested_by'], steps)
+            for warning in plan['warnings']:
+                automation.log_message(f"Workflow warning: {warning}", "WARNING")
+            
+            automation.setup_webdriver()
+            events = server.get_step_event_writer()
+            for index, step in enumerate(steps, 1):
+                if automation.execution_stopped:
+                    break
+                started_at = time.time()
+                step_type = str(step.get('type') or 'unknown')[:64]
+                automation.publish('step-started', step_index=index - 1, type=step_type)
+                outcome, step_error = 'failed', None
+                try:
+                    if automation.execute_step(step):
+                        run.steps_succeeded += 1
+                        outcome = 'succeeded'
+                    elif automation.execution_stopped:
+                        outcome = 'skipped'
+                except Exception as e:
+                    # Như runner desktop: lỗi một bước không dừng cả run
+                    step_error = str(e)
+                    automation.log_message(f"Step {index} failed: {step_error}", "ERROR")
+                
+                event = {
+                    'step_index': index - 1,
+                    'type': step_type,
+                    'node_id': str(plan['order'][index - 1]),
+                    'outcome': outcome,
+                    'duration_ms': (time.time() - started_at) * 1000,
+                    'error': step_error[:2000] if step_error else None,
+                    'started_at': started_at,
+                }
+                # Không chờ commit: thread ghi gom event của mọi slot vào một transaction
+                events.submit(run.id, row['scenario_id'], [event], wait=False, live=[('step-finished', event)])
+                time.sleep(STEP_DELAY)
+            
+            if run.stop_status:
+                status, error = run.stop_status, run.stop_error
+            elif run.steps_succeeded == steps_total:
+                status, error = 'succeeded', None
+            else:
+                status, error = 'failed', f'{steps_total - run.steps_succeeded} of {steps_total} steps failed'
+        except Exception as e:
+            status, error = run.stop_status or 'failed', run.stop_error or str(e)
+        finally:
+            automation.close()
+            with self.active_lock:
+                self.active.pop(run.id, None)
+            shutil.rmtree(automation.upload_folder.get(), ignore_errors=True)
+        
+        automation.log_message(f"Finished: {status}" + (f" ({error})" if error else ""))
+        try:
+            # Lịch sử các bước phải có trong database trước khi run được báo là xong
+            server.get_step_event_writer().flush()
+            server.finish_run(conn, run.id, self.worker_id, status, steps_total, run.steps_succeeded, error)
+            server.publish_run_events(run.id, [], (status, error, steps_total))
+        except sqlite3.Error as e:
+            # Lease hết hạn, run sẽ được trả lại hàng đợi
+            automation.log_message(f"Failed to record result: {e}", "ERROR")
+        automation.publishing = False
+
+def main():
+    parser = argparse.ArgumentParser(description="Execute queued automation runs with headless Chrome")
+    parser.add_argument('--concurrency', type=int, default=server.app.config['RUN_WORKER_CONCURRENCY'],
+                        help="number of runs executed in parallel")
+    parser.add_argument('--database', default=server.app.config['DATABASE'], help="path to the server database")
+    args = parser.parse_args()
+    
+    server.app.config['DATABASE'] = args.database
+    server.init_database()
+    
+    pool = RunWorkerPool(max(1, args.concurrency))
+    signal.signal(signal.SIGTERM, lambda signum, frame: pool.drain())
+    signal.signal(signal.SIGINT, lambda signum, frame: pool.drain())
+    pool.serve()
+
+if __name__ == '__main__':
+    main()
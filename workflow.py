@@ -0,0 +1,247 @@
+"""Biên dịch workflow (visual hoặc linear) thành execution plan cho runner.
+
+Server biên dịch mỗi lần lưu và lưu lại plan; runner chỉ cần đọc plan.steps
+rồi thực thi tuần tự, không phải duyệt graph. Module này không phụ thuộc Flask
+để runner có thể dùng khi làm việc với server cũ.
+"""
+
+import math
+
+# Tăng khi thay đổi cách biên dịch hoặc định dạng plan; server sẽ biên dịch lại
+# các plan cũ khi khởi động
+PLAN_VERSION = 1
+
+REQUIRED = object()
+
+# Tham số của từng loại step: tên -> (kiểu, giá trị mặc định).
+# Mặc định None nghĩa là runner tự quyết định lúc chạy (không điền sẵn).
+STEP_PARAMETERS = {
+    # BASIC ACTIONS
+    'open_browser': {'url': (str, 'about:blank')},
+    'wait': {'duration': (float, 1)},
+    'wait_element': {'xpath': (str, REQUIRED), 'timeout': (float, 10)},
+    
+    # NAVIGATION
+    'new_tab': {'url': (str, ''), 'tab_variable': (str, None)},
+    'activate_tab': {'tab_variable': (str, 'main_tab')},
+    'open_url': {'url': (str, 'about:blank')},
+    'close_tab': {'close_current': (bool, True), 'tab_variable': (str, '')},
+    'go_back': {'steps': (int, 1)},
+    'reload_page': {'force_reload': (bool, False)},
+    
+    # USER INTERACTIONS
+    'click': {'xpath': (str, REQUIRED), 'click_type': (str, 'single'), 'wait_timeout': (float, 10)},
+    'type_text': {
+        'xpath': (str, REQUIRED),
+        'text': (str, ''),
+        'clear_first': (bool, True),
+        'typing_speed': (str, 'normal'),
+    },
+    'scroll': {
+        'direction': (str, 'down'),
+        'pixels': (int, 500),
+        'target_element': (str, ''),
+        'smooth': (bool, True),
+    },
+    
+    # KEYBOARD
+    'press_key': {'key_combination': (str, 'Enter'), 'modifier_keys': (str, ''), 'hold_duration': (float, 0.1)},
+    
+    # DATA
+    'element_exists': {
+        'xpath': (str, REQUIRED),
+        'save_result': (bool, True),
+        'result_variable': (str, 'element_exists'),
+    },
+    'get_text': {'xpath': (str, REQUIRED), 'attribute': (str, 'text'), 'save_variable': (str, 'extracted_text')},
+    
+    # FILE OPERATIONS
+    'upload': {'xpath': (str, REQUIRED), 'file_path': (str, ''), 'wait_after': (float, 2)},
+    'download': {'xpath': (str, REQUIRED), 'save_path': (str, ''), 'wait_timeout': (float, 30)},
+    'screenshot': {'save_path': (str, ''), 'full_page': (bool, False), 'element_xpath': (str, '')},
+    
+    # CONTROL FLOW
+    'javascript': {'script': (str, ''), 'return_variable': (str, '')},
+    'condition': {
+        'condition_type': (str, 'element_exists'),
+        'xpath': (str, ''),
+        'expected_value': (str, ''),
+        'variable_name': (str, ''),
+    },
+    'loop': {'loop_type': (str, 'count'), 'count': (int, 5), 'max_iterations': (int, 100)},
+}
+
+TRUE_STRINGS = {'true', '1', 'yes', 'on'}
+FALSE_STRINGS = {'false', '0', 'no', 'off', ''}
+
+def coerce_parameter(value, kind):
+    """Ép giá trị từ editor (thường là chuỗi) về kiểu của tham số, ValueError nếu không được"""
+    if kind is bool:
+        if isinstance(value, bool):
+            return value
+        if isinstance(value, (int, float)):
+            return bool(value)
+        if isinstance(value, str) and value.strip().lower() in TRUE_STRINGS | FALSE_STRINGS:
+            return value.strip().lower() in TRUE_STRINGS
+        raise ValueError(f'expected a boolean, got {value!r}')
+    
+    if kind is int or kind is float:
+        if isinstance(value, bool):
+            raise ValueError(f'expected a number, got {value!r}')
+        if isinstance(value, (int, float)):
+            return int(value) if kind is int else value
+        if isinstance(value, str):
+            number = float(value.strip())
+            if not math.isfinite(number):
+                raise ValueError(f'expected a finite number, got {value!r}')
+            if kind is int:
+                if not number.is_integer():
+                    raise ValueError(f'expected an integer, got {value!r}')
+                return int(number)
+            return int(number) if number.is_integer() else number
+        raise ValueError(f'expected a number, got {value!r}')
+    
+    if isinstance(value, (dict, list)):
+        raise ValueError(f'expected a string, got {type(value).__name__}')
+    return value if isinstance(value, str) else str(value)
+
+def normalize_step(step, label, warnings):
+    """Điền mặc định và ép kiểu tham số của một step; các khóa lạ được giữ nguyên"""
+    step_type = step.get('type')
+    parameters = STEP_PARAMETERS.get(step_type)
+    if parameters is None:
+        warnings.append(f'{label}: unknown step type {step_type!r}')
+        return dict(step)
+    
+    normalized = dict(step)
+    for name, (kind, default) in parameters.items():
+        value = step.get(name)
+        if value is None or (default is REQUIRED and value == ''):
+            if default is REQUIRED:
+                warnings.append(f'{label} ({step_type}): missing {name}')
+            elif default is not None:
+                normalized[name] = default
+            continue
+        try:
+            normalized[name] = coerce_parameter(value, kind)
+        except ValueError as e:
+            warnings.append(f'{label} ({step_type}): invalid {name}: {e}')
+            if default is not REQUIRED and default is not None:
+                normalized[name] = default
+    return normalized
+
+def node_to_step(node):
+    """Chuyển node thành step format (dữ liệu của node nằm cùng cấp với type)"""
+    node_type = node.get('type')
+    if not node_type or node_type == 'start':
+        return None
+    node_data = node.get('data')
+    return {'type': node_type, **(node_data if isinstance(node_data, dict) else {})}
+
+def build_adjacency(connections):
+    """source -> danh sách (type, target) theo thứ tự khai báo"""
+    adjacency = {}
+    for conn in connections:
+        if not isinstance(conn, dict) or 'source' not in conn or 'target' not in conn:
+            continue
+        adjacency.setdefault(conn['source'], []).append((conn.get('type'), conn['target']))
+    return adjacency
+
+def resolve_visual_order(visual_data, warnings):
+    """Thứ tự thực thi của visual workflow: duyệt DFS từ start node, nhánh success trước"""
+    nodes = [node for node in visual_data.get('nodes') or [] if isinstance(node, dict) and 'id' in node]
+    connections = visual_data.get('connections') or []
+    if not nodes or not connections:
+        return None, [], {}
+    
+    nodes_dict = {node['id']: node for node in nodes}
+    adjacency = build_adjacency(connections)
+    
+    start_node_id = visual_data.get('startNode')
+    if not start_node_id:
+        for node in nodes:
+            if node.get('isStart') or node.get('type') == 'start':
+                start_node_id = node['id']
+                break
+    if not start_node_id:
+        warnings.append('No start node found in visual workflow')
+        return None, [], adjacency
+    
+    # Stack thay cho đệ quy để graph dài không chạm giới hạn recursion.
+    # Các target success được ưu tiên theo thứ tự ngược (như bản đệ quy cũ
+    # dùng insert(0)), sau đó tới các nhánh còn lại theo thứ tự khai báo.
+    order = []
+    visited = set()
+    stack = [start_node_id]
+    while stack:
+        node_id = stack.pop()
+        if node_id in visited:
+            continue
+        visited.add(node_id)
+        
+        if node_id not in nodes_dict:
+            warnings.append(f'Connection points to missing node {node_id!r}')
+        elif nodes_dict[node_id].get('type') != 'start':
+            order.append(node_id)
+        
+        edges = adjacency.get(node_id, [])
+        next_nodes = [target for kind, target in reversed(edges) if kind == 'success']
+        next_nodes += [target for kind, target in edges if kind != 'success']
+        stack.extend(reversed(next_nodes))
+    
+    unreachable = [node['id'] for node in nodes if node['id'] not in visited and node.get('type') != 'start']
+    if unreachable:
+        warnings.append(f'{len(unreachable)} node(s) not reachable from the start node')
+    
+    return start_node_id, order, adjacency
+
+def compile_workflow(steps_data):
+    """Biên dịch document của workflow thành execution plan (dict JSON-serializable)"""
+    warnings = []
+    is_visual = isinstance(steps_data, dict) and steps_data.get('workflow_type') == 'visual'
+    
+    if is_visual:
+        start_node_id, node_order, adjacency = resolve_visual_order(steps_data, warnings)
+        nodes_dict = {node['id']: node for node in steps_data.get('nodes') or []
+                      if isinstance(node, dict) and 'id' in node}
+        order = []
+        raw_steps = []
+        for node_id in node_order:
+            step = node_to_step(nodes_dict[node_id])
+            if step:
+                order.append(node_id)
+                raw_steps.append((f'Node {node_id}', step))
+    else:
+        start_node_id = None
+        adjacency = {}
+        order = []
+        raw_steps = []
+        for index, step in enumerate(steps_data if isinstance(steps_data, list) else []):
+            if not isinstance(step, dict):
+                warnings.append(f'Step {index + 1}: not an object')
+                continue
+            order.append(index)
+            raw_steps.append((f'Step {index + 1}', step))
+    
+    compiled = [normalize_step(step, label, warnings) for label, step in raw_steps]
+    if not compiled:
+        warnings.append('No executable steps found in workflow')
+    
+    step_types = {step.get('type') for step in compiled}
+    return {
+        'version': PLAN_VERSION,
+        'workflow_type': 'visual' if is_visual else 'linear',
+        'start_node': start_node_id,
+        'order': order,
+        'adjacency': {
+            str(source): {
+                kind or 'default': [target for edge_kind, target in edges if edge_kind == kind]
+                for kind in dict.fromkeys(edge_kind for edge_kind, _ in edges)
+            }
+            for source, edges in adjacency.items()
+        },
+        'steps': compiled,
+        'needs_upload': 'upload' in step_types,
+        'needs_download': 'download' in step_types,
+        'warnings': warnings,
+    }
@@ -0,0 +1,40 @@
+"""Entry point WSGI cho production (thay cho app.run của server.py).
+
+    pip install gunicorn gevent
+    SECRET_KEY=... gunicorn -c gunicorn.conf.py wsgi:app
+
+Mỗi worker gunicorn là một process riêng; worker gevent phục vụ mỗi kết nối
+(keep-alive, stream SSE / export) bằng một greenlet thay vì một OS thread.
+Trạng thái dùng chung giữa các worker nằm trong SQLite: session là cookie ký
+bằng cùng SECRET_KEY (hoặc file secret_key), cache scenario đồng bộ theo change
+feed, event SSE đi qua bảng run_event_log, metric của từng worker được ghi vào
+bảng metric_snapshots và gộp lại ở /metrics (worker nào nhận scrape cũng trả
+cùng tổng).
+
+Biến môi trường (tùy chọn): SECRET_KEY, DATABASE, UPLOAD_FOLDER, METRICS_TOKEN.
+"""
+import os
+
+import server
+
+ENV_SETTINGS = ('DATABASE', 'UPLOAD_FOLDER', 'METRICS_TOKEN')
+
+def configure_from_env():
+    """Ghi đè cấu hình của server bằng biến môi trường cùng tên"""
+    for name in ENV_SETTINGS:
+        if os.environ.get(name):
+            server.app.config[name] = os.environ[name]
+    # Nhiều worker: cache của mỗi process phải biết các lần ghi của process khác
+    server.app.config['SCENARIO_CACHE_SYNC'] = True
+    server.app.config['METRICS_SHARED'] = True
+    server.ensure_upload_folders()
+
+configure_from_env()
+
+# gunicorn.conf.py đã khởi tạo / migrate database trong process master trước khi fork;
+# chạy dưới WSGI server khác (một process) thì khởi tạo ở đây
+if not os.environ.get('SCENARIO_SERVER_INITIALIZED'):
+    server.init_database()
+    server.clear_metric_snapshots()
+
+app = server.app